@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime
+from aws_clients import get_client
+from instrumentation import flush_metrics
+from orchestrator import run_reports
+from query_planner import plan
+from report_email import compact_mode, send_report
+from report_specs import ReportContext, period_dates, select_reports
+
+# Produces every configured report in one invocation. The report specs are
+# planned into the fewest Cost Explorer requests plus one CloudWatch fetch
+# for the CDN reports; the fetches and each report's render and send stages
+# then run as concurrent tasks, so the run takes about as long as its
+# slowest report.
+@flush_metrics('AllReports')
+def lambda_handler(event, context):
+    event = event or {}
+    today = datetime.utcnow()
+    specs = select_reports(event.get('reports'), event)
+
+    requests = [(spec, *period_dates(spec.period, today)) for spec in specs]
+    queries = plan(requests)
+    print(f"Planned {len(queries)} queries for {len(specs)} reports")
+
+    ce_client = get_client('ce', region_name='us-east-1')
+    report_context = ReportContext(event)
+    sender = 'ashutosh.deshmukh@whistlemind.com'
+    recipient = 'ashutosh.deshmukh@whistlemind.com'
+
+    def send(subject, body_html, attachment):
+        return send_report(subject, body_html, sender, recipient, attachment)
+
+    outcomes = asyncio.run(run_reports(queries, report_context, ce_client, send, compact=compact_mode(event)))
+
+    failed = [spec.name for spec, error in outcomes if error is not None]
+    return {
+        'statusCode': 500 if failed else 200,
+        'body': f'{len(specs) - len(failed)} reports sent' + (f", failed: {', '.join(failed)}" if failed else '')
+    }
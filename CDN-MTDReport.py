@@ -1,266 +1,161 @@
-import boto3
 from datetime import datetime, timedelta
-from collections import defaultdict
-
-# Function to send email
-def send_email(subject, body, sender, recipient):
-    AWS_REGION = "us-east-1"
-    CHARSET = "UTF-8"
-    client = boto3.client('ses', region_name=AWS_REGION)
-    response = client.send_email(
-        Destination={
-            'ToAddresses': [recipient],
-        },
-        Message={
-            'Body': {
-                'Html': {
-                    'Charset': CHARSET,
-                    'Data': body,
-                }
-            },
-            'Subject': {
-                'Charset': CHARSET,
-                'Data': subject,
-            },
-        },
-        Source=sender,
-    )
-    return response
-
-# Function to convert usage to bytes
-def convert_usage_to_bytes(usage, unit):
-    units = {
-        'Bytes': 1,
-        'KB': 1024,
-        'MB': 1024 * 1024,
-        'GB': 1024 * 1024 * 1024,
-        'TB': 1024 * 1024 * 1024 * 1024
-    }
-    return usage * units.get(unit, 1)
-
-# Function to format size
-def format_size(size_in_bytes):
-    suffixes = ['Bytes', 'KB', 'MB', 'GB', 'TB']
-    index = 0
-    while size_in_bytes >= 1024 and index < len(suffixes) - 1:
-        size_in_bytes /= 1024.0
-        index += 1
-    return f"{size_in_bytes:.2f} {suffixes[index]}"
-    
-# Function to check if an account has the necessary STS role
-def has_sts_role(account_id):
-    try:
-        sts_client = boto3.client('sts')
-        sts_client.assume_role(
-            RoleArn=f"arn:aws:iam::{account_id}:role/CrossAccountReadAccess",
-            RoleSessionName="check_role_existence"
-        )
-        return True
-    except Exception as e:
-        print(f"Account {account_id} does not have the required STS role. Skipping.")
-        return
-
-# Function to list distributions for a given AWS account
-def list_distributions_for_account(account_id):
-    try:
-        sts_connection = boto3.client('sts')
-        acct_b = sts_connection.assume_role(
-            RoleArn=f"arn:aws:iam::{account_id}:role/CrossAccountReadAccess",
-            RoleSessionName="cross_acct_lambda"
-        )
-
-        ACCESS_KEY = acct_b['Credentials']['AccessKeyId']
-        SECRET_KEY = acct_b['Credentials']['SecretAccessKey']
-        SESSION_TOKEN = acct_b['Credentials']['SessionToken']
-
-        # create service client using the assumed role credentials, e.g. CloudFront
-        client = boto3.client(
-            'cloudfront',
-            aws_access_key_id=ACCESS_KEY,
-            aws_secret_access_key=SECRET_KEY,
-            aws_session_token=SESSION_TOKEN,
-        )
-
-        response = client.list_distributions()
-
-        dist_list = []
-        for i in response['DistributionList']['Items']:
-            ele = {
-                "DistributionId": i['Id'],
-                "DomainName": i['DomainName'],
-                "AlternateDomainNames": i.get('Aliases', {}).get('Items', [])
-            }
-            dist_list.append(ele)
-
-        return dist_list
-    except Exception as e:
-        print(f"Error listing distributions for account {account_id}: {str(e)}")
-        return []
-
-# Function to generate HTML table
-def generate_html_table(distributions, distribution_usage, all_days):
-    email_body = """
-    <html>
-    <head>
-    <style>
-        table {
-            border-collapse: collapse;
-            width: 100%;
-        }
-        th, td {
-            border: 1px solid black;
-            padding: 8px;
-            text-align: left;
-        }
-        th {
-            background-color: #F2F2F2;
-        }
-    </style>
-    </head>
-    <body>
-    <table>
-    <tr>
-    <th>Distribution ID</th>
-    <th>Domain Name</th>
-    <th>Alternate Domain Names</th>
-    """
-
-    for day in all_days:
-        short_day_name = day.strftime('%d')
-        email_body += f"<th>{short_day_name}</th>"
-    email_body += "<th>Total</th></tr>"
-
-    for dist in distributions:
+from functools import partial
+from cloudfront_metrics import fetch_hourly_rows, fetch_usage_rows
+from cost_matrix import format_sizes
+from html_render import render_document, render_table
+from instrumentation import flush_metrics
+from report_email import compact_mode, finish_report, render_email
+from report_fanout import fan_out_mode, partition, send_account_reports
+from report_specs import ReportContext, cdn_granularity
+from rolling_stats import ANOMALY_CLASS, NO_ANOMALIES, get_rolling_stats, render_movers
+from sharding import fetch_sharded, get_shard_count, run_shard
+
+# Function to format each distribution's peak hours as '14 09:00 UTC (1.20 GB)' cells
+def peak_hour_cells(distributions, peak_hours):
+    peaks = [peak_hours.get(dist['DistributionId'], []) for dist in distributions]
+    sizes = iter(format_sizes([value for hours in peaks for hour, value in hours]).tolist())
+    return [', '.join(f'{hour:%d %H:00} UTC ({next(sizes)})' for hour, value in hours) for hours in peaks]
+
+# Function to yield one table row per distribution, with anomalous days flagged
+def distribution_rows(distributions, matrix, peak_hours=None, flagged=()):
+    # Formatting and totals are computed for the whole matrix at once
+    cells = format_sizes(matrix.values)
+    row_totals = matrix.row_totals()
+    totals = format_sizes(row_totals)
+    peaks = peak_hour_cells(distributions, peak_hours) if peak_hours else None
+
+    for i, dist in enumerate(distributions):
         distribution_id = dist['DistributionId']
-        email_body += f"<tr><td>{distribution_id}</td><td>{dist['DomainName']}</td><td>{', '.join(dist['AlternateDomainNames'])}</td>"
-        total_usage_bytes = 0
-
-        for day in all_days:
-            usage_data = distribution_usage.get(distribution_id, {})
-            usage, unit = usage_data.get(day, (0, "Bytes"))
-            usage_in_bytes = convert_usage_to_bytes(usage, unit)
-            total_usage_bytes += usage_in_bytes
-            formatted_usage = format_size(usage_in_bytes)
-            email_body += f'<td>{formatted_usage}</td>'
-
-        formatted_total_usage = format_size(total_usage_bytes)
-        email_body += f"<td>{formatted_total_usage}</td></tr>"
+        row = [distribution_id, dist['DomainName'], ', '.join(dist['AlternateDomainNames'])]
+        row.extend((cell, ANOMALY_CLASS) if (i, j) in flagged else cell for j, cell in enumerate(cells[i].tolist()))
+        row.append((totals[i], 'total'))
+        if peaks is not None:
+            row.append(peaks[i])
 
         # Debugging print statements to identify potential duplication
         print(f"Distribution ID: {distribution_id}")
-        print(f"Total Usage Bytes: {total_usage_bytes}")
+        print(f"Total Usage Bytes: {row_totals[i]}")
+
+        yield row
+
+# Function to generate HTML table; in hourly mode a last column lists each distribution's peak hours
+def generate_html_table(distributions, matrix, peak_hours=None, flagged=()):
+    header = ['Distribution ID', 'Domain Name', 'Alternate Domain Names']
+    header.extend(day.strftime('%d') for day in matrix.columns)
+    header.append('Total')
+    if peak_hours:
+        header.append('Peak Hours')
+
+    return render_table(header, distribution_rows(distributions, matrix, peak_hours, flagged))
+
+# Function to pair the daily UsageRows of the distributions with their peak
+# hours, which labels holds in hourly mode. Returns (usage rows, peak hours by distribution)
+def rows_to_records(rows, labels):
+    return rows, labels
+
+# Function to build the email subject and HTML body; series names the
+# rolling statistics the days are flagged against, None to flag none
+def render_report(records, start_date, end_date, report_context, series='CDN-MTDReport'):
+    distribution_usage, peak_hours = records
+    distributions = report_context.distributions
+
+    # Every day of the month so far gets a column, also days without traffic
+    first_day = start_date.date()
+    all_days = [first_day + timedelta(days=n) for n in range((end_date.date() - first_day).days)]
+    matrix = distribution_usage.matrix([dist['DistributionId'] for dist in distributions], all_days)
+
+    # Days far outside their rolling statistics are flagged and the biggest
+    # movers of the latest day listed above the table. CloudWatch figures
+    # are final, so every day is folded into the statistics.
+    anomalies = get_rolling_stats(series, 28, 7).observe(matrix) if series else NO_ANOMALIES
+    movers = render_movers(anomalies.movers, 'Distribution ID', lambda values: format_sizes(values).tolist())
+    email_body = movers + generate_html_table(distributions, matrix, peak_hours, anomalies.cells)
 
-    email_body += "</table></body></html>"
+    current_month = start_date.strftime('%B')
+    current_year = start_date.strftime('%Y')
 
-    return email_body
+    # Create email content
+    body_html = render_document(f'<h4>CloudFront MTD Report <br> {current_month} {current_year}</h4>', email_body)
 
+    subject = f'CloudFront MTD Usage Report - {current_year}'
+    return subject, body_html
+
+# Function to split the records into {account ID: (distributions, records)} slices, one per account with distributions
+def account_slices(records, distributions):
+    distribution_usage, peak_hours = records
+    slices = {}
+    for account_id, account_distributions in partition(distributions, lambda dist: dist['AccountId']).items():
+        distribution_ids = [dist['DistributionId'] for dist in account_distributions]
+        peaks = {k: peak_hours[k] for k in distribution_ids if k in peak_hours}
+        slices[account_id] = (account_distributions, (distribution_usage.select(distribution_ids), peaks))
+    return slices
+
+# Function to render one account's slice for its owner. Anomalies are
+# flagged in the organization's report only, which keeps hundreds of slices cheap.
+def render_account_report(account_id, account_slice, start_date, end_date, compact=False):
+    distributions, records = account_slice
+    report_context = ReportContext(distributions=distributions)
+
+    def render():
+        subject, body_html = render_report(records, start_date, end_date, report_context, None)
+        return f'{subject} - {account_id}', body_html
+
+    return render_email(render, compact)
+
+# Function to yield one record per distribution and day with traffic, the figures the email shows
+def export_records(records, report_context):
+    distribution_usage = records[0]
+    for dist in report_context.distributions:
+        for day, usage in distribution_usage.usage(dist['DistributionId']):
+            yield {'Distribution ID': dist['DistributionId'], 'Domain Name': dist['DomainName'], 'Date': day,
+                   'Usage': usage, 'Unit': 'Bytes'}
+
+@flush_metrics('CDN-MTDReport')
 def lambda_handler(event, context):
-    org_client = boto3.client('organizations')
-    org_response = org_client.list_accounts()
-
-    cf_client = boto3.client('cloudfront')
-    ce_client = boto3.client('ce', region_name='us-east-1')
+    # A shard worker invoked by a sharded run returns its partial usage instead of sending a report
+    if event and 'shard' in event:
+        return run_shard(event['shard'])
 
     # Set end_date as the current date
     end_date = datetime.utcnow()
-    distribution_usage = {}
-    
-    ac_list = []
-    for k in org_response['Accounts']:
-        if k.get('Status') == 'ACTIVE' and has_sts_role(k['Id']):
-            ac_list.append(k['Id'])
-
-    distributions = []
-    for j in ac_list:
-        dist_list = list_distributions_for_account(j)
-        distributions.extend(dist_list)
 
-    for dist in distributions:
-        distribution_id = dist['DistributionId']
-
-        # Set start_date as the first date of the current month
-        start_date = end_date.replace(day=1)  # Set day to 1 for the first date of the current month
-
-        # Initialize daily_usage with zeros for all days using defaultdict
-        daily_usage = defaultdict(lambda: (0, 'Bytes'))
-
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date.strftime('%Y-%m-%d'),
-                'End': end_date.strftime('%Y-%m-%d')
-            },
-            Granularity='DAILY',
-            Metrics=['UsageQuantity'],
-            GroupBy=[
-                {
-                    'Type': 'DIMENSION',
-                    'Key': 'LINKED_ACCOUNT'
-                },
-            ],
-            Filter={
-                'And': [
-                    {'Dimensions': {'Key': 'SERVICE', 'Values': ['Amazon CloudFront']}},
-                    {'Dimensions': {'Key': 'RECORD_TYPE', 'Values': ['Usage']}},
-                    {'Dimensions': {'Key': 'USAGE_TYPE', 'Values': [
-                        'AP-DataTransfer-Out-Bytes',
-                        'AP-DataTransfer-Out-OBytes',
-                        'APS3-DataTransfer-Out-Bytes',
-                        'AU-DataTransfer-Out-Bytes',
-                        'AU-DataTransfer-Out-OBytes',
-                        'CA-DataTransfer-Out-Bytes',
-                        'CA-DataTransfer-Out-OBytes',
-                        'DataTransfer-Out-Bytes',
-                        'EU-DataTransfer-Out-Bytes',
-                        'EU-DataTransfer-Out-OBytes',
-                        'IN-DataTransfer-Out-Bytes',
-                        'IN-DataTransfer-Out-OBytes',
-                        'JP-DataTransfer-Out-Bytes',
-                        'JP-DataTransfer-Out-OBytes',
-                        'ME-DataTransfer-Out-Bytes',
-                        'ME-DataTransfer-Out-OBytes',
-                        'SA-DataTransfer-Out-Bytes',
-                        'SA-DataTransfer-Out-OBytes',
-                        'US-DataTransfer-Out-Bytes',
-                        'US-DataTransfer-Out-OBytes',
-                        'USE2-DataTransfer-Out-OBytes',
-                        'ZA-DataTransfer-Out-Bytes',
-                        'ZA-DataTransfer-Out-OBytes'
-                    ]}},
-                ]
-            }
+    # Set start_date as the first date of the current month
+    start_date = end_date.replace(day=1)  # Set day to 1 for the first date of the current month
+
+    report_context = ReportContext(event)
+
+    # Distributions of every account are discovered in parallel, then their
+    # daily BytesDownloaded is read from CloudWatch, up to 500 per call. In
+    # hourly mode the days are rolled up from hourly data as it streams in,
+    # keeping the peak hours of each distribution. Organizations too large
+    # for one invocation are split into shards of accounts whose partial
+    # usage is merged here, so one report is still sent.
+    shards = get_shard_count(event)
+    if shards > 1:
+        distributions, usage_rows, peak_hours = fetch_sharded(
+            start_date, end_date, cdn_granularity(event), shards, event, context
         )
-    
-        for result_by_time in response['ResultsByTime']:
-            start = datetime.strptime(result_by_time['TimePeriod']['Start'], '%Y-%m-%d').date()
-            usage = float(result_by_time['Groups'][0]['Metrics']['UsageQuantity']['Amount'])
-            unit = result_by_time['Groups'][0]['Metrics']['UsageQuantity']['Unit']
-    
-            # Update daily_usage for the specific day
-            daily_usage[start] = (daily_usage[start][0] + usage, unit)
-    
-            # Print fetched usage for each distribution after processing
-            print(f"Distribution ID: {distribution_id}, Date: {start}, Usage: {usage} {unit}")
-    
-        distribution_usage[distribution_id] = daily_usage  # Store usage data for each distribution separately
-    
-    all_days = sorted(set(day for usage_data in distribution_usage.values() for day in usage_data.keys()))
-
-    email_body = generate_html_table(distributions, distribution_usage, all_days)
-
-    current_month = start_date.strftime('%B')
-    current_year = start_date.strftime('%Y')
-
-    # Create email content
-    body_html = f'<html><body><h4>CloudFront MTD Report <br> {current_month} {current_year}</h4>{email_body}</body></html>'
+        report_context = ReportContext(event, distributions)
+    elif cdn_granularity(event) == 'HOURLY':
+        usage_rows, peak_hours = fetch_hourly_rows(report_context.distributions, start_date, end_date)
+    else:
+        usage_rows, peak_hours = fetch_usage_rows(report_context.distributions, start_date, end_date, 'DAILY'), {}
+    records = rows_to_records(usage_rows, peak_hours)
 
     sender = 'ashutosh.deshmukh@whistlemind.com'
     recipient = 'ashutosh.deshmukh@whistlemind.com'
 
-    subject = f'CloudFront MTD Usage Report - {current_year}'
-    send_email(subject, body_html, sender, recipient)
+    finish_report(
+        'CDN-MTDReport', lambda: render_report(records, start_date, end_date, report_context),
+        export_records(records, report_context), end_date, sender, recipient, compact_mode(event)
+    )
+
+    # Each account's owner gets the report for their account's distributions alone
+    if fan_out_mode(event):
+        render = partial(render_account_report, start_date=start_date, end_date=end_date, compact=compact_mode(event))
+        send_account_reports('CDN-MTDReport', account_slices(records, report_context.distributions), render, sender)
 
     return {
         'statusCode': 200,
         'body': 'Function executed successfully'
     }
-
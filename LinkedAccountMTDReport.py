@@ -1,5 +1,13 @@
-import boto3
 from datetime import datetime
+from account_names import AccountNameIndex
+from aws_clients import get_client
+from cost_columns import report_metrics
+from cost_store import fetch_daily, get_store
+from cost_tables import account_table
+from html_render import render_document
+from instrumentation import flush_metrics
+from report_email import compact_mode, finish_report
+from report_specs import COST_FILTER, ReportContext
 
 def get_mtd_dates():
     today = datetime.now()
@@ -7,89 +15,58 @@ def get_mtd_dates():
     end_date = today
     return start_date, end_date
 
-def get_cost_and_usage(start_date, end_date):
-    client = boto3.client('ce', region_name='us-east-1')
-
-    response = client.get_cost_and_usage(
-        TimePeriod={
-            'Start': start_date.strftime('%Y-%m-%d'),
-            'End': end_date.strftime('%Y-%m-%d')
-        },
-        Granularity='DAILY',
-        Metrics=['BlendedCost'],
-        GroupBy=[
-            {'Type': 'DIMENSION', 'Key': 'LINKED_ACCOUNT'}
-        ],
-        Filter={
-            "Not": {
-                'Dimensions': {
-                    'Key': 'RECORD_TYPE',
-                    'Values': ['Credit', 'Refund']
-                }
-            }
-        }
-    )
+# Function to turn (account ID, date, amount, currency) rows into report records
+def rows_to_records(rows, labels):
+    # Names are indexed once instead of scanned for every row
+    account_names = AccountNameIndex()
+    account_names.update_names(labels)
 
-    data = []
+    return rows.records(lambda account_id, date, amount, currency: {
+        'Date': date, 'Account ID': account_id, 'Account Name': account_names.resolve(account_id), 'Amount': amount,
+        'Currency': currency,
+    })
 
-    for i in response['ResultsByTime']:
-        date = i['TimePeriod']['Start']
+def get_cost_and_usage(start_date, end_date):
+    client = get_client('ce', region_name='us-east-1')
 
-        for j in i['Groups']:
-            account_id = j['Keys'][0]
-            amount = j['Metrics']['BlendedCost']['Amount']
-            currency = j['Metrics']['BlendedCost']['Unit']
-            for j in response['DimensionValueAttributes']:
-                if account_id == j['Value']:
-                    account_name = j['Attributes']['description']
-            data.append({'Date': date, 'Account ID': account_id, 'Account Name': account_name, 'Amount': amount,
-                         'Currency': currency})
+    # Earlier days come from the local store; only new and restatable days are fetched
+    store = get_store()
+    rows = fetch_daily(client, store, start_date, end_date, report_metrics('BlendedCost'), 'LINKED_ACCOUNT', filter=COST_FILTER)
 
-    return data
+    return rows_to_records(rows, store.labels('LINKED_ACCOUNT'))
 
+# Function to generate the HTML table of daily costs per account
 def format_data_to_html(data, float_format='%.2f'):
-    html_table = "<table style='border-collapse: collapse; width: 100%; border: 1px solid black;'><tr><th style='border: 1px solid black; text-align: le; background-color: #F2F2F2;'>Account ID</th><th style='border: 1px solid black; text-align: left; background-color: #F2F2F2;'>Account Name</th>"
-
-    # Extract unique dates
-    dates = sorted(set(item['Date'] for item in data))
-
-    for date in dates:
-        day_only = datetime.strptime(date, '%Y-%m-%d').strftime('%d')
-        html_table += f"<th style='border: 1px solid black; text-align: center; background-color: #F2F2F2;'>{day_only}</th>"
+    return account_table(data, lambda date: datetime.strptime(date, '%Y-%m-%d').strftime('%d'), float_format)
 
-    # Add Total column header
-    html_table += "<th style='border: 1px solid black; font-weight: bold; text-align: center; background-color: #F2F2F2;'>Total</th></tr>"
-
-    account_ids = sorted(set(item['Account ID'] for item in data))
-
-    for account_id in account_ids:
-        account_data = [item for item in data if item['Account ID'] == account_id]
-        account_name = account_data[0]['Account Name'] if account_data else 'N/A'
-        html_table += f"<tr><td style='border: 1px solid black; text-align: center;'>{account_id}</td><td style='border: 1px solid black; text-align: left;'>{account_name}</td>"
+# Function to build the email subject and HTML body
+def render_report(cost_data, start_date, end_date, report_context):
+    # Format data as HTML table with account ID and date
+    html_table = format_data_to_html(cost_data, float_format='%.2f')
 
-        total_cost = 0  # Initialize total cost for the account
+    # Extract the currency from the first item in the cost_data list
+    currency = cost_data[0]['Currency'] if cost_data else 'N/A'
 
-        for date in dates:
-            cost = next((item['Amount'] for item in account_data if item['Date'] == date), 'N/A')
-            if cost != 'N/A':
-                cost = round(float(cost), 2)  # Convert the cost to a floating-point number
-                formatted_cost = float_format % cost
-                html_table += f"<td style='border: 1px solid black; text-align: center;'>{formatted_cost}</td>"
+    # Get AWS Account ID
+    account_id = report_context.account_id
 
-                total_cost += cost  # Accumulate cost for the total column
-            else:
-                html_table += f"<td style='border: 1px solid black; text-align: center;'>{cost}</td>"
+    # Get current month and year
+    current_month = start_date.strftime('%B')
+    current_year = start_date.strftime('%Y')
 
-        # Add Total column value
-        total_formatted_cost = float_format % total_cost
-        html_table += f"<td style='border: 1px solid black; font-weight: bold; text-align: center; background-color: #F2F2F2;'>{total_formatted_cost}</td>"
+    # Create email subject with current month, year, and AWS Account ID, including start and end dates
+    subject = f'MTD Report for Linked Account - {account_id} {current_month} {current_year}'
 
-        html_table += "</tr>"
+    # Create email content
+    body_html = render_document(f"<h4>MTD Report for Linked Account - {account_id} <br> {current_month} {current_year} </h4><h5>Currency: {currency}</h5>", html_table)
 
-    html_table += "</table>"
+    return subject, body_html
 
-    return html_table
+# Function to return the records exported alongside the email
+def export_records(cost_data, report_context):
+    return iter(cost_data)
 
+@flush_metrics('LinkedAccountMTDReport')
 def lambda_handler(event, context):
     # Retrieve Month-to-Date (MTD) dates
     start_date, end_date = get_mtd_dates()
@@ -97,39 +74,15 @@ def lambda_handler(event, context):
     # Retrieve AWS cost and usage data
     cost_data = get_cost_and_usage(start_date, end_date)
 
-    # Format data as HTML table with account ID and date
-    html_table = format_data_to_html(cost_data, float_format='%.2f')
-
-    # Extract the currency from the first item in the cost_data list
-    currency = cost_data[0]['Currency'] if cost_data else 'N/A'
-
-    # Get AWS Account ID
-    sts_client = boto3.client('sts')
-    account_id = sts_client.get_caller_identity()['Account']
+    report_context = ReportContext(event)
 
     # Configure SES
-    ses = boto3.client('ses', region_name='us-east-1')
     sender_email = 'ashutosh.deshmukh@whistlemind.com'
     recipient_email = 'ashutosh.deshmukh@whistlemind.com'
 
-    # Get current month and year
-    current_month = start_date.strftime('%B')
-    current_year = start_date.strftime('%Y')
-
-    # Create email subject with current month, year, and AWS Account ID, including start and end dates
-    subject = f'MTD Report for Linked Account - {account_id} {current_month} {current_year}'
-
-    # Create email content
-    body_html = f"<html><body><h4>MTD Report for Linked Account - {account_id} <br> {current_month} {current_year} </h4><h5>Currency: {currency}</h5><p>{html_table}</p></body></html>"
-
-    # Send email
-    response = ses.send_email(
-        Source=sender_email,
-        Destination={'ToAddresses': [recipient_email]},
-        Message={
-            'Subject': {'Data': subject},
-            'Body': {'Html': {'Data': body_html}}
-        }
+    finish_report(
+        'LinkedAccountMTDReport', lambda: render_report(cost_data, start_date, end_date, report_context),
+        export_records(cost_data, report_context), end_date, sender_email, recipient_email, compact_mode(event)
     )
 
     return {
@@ -1,8 +1,15 @@
-import boto3
-from datetime import datetime, timedelta
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import calendar
+from datetime import datetime
+from functools import partial
+from aws_clients import get_client
+from cost_columns import report_metrics
+from cost_store import fetch_daily, get_store, is_settled
+from cost_tables import service_table
+from html_render import render_document
+from instrumentation import flush_metrics
+from report_email import compact_mode, finish_report, render_email
+from report_fanout import fan_out_mode, send_account_reports
+from report_specs import COST_FILTER, ReportContext
+from rolling_stats import NO_ANOMALIES, get_rolling_stats
 
 def get_mtd_dates():
     today = datetime.now()
@@ -10,42 +17,78 @@ def get_mtd_dates():
     end_date = today
     return start_date, end_date
 
+# Function to build the record of one (service, date, amount, currency) row
+def service_record(service, date, amount, currency):
+    return {'Date': date, 'Service': service, 'Amount': amount, 'Currency': currency}
+
+# Function to turn (service, date, amount, currency) rows into report records
+def rows_to_records(rows, labels):
+    return rows.records(service_record)
+
 def get_cost_and_usage(start_date, end_date):
-    client = boto3.client('ce', region_name='us-east-1')
-
-    response = client.get_cost_and_usage(
-        TimePeriod={
-            'Start': start_date.strftime('%Y-%m-%d'),
-            'End': end_date.strftime('%Y-%m-%d')
-        },
-        Granularity='DAILY',
-        Metrics=['BlendedCost'],
-        GroupBy=[
-            {'Type': 'DIMENSION', 'Key': 'SERVICE'}
-        ],
-        Filter={
-            "Not": {
-                'Dimensions': {
-                    'Key': 'RECORD_TYPE',
-                    'Values': ['Credit', 'Refund']
-                }
-            }
-        }
-    )
+    client = get_client('ce', region_name='us-east-1')
+
+    # Earlier days come from the local store; only new and restatable days are fetched
+    rows = fetch_daily(client, get_store(), start_date, end_date, report_metrics('BlendedCost'), 'SERVICE', filter=COST_FILTER)
+
+    return rows_to_records(rows, {})
+
+# Function to fetch the costs by linked account and service with one request
+# and split them into {account ID: records} slices
+def get_account_costs(start_date, end_date):
+    client = get_client('ce', region_name='us-east-1')
+    rows = fetch_daily(client, get_store(), start_date, end_date, report_metrics('BlendedCost'),
+                       ('LINKED_ACCOUNT', 'SERVICE'), filter=COST_FILTER)
+
+    records = rows.records(lambda key, date, amount, currency: service_record(key[1], date, amount, currency))
+    slices = {}
+    for (account_id, service), record in zip(rows.keys, records):
+        slices.setdefault(account_id, []).append(record)
+    return slices
+
+# Function to generate the HTML table of daily costs per service
+def format_data_to_html(data, series='LinkedAccountServicesMTDReport'):
+    # Days far outside their rolling statistics are flagged and the biggest
+    # movers of the latest day listed above the table; days still open to
+    # restatement are scored but not folded into the statistics
+    def observe(matrix):
+        return get_rolling_stats(series, 28, 7).observe(matrix, is_settled) if series else NO_ANOMALIES
+
+    return service_table(data, lambda date: str(datetime.strptime(date, '%Y-%m-%d').day), observe)
+
+# Function to build the email subject and HTML body; series names the
+# rolling statistics the cells are flagged against, None to flag none
+def render_report(cost_data, start_date, end_date, report_context, series='LinkedAccountServicesMTDReport'):
+    # Format data as HTML table with service and date
+    html_table = format_data_to_html(cost_data, series)
 
-    data = []
+    # Get AWS Account ID
+    account_id = report_context.account_id
+    
+    # Get current month and year
+    current_month = start_date.strftime('%B')
+    current_year = start_date.strftime('%Y')
+    
+    # Create email subject with current month, year, and AWS Account ID, including start and end dates
+    subject = f'MTD Cost Report by Service - {account_id}  {current_month} {current_year}'
+    
+    # Create email content
+    body_html = render_document(f'<h4>MTD Cost Report by Account Services - {account_id} <br> {current_month} {current_year}</h4> <h5> Currency: {cost_data[0]["Currency"]}</h5>', html_table)
 
-    for i in response['ResultsByTime']:
-        date = i['TimePeriod']['Start']
+    return subject, body_html
 
-        for j in i['Groups']:
-            service = j['Keys'][0]
-            amount = j['Metrics']['BlendedCost']['Amount']
-            currency = j['Metrics']['BlendedCost']['Unit']
-            data.append({'Date': date, 'Service': service, 'Amount': amount, 'Currency': currency})
+# Function to render one linked account's slice for its owner. Anomalies
+# are flagged in the organization's report only, which keeps hundreds of
+# slices cheap.
+def render_account_report(account_id, cost_data, start_date, end_date, compact=False):
+    report_context = ReportContext(account_id=account_id)
+    return render_email(lambda: render_report(cost_data, start_date, end_date, report_context, None), compact)
 
-    return data
+# Function to return the records exported alongside the email
+def export_records(cost_data, report_context):
+    return iter(cost_data)
 
+@flush_metrics('LinkedAccountServicesMTDReport')
 def lambda_handler(event, context):
     # Retrieve Month-to-Date (MTD) dates
     start_date, end_date = get_mtd_dates()
@@ -53,112 +96,22 @@ def lambda_handler(event, context):
     # Retrieve AWS cost and usage data
     cost_data = get_cost_and_usage(start_date, end_date)
     
-    # Format data as HTML table with service and date
-    html_table = "<table border='1'><tr><th>Service</th>"
-
-    # Extract unique dates
-    dates = sorted(set(item['Date'] for item in cost_data))
-
-    # Initialize column-wise total dictionary
-    column_totals = {date: 0.0 for date in dates}
-
-    for date in dates:
-        # Extract day from the date
-        day = datetime.strptime(date, '%Y-%m-%d').day
-        html_table += f"<th>{day}</th>"
-
-    html_table += "<th><b>Total</b></th></tr>"
-
-    services = sorted(set(item['Service'] for item in cost_data))
-
-    for service in services:
-        service_data = [item for item in cost_data if item['Service'] == service]
-        html_table += f"<tr><td>{service}</td>"
-
-        row_total = 0.0
-
-        for date in dates:
-            cost = next((item['Amount'] for item in service_data if item['Date'] == date), '-')
-            if cost != '-':
-                cost = float(cost)  # Convert the cost to a floating-point number
-                formatted_cost = f"{cost:.2f}"  # Include currency
-                if date == 'Total':
-                    html_table += f"<td style='text-align: center;'><b>{formatted_cost}</b></td>"
-                else:
-                    html_table += f"<td style='text-align: center;'>{formatted_cost}</td>"
-                column_totals[date] += cost
-                row_total += cost
-            else:
-                html_table += f"<td>{cost}</td>"
-
-        formatted_row_total = f"{row_total:.2f}"  # Include currency
-        html_table += f"<td style='text-align: center;'><b>{formatted_row_total}</b></td></tr>"
-
-    html_table += "<tr><td><b>Total</b></td>"
-
-    # Calculate and display column-wise total
-    grand_total = 0.0
-    for date in dates:
-        column_total = column_totals[date]
-        formatted_column_total = f"{column_total:.2f}"  # Include currency
-        html_table += f"<td style='text-align: center;'><b>{formatted_column_total}</b></td>"
-        grand_total += column_total
-
-    formatted_grand_total = f"{grand_total:.2f}"  # Include currency
-    html_table += f"<td style='text-align: center;'><b>{formatted_grand_total}</b></td></tr></table>"
-    
-    # Use the HTML logic from the first code to generate the email body
-    email_body = """
-    <html>
-    <head>
-    <style>
-        table {
-            border-collapse: collapse;
-            width: 100%;
-        }
-        th, td {
-            border: 1px solid black;
-            padding: 8px;
-            text-align: left;
-        }
-        th {
-            background-color: #F2F2F2;
-        }
-    </style>
-    </head>
-    <body>
-    """ + html_table + """
-    </body></html>
-    """
-
-    sts_client = boto3.client('sts')
-    account_id = sts_client.get_caller_identity()['Account']
-    
+    report_context = ReportContext(event)
+
     # Configure SES
-    ses = boto3.client('ses', region_name='us-east-1')
     sender_email = 'ashutosh.deshmukh@whistlemind.com'
     recipient_email = 'ashutosh.deshmukh@whistlemind.com'
-    
-    # Get current month and year
-    current_month = start_date.strftime('%B')
-    current_year = start_date.strftime('%Y')
-    
-    # Create email subject with current month, year, and AWS Account ID, including start and end dates
-    subject = f'MTD Cost Report by Service - {account_id}  {current_month} {current_year}'
-    
-    # Create email content
-    body_html = f'<html><body><h4>MTD Cost Report by Account Services - {account_id} <br> {current_month} {current_year}</h4> <h5> Currency: {service_data[0]["Currency"]}</h5>{email_body}</body></html>'
-    
-    # Send email
-    response = ses.send_email(
-        Source=sender_email,
-        Destination={'ToAddresses': [recipient_email]},
-        Message={
-            'Subject': {'Data': subject},
-            'Body': {'Html': {'Data': body_html}}
-        }
+
+    finish_report(
+        'LinkedAccountServicesMTDReport', lambda: render_report(cost_data, start_date, end_date, report_context),
+        export_records(cost_data, report_context), end_date, sender_email, recipient_email, compact_mode(event)
     )
-    
+
+    # Each linked account's owner gets the report for their account alone
+    if fan_out_mode(event):
+        render = partial(render_account_report, start_date=start_date, end_date=end_date, compact=compact_mode(event))
+        send_account_reports('LinkedAccountServicesMTDReport', get_account_costs(start_date, end_date), render, sender_email)
+
     return {
         'statusCode': 200,
         'body': 'Email sent successfully'
@@ -1,8 +1,13 @@
-import boto3
-from datetime import datetime, timedelta
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import calendar
+from datetime import datetime
+from aws_clients import get_client
+from cost_columns import report_metrics
+from cost_tables import service_table
+from html_render import render_document
+from instrumentation import flush_metrics
+from month_snapshots import fetch_monthly, get_snapshots, is_closed
+from report_email import compact_mode, finish_report
+from report_specs import COST_FILTER, ReportContext
+from rolling_stats import get_rolling_stats
 
 def get_mtd_dates():
     today = datetime.now()
@@ -10,154 +15,85 @@ def get_mtd_dates():
     end_date = today
     return start_date, end_date
 
+# Function to build the record of one (service, date, amount, currency) row
+def service_record(service, date, amount, currency):
+    return {'Date': date, 'Service': service, 'Amount': amount, 'Currency': currency}
+
+# Function to turn (service, date, amount, currency) rows into report records
+def rows_to_records(rows, labels):
+    return rows.records(service_record)
+
 def get_cost_and_usage(start_date, end_date):
-    client = boto3.client('ce', region_name='us-east-1')
-
-    response = client.get_cost_and_usage(
-        TimePeriod={
-            'Start': start_date.strftime('%Y-%m-%d'),
-            'End': end_date.strftime('%Y-%m-%d')
-        },
-        Granularity='MONTHLY',  # Change granularity to MONTHLY
-        Metrics=['BlendedCost'],
-        GroupBy=[
-            {'Type': 'DIMENSION', 'Key': 'SERVICE'}
-        ],
-        Filter={
-            "Not": {
-                'Dimensions': {
-                    'Key': 'RECORD_TYPE',
-                    'Values': ['Credit', 'Refund']
-                }
-            }
-        }
+    client = get_client('ce', region_name='us-east-1')
+
+    # Closed months come from immutable snapshots; only open months are fetched
+    rows, labels = fetch_monthly(
+        client, get_snapshots(), start_date, end_date, report_metrics('BlendedCost'), 'SERVICE', filter=COST_FILTER
+    )
+
+    return rows_to_records(rows, labels)
+
+# Function to generate the HTML table of monthly costs per service
+def format_data_to_html(data):
+    # Months far outside their rolling statistics are flagged and the biggest
+    # movers of the latest month listed above the table; only closed months
+    # are folded into the statistics
+    def observe(matrix):
+        return get_rolling_stats('LinkedAccountServicesYTM', 12, 3).observe(
+            matrix, lambda month: is_closed(datetime.strptime(month, '%Y-%m-%d'))
+        )
+
+    return service_table(
+        data, lambda month: datetime.strptime(month, '%Y-%m-%d').strftime('%b'), observe,
+        lambda month: datetime.strptime(month, '%Y-%m-%d').strftime('%b %Y')
     )
 
-    data = []
+# Function to build the email subject and HTML body
+def render_report(cost_data, start_date, end_date, report_context):
+    # Format data as HTML table with service and date
+    html_table = format_data_to_html(cost_data)
 
-    for i in response['ResultsByTime']:
-        date = i['TimePeriod']['Start']
+    # Get AWS Account ID
+    account_id = report_context.account_id
+    
+    # Get current year
+    current_year = start_date.strftime('%Y')
+    
+    # Create email subject with current year and AWS Account ID, including start and end dates
+    subject = f'YTM Cost Report by Service - {account_id} {current_year}'
+    
+    # Create email content
+    body_html = render_document(f'<h4>YTM Cost Report by Account Services - {account_id} <br> {current_year}</h4> <h5> Currency: {cost_data[0]["Currency"]}</h5>', html_table)
 
-        for j in i['Groups']:
-            service = j['Keys'][0]
-            amount = j['Metrics']['BlendedCost']['Amount']
-            currency = j['Metrics']['BlendedCost']['Unit']
-            data.append({'Date': date, 'Service': service, 'Amount': amount, 'Currency': currency})
+    return subject, body_html
 
-    return data
+# Function to return the records exported alongside the email
+def export_records(cost_data, report_context):
+    return iter(cost_data)
 
+@flush_metrics('LinkedAccountServicesYTM')
 def lambda_handler(event, context):
     # Retrieve Year-to-Date (YTD) dates
     start_date, end_date = get_mtd_dates()
+
+    # Drop the closed-month snapshots when asked to, e.g. after a billing correction
+    if (event or {}).get('invalidate_snapshots'):
+        get_snapshots().invalidate()
     
     # Retrieve AWS cost and usage data
     cost_data = get_cost_and_usage(start_date, end_date)
     
-    # Format data as HTML table with service and date
-    html_table = "<table border='1'><tr><th>Service</th>"
-
-    # Extract unique dates
-    dates = sorted(set(item['Date'] for item in cost_data))
-
-    # Initialize column-wise total dictionary
-    column_totals = {date: 0.0 for date in dates}
-
-    for date in dates:
-        # Extract first three letters of the month name
-        month_name = datetime.strptime(date, '%Y-%m-%d').strftime('%b')
-        html_table += f"<th>{month_name}</th>"
-
-    html_table += "<th><b>Total</b></th></tr>"
-
-    services = sorted(set(item['Service'] for item in cost_data))
-
-    for service in services:
-        service_data = [item for item in cost_data if item['Service'] == service]
-        html_table += f"<tr><td>{service}</td>"
-
-        row_total = 0.0
-
-        for date in dates:
-            cost = next((item['Amount'] for item in service_data if item['Date'] == date), '-')
-            if cost != '-':
-                cost = float(cost)  # Convert the cost to a floating-point number
-                formatted_cost = f"{cost:.2f}"  # Include currency
-                if date == 'Total':
-                    html_table += f"<td style='text-align: center;'><b>{formatted_cost}</b></td>"
-                else:
-                    html_table += f"<td style='text-align: center;'>{formatted_cost}</td>"
-                column_totals[date] += cost
-                row_total += cost
-            else:
-                html_table += f"<td>{cost}</td>"
-
-        formatted_row_total = f"{row_total:.2f}"  # Include currency
-        html_table += f"<td style='text-align: center;'><b>{formatted_row_total}</b></td></tr>"
-
-    html_table += "<tr><td><b>Total</b></td>"
-
-    # Calculate and display column-wise total
-    grand_total = 0.0
-    for date in dates:
-        column_total = column_totals[date]
-        formatted_column_total = f"{column_total:.2f}"  # Include currency
-        html_table += f"<td style='text-align: center;'><b>{formatted_column_total}</b></td>"
-        grand_total += column_total
-
-    formatted_grand_total = f"{grand_total:.2f}"  # Include currency
-    html_table += f"<td style='text-align: center;'><b>{formatted_grand_total}</b></td></tr></table>"
-    
-    # Use the HTML logic from the first code to generate the email body
-    email_body = """
-    <html>
-    <head>
-    <style>
-        table {
-            border-collapse: collapse;
-            width: 100%;
-        }
-        th, td {
-            border: 1px solid black;
-            padding: 8px;
-            text-align: left;
-        }
-        th {
-            background-color: #F2F2F2;
-        }
-    </style>
-    </head>
-    <body>
-    """ + html_table + """
-    </body></html>
-    """
-
-    sts_client = boto3.client('sts')
-    account_id = sts_client.get_caller_identity()['Account']
-    
+    report_context = ReportContext(event)
+
     # Configure SES
-    ses = boto3.client('ses', region_name='us-east-1')
     sender_email = 'ashutosh.deshmukh@whistlemind.com'
     recipient_email = 'ashutosh.deshmukh@whistlemind.com'
-    
-    # Get current year
-    current_year = start_date.strftime('%Y')
-    
-    # Create email subject with current year and AWS Account ID, including start and end dates
-    subject = f'YTM Cost Report by Service - {account_id} {current_year}'
-    
-    # Create email content
-    body_html = f'<html><body><h4>YTM Cost Report by Account Services - {account_id} <br> {current_year}</h4> <h5> Currency: {cost_data[0]["Currency"]}</h5>{email_body}</body></html>'
-    
-    # Send email
-    response = ses.send_email(
-        Source=sender_email,
-        Destination={'ToAddresses': [recipient_email]},
-        Message={
-            'Subject': {'Data': subject},
-            'Body': {'Html': {'Data': body_html}}
-        }
+
+    finish_report(
+        'LinkedAccountServicesYTM', lambda: render_report(cost_data, start_date, end_date, report_context),
+        export_records(cost_data, report_context), end_date, sender_email, recipient_email, compact_mode(event)
     )
-    
+
     return {
         'statusCode': 200,
         'body': 'Email sent successfully'
@@ -0,0 +1,66 @@
+import threading
+from aws_clients import get_client
+from dimension_catalog import CATALOG
+from pagination import iter_accounts
+
+# Account names from Organizations, loaded once on first miss and kept in
+# module scope so warm invocations do not list the organization again.
+class OrganizationAccountNames:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}
+        self._loaded = False
+
+    def get(self, account_id):
+        if not self._loaded:
+            self._load()
+        return self._names.get(account_id)
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                org_client = get_client('organizations')
+                for account in iter_accounts(org_client):
+                    self._names[account['Id']] = account.get('Name')
+            except Exception as e:
+                print(f"Could not load account names from Organizations: {str(e)}")
+            self._loaded = True
+
+ORGANIZATION_NAMES = OrganizationAccountNames()
+
+# Account names from the LINKED_ACCOUNT values of the dimension catalog,
+# which are cached across runs, then from Organizations for accounts the
+# catalog does not describe.
+class CatalogAccountNames:
+    def __init__(self, catalog=CATALOG, fallback=ORGANIZATION_NAMES):
+        self.catalog = catalog
+        self.fallback = fallback
+
+    def get(self, account_id):
+        name = self.catalog.describe('LINKED_ACCOUNT', account_id)
+        if not name and self.fallback:
+            name = self.fallback.get(account_id)
+        return name
+
+ACCOUNT_NAMES = CatalogAccountNames()
+
+# Maps account IDs to names from the labels the cost store and the month
+# snapshots keep of Cost Explorer's DimensionValueAttributes. Accounts
+# missing from them fall back to the catalog and Organizations names.
+class AccountNameIndex:
+    def __init__(self, fallback=ACCOUNT_NAMES, default='N/A'):
+        self.fallback = fallback
+        self.default = default
+        self._names = {}
+
+    def update_names(self, names):
+        self._names.update((k, v) for k, v in names.items() if v)
+
+    def resolve(self, account_id):
+        name = self._names.get(account_id)
+        if name is None:
+            name = (self.fallback.get(account_id) if self.fallback else None) or self.default
+            self._names[account_id] = name
+        return name
@@ -0,0 +1,70 @@
+import os
+import threading
+from collections import OrderedDict
+from instrumentation import instrument
+from rate_limiter import rate_limited
+
+# Connections per client; the discovery fan-out shares one STS client across its workers
+MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '32'))
+
+# Clients kept for assumed roles, least recently used dropped first
+MAX_CACHED_CLIENTS = int(os.environ.get('CLIENT_CACHE_SIZE', '256'))
+
+_CLIENTS = OrderedDict()
+_LOCK = threading.Lock()
+
+# Function to return a shared instrumented, rate-limited client.
+# Clients live in module scope, so warm invocations reuse them together with
+# their resolved endpoints and connection pools. Clients for an assumed role
+# pass its credentials and the account as scope; such a client is rebuilt
+# when the credentials are refreshed. endpoint_url points a client at an
+# API-compatible stand-in, such as a local S3 store. read_timeout, in
+# seconds, is for calls that wait on long work, such as invoking a Lambda;
+# such calls are not retried when they time out, since the work may have run.
+def get_client(service_name, region_name=None, credentials=None, scope=None, endpoint_url=None, read_timeout=None):
+    key = (service_name, region_name, scope, endpoint_url, read_timeout)
+    access_key = credentials['AccessKeyId'] if credentials else None
+    with _LOCK:
+        cached = _CLIENTS.get(key)
+        if cached is not None and cached[0] == access_key:
+            _CLIENTS.move_to_end(key)
+            return cached[1]
+
+        # Client creation on the default session is not thread-safe, so it stays under the lock
+        client = rate_limited(instrument(_create_client(service_name, region_name, credentials, endpoint_url, read_timeout)),
+                              scope=scope, retry_transient=not read_timeout)
+        _CLIENTS[key] = (access_key, client)
+        if len(_CLIENTS) > MAX_CACHED_CLIENTS:
+            _CLIENTS.popitem(last=False)
+        return client
+
+def _create_client(service_name, region_name, credentials, endpoint_url=None, read_timeout=None):
+    # boto3 takes a large share of cold start, so it is imported on first use
+    import boto3
+    from botocore.config import Config
+
+    # Every client is wrapped by rate_limited, which retries throttled and
+    # transient failures itself. botocore's own retries are turned off, so
+    # throttling reaches the adaptive limiter on the first attempt and one
+    # call never makes more than MAX_ATTEMPTS requests.
+    config = {'max_pool_connections': MAX_POOL_CONNECTIONS, 'retries': {'total_max_attempts': 1}}
+    if read_timeout:
+        config['read_timeout'] = read_timeout
+    kwargs = {'config': Config(**config)}
+    if region_name:
+        kwargs['region_name'] = region_name
+    if endpoint_url:
+        kwargs['endpoint_url'] = endpoint_url
+    if credentials:
+        # Assumed-role clients share the default session and its loaded service models
+        kwargs.update(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+        )
+    return boto3.client(service_name, **kwargs)
+
+# Function to drop every cached client
+def clear_clients():
+    with _LOCK:
+        _CLIENTS.clear()
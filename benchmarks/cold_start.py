@@ -0,0 +1,121 @@
+# Measures the cold-start cost of each handler: the time to import it in a
+# fresh interpreter, the modules that dominate that import, and the time to
+# create the clients it needs on first use (init) versus on a warm call.
+#
+#   python -m benchmarks.cold_start
+#   python -m benchmarks.cold_start --max-import-ms 800 --output cold_start.json
+#
+# With --max-import-ms the exit status is 1 when any handler imports slower
+# than the budget, so CI can track cold-start regressions.
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+from benchmarks.run_benchmarks import HANDLERS, REPO_ROOT
+
+# Clients a cold invocation creates before its first API call
+CLIENTS = (
+    ('ce', 'us-east-1'),
+    ('ses', 'us-east-1'),
+    ('sts', None),
+    ('organizations', None),
+)
+
+# Function to import a handler and create its clients twice, timing each step
+def measure(handler):
+    start = time.perf_counter()
+    importlib.import_module(handler)
+    import_ms = (time.perf_counter() - start) * 1000
+
+    from aws_clients import get_client
+    start = time.perf_counter()
+    for service_name, region_name in CLIENTS:
+        get_client(service_name, region_name)
+    init_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for service_name, region_name in CLIENTS:
+        get_client(service_name, region_name)
+    warm_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        'import_ms': round(import_ms, 2),
+        'client_init_ms': round(init_ms, 2),
+        'client_warm_ms': round(warm_ms, 3),
+        'loaded_modules': len(sys.modules),
+    }
+
+# Function to list the modules with the largest cumulative import time, from -X importtime output
+def slowest_imports(handler, limit):
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import importlib; importlib.import_module({handler!r})'],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Only top-level imports, so nested modules are not counted twice
+        if name.startswith('  ') or not name.strip():
+            continue
+        imports.append({'module': name.strip(), 'cumulative_ms': round(int(cumulative_us) / 1000, 2)})
+    imports.sort(key=lambda entry: entry['cumulative_ms'], reverse=True)
+    return imports[:limit]
+
+# Function to measure one handler in a fresh interpreter
+def run_isolated(handler):
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.cold_start', '--worker', handler],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit {completed.returncode}'}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure handler import and client init time')
+    parser.add_argument('--handlers', nargs='+', choices=HANDLERS + ('AllReports',), default=list(HANDLERS))
+    parser.add_argument('--top', type=int, default=8, help='slowest top-level imports to list per handler')
+    parser.add_argument('--max-import-ms', type=float, help='fail when a handler imports slower than this')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(measure(args.worker)))
+        return 0
+
+    results = []
+    for handler in args.handlers:
+        result = dict(handler=handler, **run_isolated(handler))
+        result['slowest_imports'] = slowest_imports(handler, args.top)
+        results.append(result)
+
+    print(f"{'handler':<32} {'import ms':>10} {'init ms':>9} {'warm ms':>9} {'modules':>8}")
+    over_budget = []
+    for result in results:
+        if 'error' in result:
+            print(f"{result['handler']:<32} error: {result['error']}")
+            over_budget.append(result['handler'])
+            continue
+        print(f"{result['handler']:<32} {result['import_ms']:>10.1f} {result['client_init_ms']:>9.1f} "
+              f"{result['client_warm_ms']:>9.3f} {result['loaded_modules']:>8}")
+        if args.max_import_ms is not None and result['import_ms'] > args.max_import_ms:
+            over_budget.append(result['handler'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'max_import_ms': args.max_import_ms}, f, indent=2)
+
+    if over_budget:
+        print(f"Over the cold-start budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,398 @@
+# In-process stand-in for the AWS APIs the reports call, backed by a
+# synthetic organization. Responses are generated on demand page by page, so
+# a 5,000 account organization costs no more memory than the pages read.
+import contextlib
+import io
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+# Sizes of the synthetic organizations
+SCALES = {
+    'small': {'accounts': 10, 'distributions': 100, 'services': 40},
+    'medium': {'accounts': 500, 'distributions': 2000, 'services': 200},
+    'large': {'accounts': 5000, 'distributions': 20000, 'services': 400},
+}
+
+USAGE_TYPE_PREFIXES = ['', 'AP-', 'APS3-', 'AU-', 'CA-', 'EU-', 'IN-', 'JP-', 'ME-', 'SA-', 'US-', 'USE2-', 'ZA-']
+
+# Other cost metrics differ from BlendedCost by a fixed factor
+COST_METRIC_FACTORS = {'UnblendedCost': 1.02, 'AmortizedCost': 0.97, 'NetUnblendedCost': 0.95}
+
+# Function to build a ClientError the way botocore raises it
+def client_error(operation, code, message):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+# Function to list the (start, end) periods of a Cost Explorer time period
+def iter_periods(time_period, granularity):
+    day = datetime.strptime(time_period['Start'], '%Y-%m-%d').date()
+    end = datetime.strptime(time_period['End'], '%Y-%m-%d').date()
+    while day < end:
+        if granularity == 'MONTHLY':
+            following = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+        else:
+            following = day + timedelta(days=1)
+        yield day, min(following, end)
+        day = following
+
+# A synthetic organization and the record of every call made against it.
+# Distribution n belongs to account n % accounts; every missing_role_every-th
+# account does not grant the cross-account role and every suspended_every-th
+# account is suspended. With throttle_every set, every throttle_every-th call
+# to a service fails with ThrottlingException; latency adds a fixed delay to
+# every call to stand in for the network.
+class SyntheticOrg:
+    def __init__(self, accounts, distributions, services, missing_role_every=10, suspended_every=50,
+                 groups_per_page=5000, page_size=20, distributions_per_page=100, throttle_every=0, latency=0.0):
+        self.account_ids = [f'{100000000000 + n:012d}' for n in range(accounts)]
+        self.account_index = {account_id: n for n, account_id in enumerate(self.account_ids)}
+        self.distributions = distributions
+        self.services = [f'Synthetic Service {n:03d}' for n in range(services)]
+        self.usage_types = [f'{prefix}DataTransfer-Out-{kind}' for prefix in USAGE_TYPE_PREFIXES for kind in ('Bytes', 'OBytes')]
+        self.missing_role_every = missing_role_every
+        self.suspended_every = suspended_every
+        self.groups_per_page = groups_per_page
+        self.page_size = page_size
+        self.distributions_per_page = distributions_per_page
+        self.throttle_every = throttle_every
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.reset()
+
+    # Function to forget the calls and emails recorded so far
+    def reset(self):
+        with self._lock:
+            self.calls = Counter()
+            self.throttled = Counter()
+            self.emails = []
+            self.recipients = Counter()
+            self.objects = {}
+            self.bodies = {}
+            self._uploads = {}
+            self._attempts = Counter()
+
+    def record_call(self, service, operation):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._attempts[service] += 1
+            if self.throttle_every and self._attempts[service] % self.throttle_every == 0:
+                self.throttled[f'{service}.{operation}'] += 1
+                raise client_error(operation, 'ThrottlingException', 'Rate exceeded')
+            self.calls[f'{service}.{operation}'] += 1
+
+    def record_email(self, size, recipients=()):
+        with self._lock:
+            self.emails.append(size)
+            self.recipients.update(recipients)
+
+    def record_object(self, bucket, key, size):
+        with self._lock:
+            self.objects[f'{bucket}/{key}'] = size
+
+    def dimension_values(self, dimension):
+        if dimension == 'LINKED_ACCOUNT':
+            return self.account_ids
+        if dimension == 'SERVICE':
+            return self.services
+        return self.usage_types
+
+    def has_role(self, account_id):
+        return self.account_index[account_id] % self.missing_role_every != self.missing_role_every - 1
+
+    def is_active(self, n):
+        return n % self.suspended_every != self.suspended_every - 1
+
+    def client(self, service_name, account_id=None, **kwargs):
+        account_id = account_id or self.account_ids[0]
+        return CLIENTS.get(service_name, FakeClient)(self, service_name, account_id)
+
+    # Context manager that routes boto3 clients and sessions to this organization
+    @contextlib.contextmanager
+    def patched(self):
+        # boto3 is imported here so importing this module stays cheap for cold-start measurements
+        import boto3
+        org = self
+
+        # Assumed-role credentials carry the account ID in the access key
+        def account_of(aws_access_key_id):
+            return aws_access_key_id[len('ASIA'):] if aws_access_key_id else None
+
+        def fake_client(service_name, aws_access_key_id=None, **kwargs):
+            return org.client(service_name, account_id=account_of(aws_access_key_id))
+
+        class FakeSession:
+            def __init__(self, aws_access_key_id=None, **kwargs):
+                self.account_id = account_of(aws_access_key_id)
+
+            def client(self, service_name, **kwargs):
+                return org.client(service_name, account_id=self.account_id)
+
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(mock.patch.object(boto3, 'client', fake_client))
+            stack.enter_context(mock.patch.object(boto3.session, 'Session', FakeSession))
+            stack.enter_context(mock.patch.object(boto3, 'Session', FakeSession))
+            yield self
+
+class FakeClient:
+    def __init__(self, org, service_name, account_id):
+        self.org = org
+        self.service_name = service_name
+        self.account_id = account_id
+
+    def _call(self, operation):
+        self.org.record_call(self.service_name, operation)
+
+class FakeOrganizations(FakeClient):
+    def list_accounts(self, NextToken=None, MaxResults=None):
+        self._call('ListAccounts')
+        start = int(NextToken or 0)
+        end = min(start + (MaxResults or self.org.page_size), len(self.org.account_ids))
+        response = {'Accounts': [
+            {
+                'Id': self.org.account_ids[n],
+                'Name': f'synthetic-account-{n}',
+                'Email': f'owner-{n}@example.com',
+                'Status': 'ACTIVE' if self.org.is_active(n) else 'SUSPENDED',
+            }
+            for n in range(start, end)
+        ]}
+        if end < len(self.org.account_ids):
+            response['NextToken'] = str(end)
+        return response
+
+class FakeSTS(FakeClient):
+    def get_caller_identity(self):
+        self._call('GetCallerIdentity')
+        return {'Account': self.account_id, 'Arn': f'arn:aws:iam::{self.account_id}:user/benchmark'}
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self._call('AssumeRole')
+        account_id = RoleArn.split(':')[4]
+        if account_id not in self.org.account_index or not self.org.has_role(account_id):
+            raise client_error('AssumeRole', 'AccessDenied', f'Not authorized to assume {RoleArn}')
+        return {'Credentials': {
+            'AccessKeyId': f'ASIA{account_id}',
+            'SecretAccessKey': 'synthetic',
+            'SessionToken': 'synthetic',
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+        }}
+
+class FakeCloudFront(FakeClient):
+    def list_distributions(self, Marker=None, MaxItems=None):
+        self._call('ListDistributions')
+        accounts = len(self.org.account_ids)
+        owned = range(self.org.account_index[self.account_id], self.org.distributions, accounts)
+        start = int(Marker or 0)
+        end = min(start + int(MaxItems or self.org.distributions_per_page), len(owned))
+        distribution_list = {
+            'Marker': Marker or '',
+            'Quantity': end - start,
+            'IsTruncated': end < len(owned),
+            'Items': [
+                {
+                    'Id': f'E{n:013X}',
+                    'DomainName': f'd{n:07d}.cloudfront.net',
+                    'Aliases': {'Quantity': 1, 'Items': [f'cdn{n}.example.com']},
+                }
+                for n in owned[start:end]
+            ],
+        }
+        if end < len(owned):
+            distribution_list['NextMarker'] = str(end)
+        return {'DistributionList': distribution_list}
+
+class FakeCostExplorer(FakeClient):
+    def get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy=None, Filter=None, NextPageToken=None):
+        self._call('GetCostAndUsage')
+        periods = list(iter_periods(TimePeriod, Granularity))
+        dimensions = [group['Key'] for group in GroupBy or []]
+        values = [self.org.dimension_values(dimension) for dimension in dimensions]
+        combinations = 1
+        for dimension_values in values:
+            combinations *= len(dimension_values)
+
+        # Groups are numbered period by period, combinations in row-major order
+        total = len(periods) * combinations
+        start = int(NextPageToken or 0)
+        end = min(start + self.org.groups_per_page, total)
+
+        results = []
+        described = set()
+        for n in range(start, end):
+            period, combination = divmod(n, combinations)
+            if not results or results[-1]['index'] != period:
+                period_start, period_end = periods[period]
+                results.append({
+                    'index': period,
+                    'TimePeriod': {'Start': period_start.isoformat(), 'End': period_end.isoformat()},
+                    'Total': {},
+                    'Groups': [],
+                    'Estimated': False,
+                })
+            keys = []
+            for dimension_values in reversed(values):
+                combination, i = divmod(combination, len(dimension_values))
+                keys.append(dimension_values[i])
+            keys.reverse()
+            if 'LINKED_ACCOUNT' in dimensions:
+                described.add(keys[dimensions.index('LINKED_ACCOUNT')])
+
+            results[-1]['Groups'].append({
+                'Keys': keys,
+                'Metrics': {metric: self._amount(metric, n) for metric in Metrics},
+            })
+
+        for result in results:
+            del result['index']
+        response = {
+            'GroupDefinitions': [{'Type': 'DIMENSION', 'Key': dimension} for dimension in dimensions],
+            'ResultsByTime': results,
+            'DimensionValueAttributes': [
+                {'Value': account_id, 'Attributes': {'description': f'synthetic-account-{self.org.account_index[account_id]}'}}
+                for account_id in sorted(described)
+            ],
+        }
+        if end < total:
+            response['NextPageToken'] = str(end)
+        return response
+
+    def _amount(self, metric, n):
+        amount = ((n * 2654435761) % 1000003) / 100.0 * COST_METRIC_FACTORS.get(metric, 1.0)
+        if metric == 'UsageQuantity':
+            return {'Amount': str(amount), 'Unit': 'GB'}
+        return {'Amount': str(amount), 'Unit': 'USD'}
+
+    def _attributes(self, dimension, value):
+        if dimension == 'LINKED_ACCOUNT':
+            return {'description': f'synthetic-account-{self.org.account_index[value]}'}
+        return {}
+
+    def get_dimension_values(self, TimePeriod, Dimension, NextPageToken=None, **kwargs):
+        self._call('GetDimensionValues')
+        values = self.org.dimension_values(Dimension)
+        start = int(NextPageToken or 0)
+        end = min(start + self.org.groups_per_page, len(values))
+        response = {
+            'DimensionValues': [{'Value': value, 'Attributes': self._attributes(Dimension, value)} for value in values[start:end]],
+            'ReturnSize': end - start,
+            'TotalSize': len(values),
+        }
+        if end < len(values):
+            response['NextPageToken'] = str(end)
+        return response
+
+class FakeSES(FakeClient):
+    def send_email(self, Source, Destination, Message, **kwargs):
+        self._call('SendEmail')
+        body = Message.get('Body', {})
+        size = sum(len(part.get('Data', '').encode('utf-8')) for part in body.values())
+        self.org.record_email(size, Destination.get('ToAddresses', []))
+        return {'MessageId': f'synthetic-{len(self.org.emails)}'}
+
+    def send_raw_email(self, RawMessage, Destinations=(), **kwargs):
+        self._call('SendRawEmail')
+        data = RawMessage['Data']
+        self.org.record_email(len(data.encode('utf-8') if isinstance(data, str) else data), Destinations)
+        return {'MessageId': f'synthetic-{len(self.org.emails)}'}
+
+# Daily BytesDownloaded sums per distribution. A distribution has data only
+# in the account that owns it, or through AccountId from a monitoring
+# account, and every seventh day of a distribution has no traffic.
+class FakeCloudWatch(FakeClient):
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy='TimestampDescending', NextToken=None, **kwargs):
+        self._call('GetMetricData')
+        if len(MetricDataQueries) > 500:
+            raise client_error('GetMetricData', 'ValidationError', 'The collection MetricDataQueries must not have a size greater than 500.')
+
+        start = StartTime.replace(tzinfo=timezone.utc) if StartTime.tzinfo is None else StartTime
+        end = EndTime.replace(tzinfo=timezone.utc) if EndTime.tzinfo is None else EndTime
+        results = []
+        datapoints = 0
+        for query in MetricDataQueries:
+            stat = query['MetricStat']
+            dimensions = {dimension['Name']: dimension['Value'] for dimension in stat['Metric']['Dimensions']}
+            n = int(dimensions['DistributionId'][1:], 16)
+            owner = self.org.account_ids[n % len(self.org.account_ids)] if n < self.org.distributions else None
+            timestamps, values = [], []
+            if owner == query.get('AccountId', self.account_id) and dimensions.get('Region') == 'Global':
+                moment = start
+                while moment < end:
+                    day = moment.toordinal()
+                    if (n + day) % 7:
+                        timestamps.append(moment)
+                        values.append(float((n * 2654435761 + day * 40503 + moment.hour * 7919) % 1000003) * 1024)
+                    moment += timedelta(seconds=stat['Period'])
+            if ScanBy == 'TimestampDescending':
+                timestamps.reverse()
+                values.reverse()
+            datapoints += len(values)
+            results.append({'Id': query['Id'], 'Label': stat['Metric']['MetricName'], 'Timestamps': timestamps,
+                            'Values': values, 'StatusCode': 'Complete'})
+
+        if datapoints > 100800:
+            raise client_error('GetMetricData', 'ValidationError', 'Too many datapoints requested.')
+        return {'MetricDataResults': results, 'Messages': []}
+
+# Multipart uploads keep only the part sizes, so large exports cost no memory;
+# single-part objects, such as shard results, are kept whole so they can be read back
+class FakeS3(FakeClient):
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('PutObject')
+        self.org.record_object(Bucket, Key, len(Body))
+        with self.org._lock:
+            self.org.bodies[f'{Bucket}/{Key}'] = Body
+        return {'ETag': f'"{Key}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('GetObject')
+        body = self.org.bodies.get(f'{Bucket}/{Key}')
+        if body is None:
+            raise client_error('GetObject', 'NoSuchKey', 'The specified key does not exist.')
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        with self.org._lock:
+            self.org.objects.pop(f'{Bucket}/{Key}', None)
+            self.org.bodies.pop(f'{Bucket}/{Key}', None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        with self.org._lock:
+            upload_id = f'upload-{len(self.org._uploads)}'
+            self.org._uploads[upload_id] = {}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('UploadPart')
+        self.org._uploads[UploadId][PartNumber] = len(Body)
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call('CompleteMultipartUpload')
+        parts = self.org._uploads.pop(UploadId)
+        numbers = [part['PartNumber'] for part in MultipartUpload['Parts']]
+        if any(parts[number] < 5 * 1024 * 1024 for number in numbers[:-1]):
+            raise client_error('CompleteMultipartUpload', 'EntityTooSmall', 'Your proposed upload is smaller than the minimum allowed size')
+        self.org.record_object(Bucket, Key, sum(parts[number] for number in numbers))
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('AbortMultipartUpload')
+        self.org._uploads.pop(UploadId, None)
+        return {}
+
+CLIENTS = {
+    'organizations': FakeOrganizations,
+    'sts': FakeSTS,
+    'cloudfront': FakeCloudFront,
+    'cloudwatch': FakeCloudWatch,
+    'ce': FakeCostExplorer,
+    'ses': FakeSES,
+    's3': FakeS3,
+}
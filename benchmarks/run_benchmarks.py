@@ -0,0 +1,189 @@
+# Runs the report handlers end to end against a synthetic organization and
+# records wall time, peak memory, API call counts and email size as JSON.
+# With EXPORT_FORMAT and EXPORT_S3_BUCKET set, exports go to a fake S3 and
+# their size is recorded too.
+#
+#   python -m benchmarks.run_benchmarks --scales small medium
+#   python -m benchmarks.run_benchmarks --accounts 200 --distributions 5000 --services 400
+#   python -m benchmarks.run_benchmarks --compare benchmarks/results/<earlier run>.json
+#   python -m benchmarks.run_benchmarks --fan-out --handlers LinkedAccountServicesMTDReport CDN-MTDReport
+#
+# Each (scale, handler) pair runs in its own Python process with its own
+# cost store, month snapshot, STS spill and export locations, so runs never share
+# caches and the first repetition is always a cold start.
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from benchmarks.fake_aws import SCALES, SyntheticOrg
+
+HANDLERS = (
+    'LinkedAccountMTDReport',
+    'LinkedAccountYTMReport',
+    'LinkedAccountServicesMTDReport',
+    'LinkedAccountServicesYTM',
+    'CDN-MTDReport',
+    'CDN-YTMReport',
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+# Function to run one handler repeatedly in this process and return one measurement per run
+def measure(handler, org_size, repeat):
+    org = SyntheticOrg(**org_size)
+    with org.patched():
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            module = importlib.import_module(handler)
+        import_seconds = time.perf_counter() - start
+
+        runs = []
+        for _ in range(repeat):
+            org.reset()
+            tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                module.lambda_handler({}, None)
+            wall_seconds = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            runs.append({
+                'wall_seconds': round(wall_seconds, 4),
+                'peak_memory_bytes': peak_memory,
+                'api_calls': dict(sorted(org.calls.items())),
+                'total_api_calls': sum(org.calls.values()),
+                'throttled_calls': dict(sorted(org.throttled.items())),
+                'emails': len(org.emails),
+                'recipients': len(org.recipients),
+                'html_bytes': sum(org.emails),
+                'exported_bytes': sum(org.objects.values()),
+            })
+    return {'import_seconds': round(import_seconds, 4), 'runs': runs}
+
+# Function to run one handler in a fresh interpreter with private cache locations
+def run_isolated(handler, org_size, repeat, fan_out=False):
+    with tempfile.TemporaryDirectory(prefix='billing-benchmark-') as scratch:
+        env = dict(
+            os.environ,
+            COST_STORE_PATH=os.path.join(scratch, 'cost_store.sqlite3'),
+            MONTH_SNAPSHOT_DIR=os.path.join(scratch, 'month_snapshots'),
+            STS_CACHE_SPILL_PATH=os.path.join(scratch, 'sts_credentials.cache'),
+            EXPORT_DIR=os.path.join(scratch, 'exports'),
+            DIMENSION_CATALOG_PATH=os.path.join(scratch, 'dimension_catalog.json'),
+            ROLLING_STATS_DIR=os.path.join(scratch, 'rolling_stats'),
+            REPORT_FAN_OUT='1' if fan_out else '',
+        )
+        command = [
+            sys.executable, '-m', 'benchmarks.run_benchmarks',
+            '--worker', handler, '--org', json.dumps(org_size), '--repeat', str(repeat),
+        ]
+        completed = subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f'exit {completed.returncode}'}
+    return json.loads(completed.stdout)
+
+# Function to look up the commit being measured, if the tree is a git checkout
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Function to print the first run of every result, with the change against a baseline if given
+def print_summary(results, baseline=None):
+    previous = {}
+    for result in (baseline or {}).get('results', []):
+        if result.get('runs'):
+            previous[(result['scale'], result['handler'])] = result['runs'][0]
+
+    print(f"{'scale':<8} {'handler':<32} {'wall s':>9} {'peak MB':>9} {'calls':>7} {'html KB':>9}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['scale']:<8} {result['handler']:<32} error: {result['error']}")
+            continue
+        run = result['runs'][0]
+        line = (f"{result['scale']:<8} {result['handler']:<32} {run['wall_seconds']:>9.3f} "
+                f"{run['peak_memory_bytes'] / 1048576:>9.1f} {run['total_api_calls']:>7} {run['html_bytes'] / 1024:>9.1f}")
+        before = previous.get((result['scale'], result['handler']))
+        if before and before['wall_seconds']:
+            line += f"  ({run['wall_seconds'] / before['wall_seconds']:.2f}x time, {run['total_api_calls'] - before['total_api_calls']:+d} calls)"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the report handlers against a synthetic AWS organization')
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=['small'])
+    parser.add_argument('--accounts', type=int, help='run a custom scale instead of the presets')
+    parser.add_argument('--distributions', type=int)
+    parser.add_argument('--services', type=int)
+    parser.add_argument('--throttle-every', type=int, default=0, help='throttle every Nth call to each service')
+    parser.add_argument('--latency-ms', type=float, default=0, help='simulated latency of every API call')
+    parser.add_argument('--handlers', nargs='+', choices=HANDLERS + ('AllReports',), default=list(HANDLERS))
+    parser.add_argument('--repeat', type=int, default=2, help='runs per handler; the first is a cold start')
+    parser.add_argument('--fan-out', action='store_true', help='also send every account owner their own report')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--org', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(measure(args.worker, json.loads(args.org), args.repeat)))
+        return
+
+    if args.accounts:
+        scales = {'custom': {
+            'accounts': args.accounts,
+            'distributions': args.distributions or args.accounts * 4,
+            'services': args.services or SCALES['small']['services'],
+        }}
+    else:
+        scales = {name: dict(SCALES[name]) for name in args.scales}
+    for org_size in scales.values():
+        if args.throttle_every:
+            org_size['throttle_every'] = args.throttle_every
+        if args.latency_ms:
+            org_size['latency'] = args.latency_ms / 1000
+
+    results = []
+    for scale, org_size in scales.items():
+        for handler in args.handlers:
+            print(f"Running {handler} at {scale} scale...", file=sys.stderr)
+            results.append(dict(scale=scale, handler=handler, **run_isolated(handler, org_size, args.repeat, args.fan_out)))
+
+    started = datetime.utcnow()
+    report = {
+        'created': started.isoformat(timespec='seconds') + 'Z',
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'scales': scales,
+        'repeat': args.repeat,
+        'fan_out': args.fan_out,
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{started.strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(results, baseline)
+    print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import json
+
+# Keys whose list values are unordered sets as far as Cost Explorer is concerned
+UNORDERED_KEYS = ('Values', 'Metrics', 'And', 'Or', 'MatchOptions')
+
+# Function to normalize request parameters so equivalent queries serialize identically
+def _canonicalize(value, parent_key=None):
+    if isinstance(value, dict):
+        return {k: _canonicalize(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_canonicalize(v) for v in value]
+        if parent_key in UNORDERED_KEYS:
+            items.sort(key=lambda v: json.dumps(v, sort_keys=True, default=str))
+        return items
+    return value
+
+# Function to build a canonical key for a Cost Explorer request
+def canonical_request_key(operation, params):
+    body = json.dumps(_canonicalize(params), sort_keys=True, separators=(',', ':'), default=str)
+    return f"{operation}:{body}"
+
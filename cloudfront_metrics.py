@@ -0,0 +1,359 @@
+import heapq
+import os
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from aws_clients import get_client
+from cost_matrix import CostMatrix
+from cross_account import DEFAULT_MAX_WORKERS, fan_out, role_arn
+from month_snapshots import iter_months
+from pagination import iter_metric_data_results
+from sts_credentials import assumed_client
+
+# CloudFront publishes its metrics to us-east-1 with the dimension Region=Global
+METRICS_REGION = 'us-east-1'
+NAMESPACE = 'AWS/CloudFront'
+METRIC_NAME = 'BytesDownloaded'
+PERIOD_SECONDS = 86400
+HOURLY_PERIOD_SECONDS = 3600
+
+# CloudWatch keeps one-hour data points for 455 days (15 months); older
+# periods only have daily sums left
+MAX_HOURLY_DAYS = 455
+
+# Busiest hours kept per distribution in hourly mode
+PEAK_HOURS = int(os.environ.get('CDN_PEAK_HOURS', '3'))
+
+# GetMetricData limits per call: metric queries, and data points over all queries
+MAX_QUERIES = 500
+MAX_DATAPOINTS = 100800
+
+# In a CloudWatch cross-account monitoring account one client reads the
+# metrics of every source account, so a batch can span accounts. Otherwise
+# each account's metrics are read through its cross-account role.
+MONITORING_ACCOUNT = os.environ.get('CLOUDWATCH_MONITORING_ACCOUNT', '').lower() in ('1', 'true', 'yes')
+
+# Function to return the midnight that starts a day
+def day_start(moment):
+    return datetime(moment.year, moment.month, moment.day)
+
+# Function to build the query for one distribution's BytesDownloaded per period
+def metric_query(query_id, distribution_id, account_id=None, period=PERIOD_SECONDS):
+    query = {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': NAMESPACE,
+                'MetricName': METRIC_NAME,
+                'Dimensions': [
+                    {'Name': 'DistributionId', 'Value': distribution_id},
+                    {'Name': 'Region', 'Value': 'Global'},
+                ],
+            },
+            'Period': period,
+            'Stat': 'Sum',
+        },
+        'ReturnData': True,
+    }
+    if account_id:
+        query['AccountId'] = account_id
+    return query
+
+# Function to return how many distributions fit one call for a number of data points each
+def batch_size(periods):
+    return max(1, min(MAX_QUERIES, MAX_DATAPOINTS // max(1, periods)))
+
+# BytesDownloaded per distribution and period, as one float array with a row
+# per distribution and a column per period start. Iterating yields the
+# (distribution ID, 'YYYY-MM-DD', bytes, 'Bytes') rows of the periods with
+# traffic in date order, so code written for plain rows keeps working, and
+# the reports lay the array out as their CostMatrix directly.
+class UsageRows:
+    def __init__(self, distribution_ids, periods, values):
+        self.distribution_ids = list(distribution_ids)
+        self.periods = list(periods)
+        self.values = values
+        self._positions = {distribution_id: i for i, distribution_id in enumerate(self.distribution_ids)}
+
+    # Function to build usage rows from (distribution ID, 'YYYY-MM-DD', bytes, unit) rows of bytes
+    @classmethod
+    def from_rows(cls, rows):
+        import numpy as np
+        rows = list(rows)
+        distribution_ids = list(dict.fromkeys(row[0] for row in rows))
+        dates = sorted({row[1] for row in rows})
+        row_index = {distribution_id: i for i, distribution_id in enumerate(distribution_ids)}
+        column_index = {date: j for j, date in enumerate(dates)}
+
+        i = np.fromiter((row_index[row[0]] for row in rows), dtype=int, count=len(rows))
+        j = np.fromiter((column_index[row[1]] for row in rows), dtype=int, count=len(rows))
+        values = np.zeros((len(distribution_ids), len(dates)))
+        np.add.at(values, (i, j), np.fromiter((row[2] for row in rows), dtype=float, count=len(rows)))
+        periods = [datetime.strptime(date, '%Y-%m-%d').date() for date in dates]
+        return cls(distribution_ids, periods, values)
+
+    def __len__(self):
+        return int((self.values != 0).sum())
+
+    def __iter__(self):
+        dates = [period.strftime('%Y-%m-%d') for period in self.periods]
+        for date, column in zip(dates, self.values.T.tolist()):
+            for distribution_id, amount in zip(self.distribution_ids, column):
+                if amount:
+                    yield distribution_id, date, amount, 'Bytes'
+
+    # Function to return the (period, bytes) of one distribution's periods with traffic
+    def usage(self, distribution_id):
+        i = self._positions.get(distribution_id)
+        if i is None:
+            return []
+        return [(period, amount) for period, amount in zip(self.periods, self.values[i].tolist()) if amount]
+
+    # Function to return the usage of some of the distributions
+    def select(self, distribution_ids):
+        kept = [distribution_id for distribution_id in distribution_ids if distribution_id in self._positions]
+        return UsageRows(kept, self.periods, self.values[[self._positions[k] for k in kept], :])
+
+    # Function to lay the usage out as a CostMatrix of the given distributions
+    # and periods; the cells of those without usage are 0
+    def matrix(self, distribution_ids, periods):
+        import numpy as np
+        column_positions = {period: j for j, period in enumerate(self.periods)}
+        rows = [(i, self._positions[k]) for i, k in enumerate(distribution_ids) if k in self._positions]
+        columns = [(j, column_positions[p]) for j, p in enumerate(periods) if p in column_positions]
+
+        values = np.zeros((len(distribution_ids), len(periods)))
+        if rows and columns:
+            target_rows, source_rows = zip(*rows)
+            target_columns, source_columns = zip(*columns)
+            values[np.ix_(target_rows, target_columns)] = self.values[np.ix_(source_rows, source_columns)]
+        return CostMatrix(distribution_ids, periods, values)
+
+# Daily sums per distribution for the days starting at first, one float array
+# per distribution, so a year of 20,000 distributions stays in tens of MB.
+# numpy is imported where the arrays are built and summed, not at import.
+class DailyUsage:
+    def __init__(self, first, days):
+        self.first = first
+        self.days = days
+        self.by_distribution = {}
+
+    # Function to add the daily arrays of a fetched batch
+    def add(self, batch):
+        self.by_distribution.update(batch)
+
+    # Function to return {distribution ID: [(hour start, bytes)]}; daily sums have no peak hours
+    def peak_hours(self):
+        return {}
+
+    # Function to return the UsageRows of the days in [start, end), summed per
+    # month for MONTHLY granularity and per day otherwise, HOURLY included.
+    # Like Cost Explorer, the first month starts at start.
+    def rows(self, start, end, granularity='DAILY'):
+        import numpy as np
+        distribution_ids = list(self.by_distribution)
+        first = max(day_start(start).date(), self.first)
+        last = min(day_start(end).date(), self.first + timedelta(days=self.days))
+        if last <= first:
+            return UsageRows(distribution_ids, [], np.zeros((len(distribution_ids), 0)))
+        if granularity == 'MONTHLY':
+            periods = [max(month, first) for month in iter_months(first, last)]
+        else:
+            periods = [first + timedelta(days=n) for n in range((last - first).days)]
+        if not distribution_ids:
+            return UsageRows([], periods, np.zeros((0, len(periods))))
+
+        # The days of every distribution are summed into their periods at once
+        begin, stop = (first - self.first).days, (last - self.first).days
+        offsets = [(period - first).days for period in periods]
+        daily = np.vstack(list(self.by_distribution.values()))[:, begin:stop]
+        return UsageRows(distribution_ids, periods, np.add.reduceat(daily, offsets, axis=1))
+
+# Hourly sums of one distribution rolled up into days as they stream in. The
+# hours of the day being read sit in a 24-slot ring buffer that is folded into
+# the day's total when the next day starts, and a heap keeps only the top_k
+# busiest hours, so memory does not grow with the number of hours.
+class HourlyRollup:
+    def __init__(self, days, top_k=PEAK_HOURS):
+        import numpy as np
+        self.daily = np.zeros(days)
+        self.top_k = top_k
+        self.peaks = []
+        self._ring = deque(maxlen=24)
+        self._day = None
+
+    # Function to add the bytes of one hour, counted from the start of the period
+    def add(self, hour, value):
+        day = hour // 24
+        if day != self._day:
+            self.flush()
+            self._day = day
+        self._ring.append((hour, value))
+
+    # Function to fold the buffered hours into their day and the peak hours
+    def flush(self):
+        if not self._ring:
+            return
+        self.daily[self._day] += sum(value for hour, value in self._ring)
+        for hour, value in self._ring:
+            if len(self.peaks) < self.top_k:
+                heapq.heappush(self.peaks, (value, hour))
+            elif value > self.peaks[0][0]:
+                heapq.heapreplace(self.peaks, (value, hour))
+        self._ring.clear()
+
+# Daily sums rolled up from hourly data, with the busiest hours of each distribution
+class HourlyUsage(DailyUsage):
+    def __init__(self, first, days):
+        super().__init__(first, days)
+        self.peaks = {}
+
+    # Function to add the roll-ups of a fetched batch
+    def add(self, batch):
+        for distribution_id, rollup in batch.items():
+            rollup.flush()
+            self.by_distribution[distribution_id] = rollup.daily
+            self.peaks[distribution_id] = rollup.peaks
+
+    # Function to return {distribution ID: [(hour start, bytes)]}, busiest hour first
+    def peak_hours(self):
+        origin = datetime(self.first.year, self.first.month, self.first.day)
+        return {
+            distribution_id: [(origin + timedelta(hours=hour), value) for value, hour in sorted(peaks, reverse=True) if value]
+            for distribution_id, peaks in self.peaks.items()
+        }
+
+# Function to stream the MetricDataResults of one get_metric_data call for a
+# batch of distributions, following NextToken if the service splits the
+# result. Yields (distribution ID, result) page by page.
+def _iter_batch_results(client, distributions, start, end, cross_account, period):
+    queries = []
+    distribution_ids = {}
+    for i, dist in enumerate(distributions):
+        query_id = f'd{i}'
+        queries.append(metric_query(query_id, dist['DistributionId'], dist.get('AccountId') if cross_account else None, period))
+        distribution_ids[query_id] = dist['DistributionId']
+
+    results = iter_metric_data_results(
+        client, MetricDataQueries=queries, StartTime=start, EndTime=end, ScanBy='TimestampAscending'
+    )
+    for result in results:
+        yield distribution_ids[result['Id']], result
+
+# Function to fetch the daily sums of a batch of distributions with one call.
+# Returns {distribution ID: array of daily bytes from start}
+def fetch_batch(client, distributions, start, end, cross_account=False):
+    import numpy as np
+    days = (end - start).days
+    origin = start.replace(tzinfo=timezone.utc).timestamp()
+    usage = {}
+    for distribution_id, result in _iter_batch_results(client, distributions, start, end, cross_account, PERIOD_SECONDS):
+        values = usage.get(distribution_id)
+        if values is None:
+            values = usage[distribution_id] = np.zeros(days)
+        for timestamp, value in zip(result['Timestamps'], result['Values']):
+            index = int((timestamp.timestamp() - origin) // PERIOD_SECONDS)
+            if 0 <= index < days:
+                values[index] += value
+    return usage
+
+# Function to fetch the hourly sums of a batch of distributions with one call,
+# rolling them up as each page arrives. Returns {distribution ID: HourlyRollup}
+def fetch_hourly_batch(client, distributions, start, end, cross_account=False, top_k=PEAK_HOURS):
+    days = (end - start).days
+    origin = start.replace(tzinfo=timezone.utc).timestamp()
+    usage = {}
+    for distribution_id, result in _iter_batch_results(client, distributions, start, end, cross_account, HOURLY_PERIOD_SECONDS):
+        rollup = usage.get(distribution_id)
+        if rollup is None:
+            rollup = usage[distribution_id] = HourlyRollup(days, top_k)
+        for timestamp, value in zip(result['Timestamps'], result['Values']):
+            hour = int((timestamp.timestamp() - origin) // HOURLY_PERIOD_SECONDS)
+            if 0 <= hour < days * 24:
+                rollup.add(hour, value)
+    return usage
+
+# Function to fetch the daily BytesDownloaded of every distribution for the
+# whole days in [start, end). Distributions are batched per account, up to
+# MAX_QUERIES per call, and the batches of all accounts run in parallel.
+# Returns a DailyUsage, or with hourly set an HourlyUsage rolled up from
+# one-hour data points while CloudWatch still keeps them for start; a failed
+# batch is logged and its distributions are left without data.
+def fetch_bytes_downloaded(distributions, start, end, max_workers=DEFAULT_MAX_WORKERS, hourly=False):
+    start, end = day_start(start), day_start(end)
+    if hourly and (day_start(datetime.utcnow()) - start).days > MAX_HOURLY_DAYS:
+        print(f"CloudWatch keeps hourly metrics for {MAX_HOURLY_DAYS} days, fetching daily sums instead")
+        hourly = False
+    usage = (HourlyUsage if hourly else DailyUsage)(start.date(), max(0, (end - start).days))
+    if not usage.days or not distributions:
+        return usage
+    size = batch_size(usage.days * 24 if hourly else usage.days)
+
+    if MONITORING_ACCOUNT:
+        groups = {None: list(distributions)}
+    else:
+        groups = {}
+        for dist in distributions:
+            groups.setdefault(dist['AccountId'], []).append(dist)
+
+    batches = []
+    for account_id, dists in groups.items():
+        for i in range(0, len(dists), size):
+            batches.append((account_id, dists[i:i + size]))
+
+    sts_client = get_client('sts')
+
+    def fetch(batch):
+        account_id, dists = batch
+        if account_id is None:
+            client = get_client('cloudwatch', METRICS_REGION)
+        else:
+            client = assumed_client('cloudwatch', account_id, role_arn(account_id), sts_client, METRICS_REGION)
+        if hourly:
+            return fetch_hourly_batch(client, dists, start, end, cross_account=account_id is None)
+        return fetch_batch(client, dists, start, end, cross_account=account_id is None)
+
+    for (account_id, dists), batch_usage, error in fan_out(fetch, batches, max_workers):
+        if error is not None:
+            print(f"Error fetching CloudFront metrics for {len(dists)} distributions"
+                  f"{f' of account {account_id}' if account_id else ''}: {str(error)}")
+            continue
+        usage.add(batch_usage)
+
+    print(f"CloudFront metrics: {len(distributions)} distributions in {len(batches)} GetMetricData batches")
+    return usage
+
+# Function to fetch the BytesDownloaded rows of every distribution for a report period
+def fetch_usage_rows(distributions, start, end, granularity='DAILY', max_workers=DEFAULT_MAX_WORKERS):
+    return fetch_bytes_downloaded(distributions, start, end, max_workers).rows(start, end, granularity)
+
+# Function to fetch the daily rows of every distribution from hourly data,
+# with {distribution ID: [(hour start, bytes)]} of its busiest hours
+def fetch_hourly_rows(distributions, start, end, max_workers=DEFAULT_MAX_WORKERS):
+    usage = fetch_bytes_downloaded(distributions, start, end, max_workers, hourly=True)
+    return usage.rows(start, end, 'DAILY'), usage.peak_hours()
+
+# One CloudWatch fetch serving report specs whose source is CloudWatch.
+# Sums are fetched once for the union of the specs' periods and cut back per
+# spec; with hourly set they are rolled up from one-hour data points and the
+# labels of each spec carry its distributions' peak hours. It runs once the
+# distributions named in context are known.
+class DistributionMetricsQuery:
+    context = ('distributions',)
+
+    def __init__(self, targets, hourly=False):
+        self.targets = targets
+        self.hourly = hourly
+        self.start = min(start for spec, start, end in targets)
+        self.end = max(end for spec, start, end in targets)
+
+    def describe(self):
+        names = ', '.join(spec.name for spec, start, end in self.targets)
+        granularity = 'HOURLY' if self.hourly else 'DAILY'
+        return f"CloudWatch {granularity} DistributionId {METRIC_NAME} {self.start:%Y-%m-%d}..{self.end:%Y-%m-%d} for {names}"
+
+    # Function to fetch the metrics and return {spec name: (rows, labels)}
+    def execute(self, distributions):
+        print(f"Query plan: {self.describe()}")
+        usage = fetch_bytes_downloaded(distributions, self.start, self.end, hourly=self.hourly)
+        peak_hours = usage.peak_hours()
+        return {spec.name: (usage.rows(start, end, spec.granularity), peak_hours) for spec, start, end in self.targets}
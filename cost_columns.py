@@ -0,0 +1,105 @@
+import os
+import re
+from array import array
+
+# Cost metrics fetched in the same request as each report's own metric and
+# shown as extra total columns, e.g. 'UnblendedCost,AmortizedCost,NetUnblendedCost'
+EXTRA_METRICS = tuple(m.strip() for m in os.environ.get('REPORT_EXTRA_METRICS', '').split(',') if m.strip())
+
+# Function to list the metrics a report requests: its own first, then the extra ones
+def report_metrics(metric):
+    return (metric,) + tuple(m for m in EXTRA_METRICS if m != metric)
+
+# Function to turn a metric name such as 'NetUnblendedCost' into the heading 'Net Unblended Cost'
+def metric_label(metric):
+    return re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', metric)
+
+# Amounts of several metrics over one shared (key, date) index, stored as one
+# array of doubles per metric. Iterating yields (key, date, amount, unit) rows
+# of the first metric, so code written for plain rows keeps working, and
+# renderers read the other metrics with column() from the same index.
+class CostColumns:
+    def __init__(self, metrics):
+        self.metrics = tuple(metrics)
+        self.keys = []
+        self.dates = []
+        self.units = []
+        self._positions = {}
+        self._columns = {metric: array('d') for metric in self.metrics}
+
+    # Function to build columns from {metric: (key, date, amount, unit) rows};
+    # the rows of the first metric set the order of the index
+    @classmethod
+    def from_rows(cls, rows_by_metric):
+        columns = cls(rows_by_metric)
+        for metric, rows in rows_by_metric.items():
+            for key, date, amount, unit in rows:
+                columns.add(key, date, unit, {metric: amount})
+        return columns
+
+    # Function to add {metric: amount} for a (key, date), summing into the amounts already there
+    def add(self, key, date, unit, amounts):
+        position = self._positions.get((key, date))
+        if position is None:
+            self._positions[(key, date)] = len(self.keys)
+            self.keys.append(key)
+            self.dates.append(date)
+            self.units.append(unit)
+            for metric in self.metrics:
+                self._columns[metric].append(amounts.get(metric, 0.0))
+            return
+        for metric, amount in amounts.items():
+            if metric in self._columns:
+                self._columns[metric][position] += amount
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def column(self, metric):
+        return self._columns[metric]
+
+    # Function to return (metric, column) for every metric after the first
+    def extra_columns(self):
+        return [(metric, self._columns[metric]) for metric in self.metrics[1:]]
+
+    def rows(self, metric=None):
+        return list(zip(self.keys, self.dates, self._columns[metric or self.metrics[0]], self.units))
+
+    # Function to return the report records of the rows, built with
+    # record(key, date, amount, unit); the extra metrics become fields named after the metric
+    def records(self, record):
+        return CostRecords(self, record)
+
+# Report records over CostColumns, built one at a time whenever they are
+# iterated instead of being kept as a list. Rendering and exporting a report
+# read the records as they go, so only the columns stay in memory.
+class CostRecords:
+    def __init__(self, columns, record):
+        self.columns = columns
+        self.record = record
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, i):
+        return next(self._iter([range(len(self.columns))[i]]))
+
+    def __iter__(self):
+        return self._iter(range(len(self.columns)))
+
+    def _iter(self, positions):
+        columns = self.columns
+        amounts = columns.column(columns.metrics[0])
+        extra_columns = columns.extra_columns()
+        for i in positions:
+            fields = self.record(columns.keys[i], columns.dates[i], amounts[i], columns.units[i])
+            for metric, column in extra_columns:
+                fields[metric] = column[i]
+            yield fields
+
+# Function to list the extra metrics carried by report records, as fields named after the metric
+def record_metrics(records):
+    return [metric for metric in EXTRA_METRICS if records and metric in records[0]]
@@ -0,0 +1,100 @@
+# numpy is imported on first use, so a handler only loads it once it
+# builds a matrix rather than at import
+SIZE_SUFFIXES = ('Bytes', 'KB', 'MB', 'GB', 'TB')
+
+# Trend classes for the month-over-month comparison, indexed by sign + 1
+TREND_CLASSES = ('down', None, 'up')
+
+# Function to format each distinct value once and scatter the strings back into shape
+def _format_unique(values, formatter):
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    unique, inverse = np.unique(values, return_inverse=True)
+    return formatter(unique)[inverse].reshape(values.shape)
+
+# Function to return the index in SIZE_SUFFIXES of the unit each byte count is shown in
+def _size_index(sizes):
+    import numpy as np
+    index = np.zeros(sizes.shape, dtype=int)
+    positive = sizes >= 1024
+    index[positive] = np.floor(np.log(sizes[positive]) / np.log(1024)).astype(int)
+    # Correct floating point error right at the powers of 1024
+    index += sizes >= np.power(1024.0, index + 1)
+    index -= (index > 0) & (sizes < np.power(1024.0, index))
+    return np.clip(index, 0, len(SIZE_SUFFIXES) - 1)
+
+# Function to join formatted amounts and their units into '1.50 GB' strings
+def _join_sizes(amounts, suffixes):
+    import numpy as np
+    return np.char.add(np.char.add(amounts, ' '), suffixes)
+
+# Function to format byte counts as '1.50 GB' strings in one batch. Cells are
+# grouped by unit and hundredths, so each distinct string is formatted once;
+# the few cells too close to a rounding boundary to group are formatted one by one.
+def format_sizes(sizes):
+    import numpy as np
+    sizes = np.asarray(sizes, dtype=float)
+    index = _size_index(sizes)
+    scaled = sizes / np.power(1024.0, index)
+    suffixes = np.array(SIZE_SUFFIXES)
+
+    hundredths = np.rint(scaled * 100)
+    with np.errstate(invalid='ignore'):
+        grouped = (scaled >= 0) & (np.abs(scaled * 100 - hundredths) < 0.49)
+    codes, inverse = np.unique(hundredths[grouped] * len(suffixes) + index[grouped], return_inverse=True)
+    group_strings = _join_sizes(np.char.mod('%.2f', codes // len(suffixes) / 100), suffixes[(codes % len(suffixes)).astype(int)])
+    single_strings = _join_sizes(np.char.mod('%.2f', scaled[~grouped]), suffixes[index[~grouped]])
+
+    formatted = np.empty(sizes.shape, dtype=np.result_type(group_strings, single_strings))
+    formatted[grouped] = group_strings[inverse.reshape(-1)]
+    formatted[~grouped] = single_strings
+    return formatted
+
+# Function to format amounts with a printf-style format in one batch
+def format_amounts(amounts, float_format='%.2f'):
+    import numpy as np
+    return _format_unique(amounts, lambda unique: np.char.mod(float_format, unique))
+
+# Dense matrix of amounts with rows = accounts, services or distributions and
+# columns = dates. Cells without data are 0 in values and False in present.
+class CostMatrix:
+    def __init__(self, rows, columns, values, present=None):
+        import numpy as np
+        self.rows = list(rows)
+        self.columns = list(columns)
+        self.values = np.asarray(values, dtype=float).reshape(len(self.rows), len(self.columns))
+        self.present = np.ones(self.values.shape, dtype=bool) if present is None else np.asarray(present, dtype=bool)
+
+    # Function to build a matrix from a Pivot index
+    @classmethod
+    def from_pivot(cls, pivot):
+        import numpy as np
+        rows = pivot.rows
+        columns = pivot.columns
+        row_index = {row: i for i, row in enumerate(rows)}
+        column_index = {column: j for j, column in enumerate(columns)}
+
+        count = len(pivot.cells)
+        i = np.fromiter((row_index[row] for row, column in pivot.cells), dtype=int, count=count)
+        j = np.fromiter((column_index[column] for row, column in pivot.cells), dtype=int, count=count)
+        amounts = np.fromiter(pivot.cells.values(), dtype=float, count=count)
+
+        values = np.zeros((len(rows), len(columns)))
+        present = np.zeros((len(rows), len(columns)), dtype=bool)
+        values[i, j] = amounts
+        present[i, j] = True
+        return cls(rows, columns, values, present)
+
+    def row_totals(self):
+        return self.values.sum(axis=1)
+
+    def column_totals(self):
+        return self.values.sum(axis=0)
+
+    def grand_total(self):
+        return float(self.values.sum())
+
+    # Function to return -1, 0 or 1 per cell comparing it with the previous column (the first with 0)
+    def trend(self):
+        import numpy as np
+        return np.sign(np.diff(self.values, axis=1, prepend=0.0)).astype(int)
@@ -0,0 +1,185 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from ce_coalescer import canonical_request_key
+from cost_columns import CostColumns
+from pagination import iter_cost_and_usage_pages
+
+COST_STORE_PATH = os.environ.get('COST_STORE_PATH', '/tmp/cost_store.sqlite3')
+
+# Trailing days Cost Explorer may still restate, so they are always re-fetched
+RESTATEMENT_DAYS = int(os.environ.get('COST_STORE_RESTATEMENT_DAYS', '3'))
+
+# Joins the keys of a row grouped by two dimensions into one stored key
+KEY_SEPARATOR = '\t'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS costs (
+    scope TEXT, metric TEXT, dimension TEXT, key TEXT, date TEXT, amount REAL, unit TEXT,
+    PRIMARY KEY (scope, metric, dimension, key, date)
+);
+CREATE TABLE IF NOT EXISTS fetched (
+    scope TEXT, metric TEXT, dimension TEXT, date TEXT,
+    PRIMARY KEY (scope, metric, dimension, date)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    dimension TEXT, key TEXT, label TEXT,
+    PRIMARY KEY (dimension, key)
+);
+"""
+
+# Function to derive the store scope of a query from its filter, so two
+# reports with different filters never read each other's amounts
+def query_scope(filter):
+    return hashlib.sha1(canonical_request_key('filter', filter or {}).encode('utf-8')).hexdigest()[:16]
+
+# Function to check whether a YYYY-MM-DD day is past the restatement window, so its amounts are final
+def is_settled(day, today=None):
+    today = today or datetime.utcnow()
+    return day < (today - timedelta(days=RESTATEMENT_DAYS)).strftime('%Y-%m-%d')
+
+# Function to list the YYYY-MM-DD days in [start, end)
+def iter_days(start, end):
+    day = start
+    while day < end:
+        yield day.strftime('%Y-%m-%d')
+        day += timedelta(days=1)
+
+# Persistent daily cost store keyed by (scope, metric, dimension, key, date).
+# Rows are read back in the order Cost Explorer returned them for each day.
+class CostStore:
+    def __init__(self, path=COST_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def fetched_dates(self, scope, metric, dimension, start, end):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT date FROM fetched WHERE scope = ? AND metric = ? AND dimension = ? AND date >= ? AND date < ?",
+                (scope, metric, dimension, start, end))
+            return {row[0] for row in cursor}
+
+    # Function to replace every stored amount in [start, end) with the given rows
+    def replace_range(self, scope, metric, dimension, start, end, rows, labels=None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM costs WHERE scope = ? AND metric = ? AND dimension = ? AND date >= ? AND date < ?",
+                (scope, metric, dimension, start, end))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO costs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((scope, metric, dimension, key, date, amount, unit) for key, date, amount, unit in rows))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fetched VALUES (?, ?, ?, ?)",
+                ((scope, metric, dimension, date) for date in iter_days(
+                    datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d'))))
+            if labels:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO labels VALUES (?, ?, ?)",
+                    ((dimension, key, label) for key, label in labels.items()))
+
+    def rows(self, scope, metric, dimension, start, end):
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT key, date, amount, unit FROM costs WHERE scope = ? AND metric = ? AND dimension = ? "
+                "AND date >= ? AND date < ? ORDER BY date, rowid",
+                (scope, metric, dimension, start, end))
+            return cursor.fetchall()
+
+    def labels(self, dimension):
+        with self._lock:
+            cursor = self._conn.execute("SELECT key, label FROM labels WHERE dimension = ?", (dimension,))
+            return dict(cursor.fetchall())
+
+    def close(self):
+        self._conn.close()
+
+_STORE = None
+
+# Function to return the module-scope store, which stays open across warm invocations
+def get_store():
+    global _STORE
+    if _STORE is None:
+        _STORE = CostStore()
+    return _STORE
+
+# Function to normalize a metric or tuple of metrics and a dimension or tuple
+# of dimensions. Returns (metrics, dimensions, the dimension key they are stored under).
+def query_shape(metrics, dimension):
+    metrics = (metrics,) if isinstance(metrics, str) else tuple(metrics)
+    dimensions = (dimension,) if isinstance(dimension, str) else tuple(dimension)
+    return metrics, dimensions, ','.join(dimensions)
+
+# Function to return the first day to request from Cost Explorer for [start, end),
+# the first day missing from the store for any metric or else the start of the
+# restatement window, with the days already stored
+def _fetch_start(store, scope, metrics, dimension, start_date, end_date, restatement_days):
+    start = start_date.strftime('%Y-%m-%d')
+    refetch_from = max(start_date, end_date - timedelta(days=restatement_days)).strftime('%Y-%m-%d')
+    # A day is only reused when every metric has it
+    fetched = set.intersection(*(store.fetched_dates(scope, metric, dimension, start, refetch_from) for metric in metrics))
+    missing = [day for day in iter_days(start_date, end_date) if day < refetch_from and day not in fetched]
+    return min(missing + [refetch_from]), fetched
+
+# Function to return how many days fetch_daily would request from Cost Explorer, without requesting them
+def days_to_fetch(store, start_date, end_date, metrics, dimension, filter=None, restatement_days=RESTATEMENT_DAYS):
+    metrics, dimensions, dimension = query_shape(metrics, dimension)
+    start_date = datetime.strptime(start_date.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    end_date = datetime.strptime(end_date.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    fetch_start = _fetch_start(store, query_scope(filter), metrics, dimension, start_date, end_date, restatement_days)[0]
+    return max(0, (end_date - datetime.strptime(fetch_start, '%Y-%m-%d')).days)
+
+# Function to fetch one or more metrics grouped by one dimension at DAILY
+# granularity, asking Cost Explorer only for the days missing from the store
+# plus the trailing restatement window. Every metric comes from the same
+# request. Returns CostColumns for [start_date, end_date) read from the store,
+# which iterate as (key, date, amount, unit) rows of the first metric. With
+# two dimensions, such as ('LINKED_ACCOUNT', 'SERVICE'), the key is a tuple.
+def fetch_daily(ce_client, store, start_date, end_date, metrics, dimension, filter=None,
+                restatement_days=RESTATEMENT_DAYS):
+    metrics, dimensions, dimension = query_shape(metrics, dimension)
+    start = start_date.strftime('%Y-%m-%d')
+    end = end_date.strftime('%Y-%m-%d')
+    start_date = datetime.strptime(start, '%Y-%m-%d')
+    end_date = datetime.strptime(end, '%Y-%m-%d')
+    scope = query_scope(filter)
+
+    fetch_start, fetched = _fetch_start(store, scope, metrics, dimension, start_date, end_date, restatement_days)
+
+    if fetch_start < end:
+        params = {
+            'TimePeriod': {'Start': fetch_start, 'End': end},
+            'Granularity': 'DAILY',
+            'Metrics': list(metrics),
+            'GroupBy': [{'Type': 'DIMENSION', 'Key': key} for key in dimensions],
+        }
+        if filter:
+            params['Filter'] = filter
+
+        rows = {metric: [] for metric in metrics}
+        labels = {}
+        for page in iter_cost_and_usage_pages(ce_client, **params):
+            for attribute in page.get('DimensionValueAttributes', []):
+                labels[attribute['Value']] = attribute.get('Attributes', {}).get('description')
+            for result_by_time in page['ResultsByTime']:
+                date = result_by_time['TimePeriod']['Start']
+                for group in result_by_time.get('Groups', []):
+                    key = KEY_SEPARATOR.join(group['Keys'])
+                    for metric in metrics:
+                        value = group['Metrics'][metric]
+                        rows[metric].append((key, date, float(value['Amount']), value['Unit']))
+
+        for metric in metrics:
+            store.replace_range(scope, metric, dimension, fetch_start, end, rows[metric],
+                                {k: v for k, v in labels.items() if v})
+        reused = sum(1 for day in fetched if day < fetch_start)
+        print(f"Cost store: fetched {fetch_start} to {end} from Cost Explorer, reused {reused} stored days")
+
+    rows = {metric: store.rows(scope, metric, dimension, start, end) for metric in metrics}
+    if len(dimensions) > 1:
+        rows = {metric: [(tuple(key.split(KEY_SEPARATOR)), date, amount, unit) for key, date, amount, unit in metric_rows]
+                for metric, metric_rows in rows.items()}
+    return CostColumns.from_rows(rows)
@@ -0,0 +1,91 @@
+from cost_columns import metric_label, record_metrics
+from cost_matrix import CostMatrix, format_amounts
+from html_render import render_table
+from pivot import Pivot
+from rolling_stats import flag_class, render_movers
+
+# Function to yield one table row per account; missing marks the periods without a cost
+def account_rows(pivot, dates, float_format, extra_pivots=(), missing='N/A'):
+    for account_id in pivot.rows:
+        row = [(account_id, 'num'), pivot.label(account_id, missing)]
+
+        for date in dates:
+            cost = pivot.get(account_id, date)
+            formatted_cost = float_format % round(cost, 2) if cost is not None else missing
+            row.append((formatted_cost, 'num'))
+
+        # Add Total column value
+        row.append((float_format % pivot.row_total(account_id), 'total'))
+
+        # Period totals of the extra metrics
+        row.extend((float_format % extra.row_total(account_id), 'total') for extra in extra_pivots)
+        yield row
+
+# Function to render the cost of every linked account per period;
+# format_period turns a 'YYYY-MM-DD' period into its column heading
+def account_table(data, format_period, float_format='%.2f', missing='N/A'):
+    # Index amounts by (account, date) in a single pass
+    pivot = Pivot.from_records(data, 'Account ID', 'Date', label_field='Account Name')
+
+    # Extract unique dates
+    dates = pivot.columns
+
+    header = ['Account ID', 'Account Name']
+    header.extend(format_period(date) for date in dates)
+    header.append(('Total', 'total'))
+
+    # Each extra metric adds a column with its total over the period
+    metrics = record_metrics(data)
+    extra_pivots = [Pivot.from_records(data, 'Account ID', 'Date', value_field=metric) for metric in metrics]
+    header.extend((metric_label(metric), 'total') for metric in metrics)
+
+    return render_table(header, account_rows(pivot, dates, float_format, extra_pivots, missing))
+
+# Function to yield one table row per service followed by the column totals
+def service_rows(matrix, extra_pivots=(), flagged=()):
+    # Cells and totals are formatted for the whole matrix at once
+    cells = format_amounts(matrix.values)
+    row_totals = format_amounts(matrix.row_totals())
+
+    # Period totals of the extra metrics, one column each
+    extra_totals = [format_amounts([extra.row_total(service) for service in matrix.rows]).tolist() for extra in extra_pivots]
+
+    for i, service in enumerate(matrix.rows):
+        row = [service]
+        row.extend(
+            (cell, flag_class('num', (i, j) in flagged)) if present else '-'
+            for j, (cell, present) in enumerate(zip(cells[i].tolist(), matrix.present[i].tolist()))
+        )
+        row.append((row_totals[i], 'total'))
+        row.extend((totals[i], 'total') for totals in extra_totals)
+        yield row
+
+    # Column-wise totals
+    totals = [('Total', 'total')]
+    totals.extend((total, 'total') for total in format_amounts(matrix.column_totals()).tolist())
+    totals.append((str(format_amounts(matrix.grand_total())), 'total'))
+    totals.extend((str(format_amounts(extra.grand_total)), 'total') for extra in extra_pivots)
+    yield totals
+
+# Function to render the cost of every service per period with its movers
+# above the table. format_period turns a 'YYYY-MM-DD' period into its
+# column heading and its label in the movers list; observe(matrix) scores
+# the periods against their rolling statistics.
+def service_table(data, format_period, observe, format_mover_period=str):
+    # Index amounts by (service, date) in a single pass, then lay them out as a dense matrix
+    pivot = Pivot.from_records(data, 'Service', 'Date')
+    matrix = CostMatrix.from_pivot(pivot)
+
+    header = ['Service']
+    header.extend(format_period(date) for date in matrix.columns)
+    header.append(('Total', 'total'))
+
+    # Each extra metric adds a column with its total over the period
+    metrics = record_metrics(data)
+    extra_pivots = [Pivot.from_records(data, 'Service', 'Date', value_field=metric) for metric in metrics]
+    header.extend((metric_label(metric), 'total') for metric in metrics)
+
+    anomalies = observe(matrix)
+    movers = render_movers(anomalies.movers, 'Service', lambda values: format_amounts(values).tolist(), format_mover_period)
+
+    return movers + render_table(header, service_rows(matrix, extra_pivots, anomalies.cells))
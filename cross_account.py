@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import get_client
+from pagination import iter_distributions
+from sts_credentials import CREDENTIALS, assumed_client
+
+CROSS_ACCOUNT_ROLE = 'CrossAccountReadAccess'
+DEFAULT_MAX_WORKERS = 16
+
+# Function to resolve the discovery concurrency from the event, then the environment
+def get_max_workers(event=None):
+    value = (event or {}).get('max_workers') or os.environ.get('DISCOVERY_MAX_WORKERS')
+    try:
+        return max(1, int(value)) if value else DEFAULT_MAX_WORKERS
+    except ValueError:
+        print(f"Ignoring invalid max_workers value {value!r}")
+        return DEFAULT_MAX_WORKERS
+
+# Function to run func over items on a bounded thread pool.
+# Returns (item, result, error) tuples in the same order as items; an
+# exception in one item is recorded against it and never affects the others.
+def fan_out(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    items = list(items)
+    if not items:
+        return []
+
+    def run(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(run, items))
+
+# Function to build the ARN of the cross-account read role in an account
+def role_arn(account_id):
+    return f"arn:aws:iam::{account_id}:role/{CROSS_ACCOUNT_ROLE}"
+
+# Function to check if an account has the necessary STS role
+def has_sts_role(account_id, sts_client=None):
+    try:
+        # The credentials are cached, so the data fetch that follows reuses them
+        CREDENTIALS.get(account_id, role_arn(account_id), sts_client)
+        return True
+    except Exception as e:
+        print(f"Account {account_id} does not have the required STS role. Skipping.")
+        return False
+
+# Function to list distributions for a given AWS account
+def list_distributions_for_account(account_id, sts_client=None):
+    try:
+        client = assumed_client('cloudfront', account_id, role_arn(account_id), sts_client)
+
+        dist_list = []
+        for i in iter_distributions(client):
+            ele = {
+                "AccountId": account_id,
+                "DistributionId": i['Id'],
+                "DomainName": i['DomainName'],
+                "AlternateDomainNames": i.get('Aliases', {}).get('Items', [])
+            }
+            dist_list.append(ele)
+
+        return dist_list
+    except Exception as e:
+        print(f"Error listing distributions for account {account_id}: {str(e)}")
+        return []
+
+# Function to list the distributions of every active account that grants the cross-account role.
+# Accounts are probed in parallel; results are ordered by account ID so the report is stable.
+def discover_distributions(accounts, max_workers=DEFAULT_MAX_WORKERS):
+    account_ids = sorted(k['Id'] for k in accounts if k.get('Status') == 'ACTIVE')
+    sts_client = get_client('sts')
+
+    def distributions_for(account_id):
+        if not has_sts_role(account_id, sts_client):
+            return []
+        return list_distributions_for_account(account_id, sts_client)
+
+    distributions = []
+    for account_id, dist_list, error in fan_out(distributions_for, account_ids, max_workers):
+        if error is not None:
+            print(f"Error discovering distributions for account {account_id}: {str(error)}")
+            continue
+        distributions.extend(dist_list)
+
+    return distributions
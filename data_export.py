@@ -0,0 +1,230 @@
+import csv
+import io
+import itertools
+import json
+import os
+from datetime import date
+from aws_clients import get_client
+
+# Export format: csv, ndjson or parquet; exports are off when unset
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', '').lower()
+
+# Local directory sink, used unless an S3 bucket is configured
+EXPORT_DIR = os.environ.get('EXPORT_DIR', '/tmp/exports')
+
+# S3 sink; the endpoint can point at any S3-compatible store, such as a local stand-in
+EXPORT_S3_BUCKET = os.environ.get('EXPORT_S3_BUCKET', '')
+EXPORT_S3_PREFIX = os.environ.get('EXPORT_S3_PREFIX', 'billing-reports/')
+EXPORT_S3_ENDPOINT = os.environ.get('EXPORT_S3_ENDPOINT') or None
+
+# Records encoded per chunk; this and the part size bound the memory an export uses
+CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', '5000'))
+
+# S3 rejects multipart parts below 5 MiB, except for the last one
+MIN_PART_BYTES = 5 * 1024 * 1024
+PART_BYTES = max(int(os.environ.get('EXPORT_PART_BYTES', str(8 * 1024 * 1024))), MIN_PART_BYTES)
+
+# Function to split records into lists of at most size records
+def iter_chunks(records, size=CHUNK_ROWS):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+# Function to write records as CSV, with a header from the first record's fields
+def write_csv(records, out):
+    buffer = io.StringIO()
+    writer = None
+    count = 0
+    for chunk in iter_chunks(records):
+        if writer is None:
+            writer = csv.DictWriter(buffer, fieldnames=list(chunk[0]))
+            writer.writeheader()
+        writer.writerows(chunk)
+        out.write(buffer.getvalue().encode('utf-8'))
+        buffer.seek(0)
+        buffer.truncate()
+        count += len(chunk)
+    return count
+
+# Function to write records as newline-delimited JSON
+def write_ndjson(records, out):
+    count = 0
+    for chunk in iter_chunks(records):
+        out.write(''.join(json.dumps(record, default=_json_default) + '\n' for record in chunk).encode('utf-8'))
+        count += len(chunk)
+    return count
+
+# Function to write records as Parquet, one row group per chunk. The schema
+# is inferred from the first chunk. pyarrow is optional and only needed here.
+def write_parquet(records, out):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('Parquet export needs the pyarrow package')
+
+    writer = None
+    count = 0
+    for chunk in iter_chunks(records):
+        if writer is None:
+            table = pyarrow.Table.from_pylist(chunk)
+            writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(out, mode='w'), table.schema)
+        else:
+            table = pyarrow.Table.from_pylist(chunk, schema=writer.schema)
+        writer.write_table(table)
+        count += len(chunk)
+    if writer is not None:
+        writer.close()
+    return count
+
+FORMATS = {
+    'csv': ('.csv', write_csv),
+    'ndjson': ('.ndjson', write_ndjson),
+    'parquet': ('.parquet', write_parquet),
+}
+
+# A file being written in a local directory. It is written under a temporary
+# name and renamed on close, so readers never see a partial export.
+class LocalObject:
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+        self._size = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path + '.part', 'wb')
+
+    def write(self, data):
+        self._size += len(data)
+        return self._file.write(data)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            os.replace(self.path + '.part', self.path)
+            self.closed = True
+
+    def abort(self):
+        self.closed = True
+        self._file.close()
+        os.remove(self.path + '.part')
+
+class LocalDirectorySink:
+    def __init__(self, directory=EXPORT_DIR):
+        self.directory = directory
+
+    def open(self, key):
+        return LocalObject(os.path.join(self.directory, key))
+
+    def location(self, key):
+        return os.path.join(self.directory, key)
+
+# An S3 object written with a multipart upload. Writes are buffered until a
+# part is full, so at most one part is held in memory whatever the export size.
+class MultipartUpload:
+    def __init__(self, client, bucket, key, part_bytes=PART_BYTES):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.closed = False
+        self.parts = []
+        self._buffer = bytearray()
+        self._size = 0
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def write(self, data):
+        self._buffer += data
+        self._size += len(data)
+        if len(self._buffer) >= self.part_bytes:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=bytes(self._buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self._buffer.clear()
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer or not self.parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts}
+        )
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+class S3Sink:
+    def __init__(self, bucket, prefix=EXPORT_S3_PREFIX, endpoint_url=EXPORT_S3_ENDPOINT, part_bytes=PART_BYTES):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_bytes = part_bytes
+        self.client = get_client('s3', endpoint_url=endpoint_url)
+
+    def open(self, key):
+        return MultipartUpload(self.client, self.bucket, self.prefix + key, self.part_bytes)
+
+    def location(self, key):
+        return f's3://{self.bucket}/{self.prefix}{key}'
+
+# Function to return the sink configured through the environment
+def get_sink():
+    if EXPORT_S3_BUCKET:
+        return S3Sink(EXPORT_S3_BUCKET)
+    return LocalDirectorySink()
+
+# Function to stream a report's records to the sink as <report>/<run date>.<format>.
+# Records may be a generator; they are encoded and written chunk by chunk.
+# A failed export is aborted and logged without failing the report, and the
+# object key is returned when the export succeeds.
+def export_report(report, records, run_date, format=None, sink=None):
+    format = (format or EXPORT_FORMAT).lower()
+    if not format:
+        return None
+    if format not in FORMATS:
+        print(f"Unknown export format '{format}', expected one of {', '.join(FORMATS)}")
+        return None
+
+    extension, write = FORMATS[format]
+    key = f"{report}/{run_date.strftime('%Y-%m-%d')}{extension}"
+    sink = sink or get_sink()
+    out = None
+    try:
+        out = sink.open(key)
+        count = write(records, out)
+        out.close()
+    except Exception as e:
+        if out is not None and not out.closed:
+            out.abort()
+        print(f"Export of {report} failed: {str(e)}")
+        return None
+
+    print(f"Exported {count} records of {report} to {sink.location(key)}: {out.tell()} bytes")
+    return key
@@ -0,0 +1,85 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from aws_clients import get_client
+from pagination import iter_dimension_values
+
+# Seconds before a dimension's values are listed again
+CATALOG_TTL_SECONDS = int(os.environ.get('DIMENSION_CATALOG_TTL', str(24 * 3600)))
+
+# Values seen in this many days before today are listed
+LOOKBACK_DAYS = int(os.environ.get('DIMENSION_CATALOG_LOOKBACK_DAYS', '90'))
+
+# The catalog is kept on disk as well, so cold starts within the TTL make no calls
+CATALOG_PATH = os.environ.get('DIMENSION_CATALOG_PATH', '/tmp/dimension_catalog.json')
+
+# Values of the Cost Explorer dimensions with their attributes, listed with
+# get_dimension_values and cached in module scope and on disk for
+# CATALOG_TTL_SECONDS. When a refresh fails, the expired values are kept.
+class DimensionCatalog:
+    def __init__(self, path=CATALOG_PATH, ttl=CATALOG_TTL_SECONDS, lookback_days=LOOKBACK_DAYS):
+        self.path = path
+        self.ttl = ttl
+        self.lookback_days = lookback_days
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _read(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f).get('dimensions', {})
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable dimension catalog {self.path}: {str(e)}")
+
+    def _write(self):
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'dimensions': self._entries}, f)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            print(f"Could not save the dimension catalog: {str(e)}")
+
+    def _fetch(self, dimension, ce_client):
+        today = datetime.utcnow().date()
+        params = {
+            'TimePeriod': {'Start': (today - timedelta(days=self.lookback_days)).isoformat(), 'End': today.isoformat()},
+            'Dimension': dimension,
+            'Context': 'COST_AND_USAGE',
+        }
+        return {value['Value']: value.get('Attributes', {}) for value in iter_dimension_values(ce_client, **params)}
+
+    # Function to return {value: attributes} for a dimension, listing it again once the TTL has passed
+    def values(self, dimension, ce_client=None):
+        with self._lock:
+            self._read()
+            entry = self._entries.get(dimension)
+            if entry is not None and time.time() - entry['loaded_at'] < self.ttl:
+                return entry['values']
+            try:
+                values = self._fetch(dimension, ce_client or get_client('ce', region_name='us-east-1'))
+            except Exception as e:
+                print(f"Could not list {dimension} values: {str(e)}")
+                return entry['values'] if entry is not None else {}
+            self._entries[dimension] = {'loaded_at': time.time(), 'values': values}
+            self._write()
+            print(f"Dimension catalog: {len(values)} {dimension} values")
+            return values
+
+    # Function to return the number of values of a dimension without making any calls, or None if unknown
+    def cached_count(self, dimension):
+        with self._lock:
+            self._read()
+            entry = self._entries.get(dimension)
+            return len(entry['values']) if entry is not None else None
+
+    # Function to return the description attribute of a value, such as an account's name
+    def describe(self, dimension, value, ce_client=None):
+        return self.values(dimension, ce_client).get(value, {}).get('description')
+
+CATALOG = DimensionCatalog()
@@ -0,0 +1,207 @@
+# Shared HTML rendering for the report emails. Tables are built from rows of
+# cells through precompiled templates and joined chunk by chunk, and cells
+# carry a CSS class from STYLESHEET instead of repeating inline styles.
+import contextlib
+import contextvars
+import csv
+import gzip
+import io
+import re
+
+STYLESHEET = """<style>
+table.report { border-collapse: collapse; width: 100%; }
+table.report th, table.report td { border: 1px solid black; padding: 8px; text-align: left; }
+table.report th { background-color: #F2F2F2; text-align: center; }
+table.report td.num { text-align: center; }
+table.report .total { font-weight: bold; text-align: center; background-color: #F2F2F2; }
+table.report td.up { color: green; }
+table.report td.down { color: red; }
+table.report td.anomaly { background-color: #FFE8A3; font-weight: bold; }
+</style>"""
+
+# Stylesheet for compact tables, whose cells carry no 'num' class
+COMPACT_STYLESHEET = '<style>table.compact td { text-align: center; }</style>'
+
+# Rows joined into each chunk yielded by iter_table
+ROWS_PER_CHUNK = 500
+
+_TEMPLATES = {}
+
+# Bytes of the class attribute compact rows leave out of each numeric cell,
+# and the bytes compact tables add to their opening tag
+_NUM_CLASS_BYTES = len(' class="num"')
+_COMPACT_CLASS_BYTES = len(' compact')
+
+# Function to return the precompiled formatter for a tag and CSS class
+def _template(tag, cls):
+    template = _TEMPLATES.get((tag, cls))
+    if template is None:
+        if cls:
+            template = f'<{tag} class="{cls}">{{}}</{tag}>'.format
+        else:
+            template = f'<{tag}>{{}}</{tag}>'.format
+        _TEMPLATES[(tag, cls)] = template
+    return template
+
+# Function to render one row; a cell is either a value or a (value, css_class) pair
+def render_row(cells, tag='td'):
+    parts = ['<tr>']
+    for cell in cells:
+        if isinstance(cell, tuple):
+            parts.append(_template(tag, cell[1])(cell[0]))
+        else:
+            parts.append(_template(tag, None)(cell))
+    parts.append('</tr>')
+    return ''.join(parts)
+
+# Function to render one row for a compact table, where the stylesheet centres
+# every cell and the per-cell 'num' class is left out
+def render_compact_row(cells, tag='td'):
+    parts = ['<tr>']
+    for cell in cells:
+        if isinstance(cell, tuple) and cell[1] != 'num':
+            parts.append(_template(tag, cell[1])(cell[0]))
+        else:
+            parts.append(_template(tag, None)(cell[0] if isinstance(cell, tuple) else cell))
+    parts.append('</tr>')
+    return ''.join(parts)
+
+# Options for the tables rendered inside a rendering() block. With capture
+# set, the cell values of every table are also written to a gzip'd CSV.
+# saved_bytes counts the HTML that compact mode left out, net of what it added.
+class RenderState:
+    def __init__(self, compact=False, capture=False):
+        self.compact = compact
+        self.tables = 0
+        self.saved_bytes = 0
+        self._csv_buffer = None
+        self._csv_file = None
+        self._csv_writer = None
+        if capture:
+            self._csv_buffer = io.BytesIO()
+            self._csv_file = io.TextIOWrapper(gzip.GzipFile(fileobj=self._csv_buffer, mode='wb'), encoding='utf-8', newline='')
+            self._csv_writer = csv.writer(self._csv_file)
+
+    def capture_row(self, cells):
+        if self._csv_writer is not None:
+            self._csv_writer.writerow(cell[0] if isinstance(cell, tuple) else cell for cell in cells)
+
+    def start_table(self):
+        if self._csv_writer is not None and self.tables:
+            self._csv_writer.writerow([])
+        self.tables += 1
+
+    # Function to finish the CSV and return its gzip'd bytes, or None when nothing was captured
+    def csv_gzip(self):
+        if self._csv_file is None or not self.tables:
+            return None
+        if not self._csv_file.closed:
+            self._csv_file.close()
+        return self._csv_buffer.getvalue()
+
+_STATE = contextvars.ContextVar('html_render_state', default=None)
+
+# Context manager that applies rendering options to every table rendered inside it
+@contextlib.contextmanager
+def rendering(compact=False, capture=False):
+    state = RenderState(compact, capture)
+    token = _STATE.set(state)
+    try:
+        yield state
+    finally:
+        _STATE.reset(token)
+
+# Function to yield a table as HTML chunks; rows may be a generator, so the
+# table never has to exist in memory as a whole
+def iter_table(header, rows, rows_per_chunk=ROWS_PER_CHUNK):
+    state = _STATE.get()
+    compact = state is not None and state.compact
+    row_renderer = render_compact_row if compact else render_row
+    if state is not None:
+        state.start_table()
+        state.capture_row(header)
+        if compact:
+            state.saved_bytes -= _COMPACT_CLASS_BYTES
+
+    chunk = ['<table class="report compact">' if compact else '<table class="report">', row_renderer(header, 'th')]
+    for row in rows:
+        if state is not None:
+            state.capture_row(row)
+            if compact:
+                state.saved_bytes += _NUM_CLASS_BYTES * sum(1 for cell in row if isinstance(cell, tuple) and cell[1] == 'num')
+        chunk.append(row_renderer(row))
+        if len(chunk) >= rows_per_chunk:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append('</table>')
+    yield ''.join(chunk)
+
+# Function to render a whole table as one string
+def render_table(header, rows):
+    return ''.join(iter_table(header, rows))
+
+# Function to wrap rendered parts in an HTML document carrying the stylesheet
+def render_document(*parts):
+    state = _STATE.get()
+    stylesheet = STYLESHEET
+    if state is not None and state.compact:
+        stylesheet += COMPACT_STYLESHEET
+        state.saved_bytes -= len(COMPACT_STYLESHEET)
+    return ''.join(['<html><head>', stylesheet, '</head><body>', *parts, '</body></html>'])
+
+_TABLE = re.compile(r'(<table[^>]*>(?:<tr>.*?</tr>)?)(.*?)</table>', re.S)
+_ROW = re.compile(r'<tr>.*?</tr>', re.S)
+
+def _size(text):
+    return len(text.encode('utf-8'))
+
+# Function to split a document from render_document into documents of at most
+# max_bytes each. Tables are broken between rows and every part repeats the
+# table's header row; a single row larger than max_bytes still gets a part.
+def split_document(document, max_bytes):
+    if _size(document) <= max_bytes:
+        return [document]
+
+    head_end = document.index('<body>') + len('<body>')
+    tail_start = document.rindex('</body>')
+    head, body, tail = document[:head_end], document[head_end:tail_start], document[tail_start:]
+    overhead = _size(head) + _size(tail)
+
+    parts = []
+    current = []
+    size = overhead
+
+    def add(text):
+        nonlocal current, size
+        if current and size + _size(text) > max_bytes:
+            parts.append(head + ''.join(current) + tail)
+            current = []
+            size = overhead
+        current.append(text)
+        size += _size(text)
+
+    position = 0
+    for table in _TABLE.finditer(body):
+        if table.start() > position:
+            add(body[position:table.start()])
+        table_open = table.group(1)
+        add(table_open)
+        rows_in_part = 0
+        for row in _ROW.findall(table.group(2)):
+            row_size = _size(row)
+            if rows_in_part and size + row_size + _size('</table>') > max_bytes:
+                current.append('</table>')
+                parts.append(head + ''.join(current) + tail)
+                current = [table_open]
+                size = overhead + _size(table_open)
+                rows_in_part = 0
+            current.append(row)
+            size += row_size
+            rows_in_part += 1
+        current.append('</table>')
+        size += _size('</table>')
+        position = table.end()
+    if position < len(body):
+        add(body[position:])
+    parts.append(head + ''.join(current) + tail)
+    return parts
@@ -0,0 +1,202 @@
+import contextlib
+import functools
+import json
+import threading
+import time
+from collections import defaultdict
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Error codes AWS uses to signal throttling
+THROTTLING_CODES = (
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'LimitExceededException',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'Throttled',
+)
+
+# Cost Explorer bills every API request
+CE_REQUEST_PRICE_USD = 0.01
+
+NAMESPACE = 'BillingReports'
+
+def _bucket_label(index):
+    if index < len(LATENCY_BUCKETS_MS):
+        return f"le_{LATENCY_BUCKETS_MS[index]}"
+    return 'gt_' + str(LATENCY_BUCKETS_MS[-1])
+
+# Per (service, operation) counters for the calls made by instrumented clients
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.throttles = 0
+        self.errors = 0
+        self.latency_total_ms = 0.0
+        self.latency_max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add_latency(self, latency_ms):
+        self.latency_total_ms += latency_ms
+        self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and latency_ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.histogram[index] += 1
+
+# Collects call metrics from botocore's before-call, response-received and
+# after-call events. Latency covers the whole call including retries; every
+# HTTP attempt is counted and checked for throttling. Retries are made by
+# call_with_retry, which runs each call inside call(), so its attempts are
+# counted as one call.
+class ApiMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(OperationStats)
+        self._local = threading.local()
+
+    def _before_call(self, model, context, **kwargs):
+        started = time.perf_counter()
+        context['instrumentation'] = (model.service_model.service_name, model.name, started)
+        call = getattr(self._local, 'call', None)
+        if call is not None:
+            call['operation'] = (model.service_model.service_name, model.name)
+            call['attempts'] += 1
+            call['started'] = call['started'] or started
+
+    def _response_received(self, context, parsed_response=None, exception=None, **kwargs):
+        call = context.get('instrumentation')
+        if call is None:
+            return
+        code = (parsed_response or {}).get('Error', {}).get('Code')
+        with self._lock:
+            stats = self._stats[call[:2]]
+            stats.attempts += 1
+            if code in THROTTLING_CODES:
+                stats.throttles += 1
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        self._finish(context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                     http_response.status_code >= 300)
+
+    def _after_call_error(self, context, **kwargs):
+        self._finish(context, 0, True)
+
+    def _finish(self, context, retries, failed):
+        call = context.pop('instrumentation', None)
+        # Inside call() the attempt is counted when the whole call is done
+        if call is None or getattr(self._local, 'call', None) is not None:
+            return
+        service, operation, started = call
+        self._record(service, operation, started, retries, failed)
+
+    def _record(self, service, operation, started, retries, failed):
+        latency_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats[(service, operation)]
+            stats.calls += 1
+            stats.retries += retries
+            stats.errors += int(failed)
+            stats.add_latency(latency_ms)
+
+    # Function to count the attempts made inside as one call; every attempt after the first is a retry
+    @contextlib.contextmanager
+    def call(self):
+        previous = getattr(self._local, 'call', None)
+        call = self._local.call = {'operation': None, 'attempts': 0, 'started': None}
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self._local.call = previous
+            if call['operation'] is not None:
+                self._record(*call['operation'], call['started'], call['attempts'] - 1, failed)
+
+    # Function to register the handlers on a client; clients without botocore events are left alone
+    def instrument(self, client):
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return client
+        events.register('before-call', self._before_call, unique_id='instrumentation-before-call')
+        events.register('response-received', self._response_received, unique_id='instrumentation-response-received')
+        events.register('after-call', self._after_call, unique_id='instrumentation-after-call')
+        events.register('after-call-error', self._after_call_error, unique_id='instrumentation-after-call-error')
+        return client
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset(self):
+        with self._lock:
+            self._stats = defaultdict(OperationStats)
+
+    # Function to build one embedded-metric-format document per (service, operation)
+    def summary(self, report):
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for (service, operation), stats in sorted(self.snapshot().items()):
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': NAMESPACE,
+                        'Dimensions': [['Report', 'Service', 'Operation']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Attempts', 'Unit': 'Count'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'Throttles', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'LatencyTotal', 'Unit': 'Milliseconds'},
+                            {'Name': 'LatencyMax', 'Unit': 'Milliseconds'},
+                        ],
+                    }],
+                },
+                'Report': report,
+                'Service': service,
+                'Operation': operation,
+                'Calls': stats.calls,
+                'Attempts': stats.attempts,
+                'Retries': stats.retries,
+                'Throttles': stats.throttles,
+                'Errors': stats.errors,
+                'LatencyTotal': round(stats.latency_total_ms, 3),
+                'LatencyMax': round(stats.latency_max_ms, 3),
+                'LatencyHistogram': {_bucket_label(i): count for i, count in enumerate(stats.histogram)},
+            }
+            if service == 'ce':
+                document['EstimatedCostUSD'] = round(stats.calls * CE_REQUEST_PRICE_USD, 2)
+            documents.append(document)
+        return documents
+
+    # Function to print the summary, one JSON document per line, and start counting afresh
+    def flush(self, report):
+        documents = self.summary(report)
+        for document in documents:
+            print(json.dumps(document, separators=(',', ':')))
+        self.reset()
+        return documents
+
+# Shared by every client of the invocation
+METRICS = ApiMetrics()
+
+# Function to instrument a client with the shared metrics
+def instrument(client):
+    return METRICS.instrument(client)
+
+# Function to decorate a Lambda handler so the per-API call counts, latency,
+# retries and throttles are printed as embedded metrics when it returns, and
+# also when it fails, when they matter most
+def flush_metrics(report):
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                METRICS.flush(report)
+        return wrapper
+    return decorate
@@ -0,0 +1,185 @@
+import glob
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from cost_columns import CostColumns
+from cost_store import KEY_SEPARATOR, query_shape, query_scope
+from pagination import iter_cost_and_usage_pages
+
+SNAPSHOT_DIR = os.environ.get('MONTH_SNAPSHOT_DIR', '/tmp/month_snapshots')
+
+# Days after a month ends before Cost Explorer stops restating it
+CLOSE_AFTER_DAYS = int(os.environ.get('MONTH_SNAPSHOT_CLOSE_AFTER_DAYS', '5'))
+
+# Function to return the first day of the month after the given date
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+# Function to list the first day of every month overlapping [start, end)
+def iter_months(start, end):
+    month = start.replace(day=1)
+    while month < end:
+        yield month
+        month = next_month(month)
+
+# Function to check whether a month is past the restatement window
+def is_closed(month, today=None):
+    today = today or datetime.utcnow()
+    return today >= next_month(month) + timedelta(days=CLOSE_AFTER_DAYS)
+
+def _checksum(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Immutable per-month snapshots of closed months, one JSON file per
+# (scope, metric, dimension, month). Each file carries a checksum of its
+# payload; a snapshot that fails the check is deleted and fetched again.
+class MonthSnapshots:
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, scope, metric, dimension, month):
+        return os.path.join(self.directory, f"{scope}-{metric}-{dimension}-{month.strftime('%Y-%m')}.json")
+
+    def load(self, scope, metric, dimension, month):
+        path = self._path(scope, metric, dimension, month)
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            if snapshot.get('checksum') == _checksum(snapshot.get('payload')):
+                return snapshot['payload']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            pass
+        print(f"Discarding corrupted month snapshot {path}")
+        self._remove(path)
+        return None
+
+    def exists(self, scope, metric, dimension, month):
+        return os.path.exists(self._path(scope, metric, dimension, month))
+
+    # Function to write a snapshot once; an existing valid snapshot is never overwritten
+    def save(self, scope, metric, dimension, month, payload):
+        path = self._path(scope, metric, dimension, month)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'checksum': _checksum(payload), 'payload': payload}, f, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    # Function to delete snapshots; every argument left as None matches all values
+    def invalidate(self, scope=None, metric=None, dimension=None, month=None):
+        pattern = '-'.join([
+            scope or '*', metric or '*', dimension or '*', month.strftime('%Y-%m') if month else '*'
+        ]) + '.json'
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, pattern)):
+            self._remove(path)
+            removed += 1
+        return removed
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+_SNAPSHOTS = None
+
+# Function to return the module-scope snapshot cache
+def get_snapshots():
+    global _SNAPSHOTS
+    if _SNAPSHOTS is None:
+        _SNAPSHOTS = MonthSnapshots()
+    return _SNAPSHOTS
+
+# Function to return how many months fetch_monthly would request from Cost
+# Explorer, from the first month without a snapshot for every metric to the
+# end, checking only that the snapshot files exist
+def months_to_fetch(snapshots, start_date, end_date, metrics, dimension, filter=None):
+    metrics, dimensions, dimension = query_shape(metrics, dimension)
+    scope = query_scope(filter)
+    months = list(iter_months(start_date, end_date))
+    for n, month in enumerate(months):
+        if not is_closed(month) or not all(snapshots.exists(scope, metric, dimension, month) for metric in metrics):
+            return len(months) - n
+    return 0
+
+# Function to fetch one or more metrics grouped by one dimension at MONTHLY
+# granularity. Closed months are served from snapshots and only the open
+# months (plus any closed month without a valid snapshot for every metric) are
+# requested from Cost Explorer, all metrics in the same request. Returns
+# (CostColumns in Cost Explorer order, labels); the columns iterate as
+# (key, month start, amount, unit) rows of the first metric. With two
+# dimensions, such as ('LINKED_ACCOUNT', 'SERVICE'), the key is a tuple.
+def fetch_monthly(ce_client, snapshots, start_date, end_date, metrics, dimension, filter=None):
+    metrics, dimensions, dimension = query_shape(metrics, dimension)
+    start_date = datetime.strptime(start_date.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    end_date = datetime.strptime(end_date.strftime('%Y-%m-%d'), '%Y-%m-%d')
+    scope = query_scope(filter)
+
+    payloads = {}
+    to_fetch = []
+    for month in iter_months(start_date, end_date):
+        month_payloads = {}
+        if is_closed(month):
+            for metric in metrics:
+                payload = snapshots.load(scope, metric, dimension, month)
+                if payload is None:
+                    break
+                month_payloads[metric] = payload
+        if len(month_payloads) < len(metrics):
+            to_fetch.append(month)
+        else:
+            payloads[month] = month_payloads
+
+    if to_fetch:
+        fetch_start = max(start_date, to_fetch[0])
+        params = {
+            'TimePeriod': {'Start': fetch_start.strftime('%Y-%m-%d'), 'End': end_date.strftime('%Y-%m-%d')},
+            'Granularity': 'MONTHLY',
+            'Metrics': list(metrics),
+            'GroupBy': [{'Type': 'DIMENSION', 'Key': key} for key in dimensions],
+        }
+        if filter:
+            params['Filter'] = filter
+
+        fetched = {month: {metric: {'rows': [], 'labels': {}} for metric in metrics} for month in to_fetch}
+        for page in iter_cost_and_usage_pages(ce_client, **params):
+            labels = {a['Value']: a.get('Attributes', {}).get('description')
+                      for a in page.get('DimensionValueAttributes', [])}
+            for result_by_time in page['ResultsByTime']:
+                date = result_by_time['TimePeriod']['Start']
+                month = datetime.strptime(date, '%Y-%m-%d').replace(day=1)
+                if month not in fetched:
+                    continue
+                for group in result_by_time.get('Groups', []):
+                    key = KEY_SEPARATOR.join(group['Keys'])
+                    for metric in metrics:
+                        value = group['Metrics'][metric]
+                        fetched[month][metric]['rows'].append([key, date, float(value['Amount']), value['Unit']])
+                        for part in group['Keys']:
+                            if labels.get(part):
+                                fetched[month][metric]['labels'][part] = labels[part]
+
+        for month, month_payloads in fetched.items():
+            if is_closed(month):
+                for metric, payload in month_payloads.items():
+                    snapshots.save(scope, metric, dimension, month, payload)
+            payloads[month] = month_payloads
+
+        print(f"Month snapshots: fetched {len(to_fetch)} month(s) from Cost Explorer, reused {len(payloads) - len(to_fetch)} snapshot(s)")
+
+    rows = {metric: [] for metric in metrics}
+    labels = {}
+    for month in sorted(payloads):
+        for metric in metrics:
+            rows[metric].extend(tuple(row) for row in payloads[month][metric]['rows'])
+            labels.update(payloads[month][metric]['labels'])
+    if len(dimensions) > 1:
+        rows = {metric: [(tuple(key.split(KEY_SEPARATOR)), date, amount, unit) for key, date, amount, unit in metric_rows]
+                for metric, metric_rows in rows.items()}
+    return CostColumns.from_rows(rows), labels
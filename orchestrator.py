@@ -0,0 +1,90 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from data_export import export_report
+from query_planner import execute_query
+from report_email import render_email
+from report_specs import load_renderer
+
+# Threads for the blocking fetch, render, send and export stages
+MAX_WORKERS = int(os.environ.get('ORCHESTRATOR_MAX_WORKERS', '8'))
+
+# Function to turn a report's rows into its records and its email subject, HTML body and attachment
+def render(spec, rows, labels, start_date, end_date, report_context, compact=False):
+    renderer = load_renderer(spec)
+    records = renderer.rows_to_records(rows, labels) if spec.labels else renderer.rows_to_records(rows)
+    return records, render_email(lambda: renderer.render_report(records, start_date, end_date, report_context), compact)
+
+# Function to stream a report's records to the export sink, if one is configured
+def export(spec, records, end_date, report_context):
+    renderer = load_renderer(spec)
+    return export_report(spec.renderer, renderer.export_records(records, report_context), end_date)
+
+# Function to run a query once the context lookups it needs are done
+async def fetch_with_context(query, lookups, run):
+    context = [await lookups[name] for name in query.context]
+    return await run(query.execute, *context)
+
+# Function to wait for a report's data and context, then render, send and export it
+async def run_report(spec, start_date, end_date, fetch, lookups, report_context, send, run, compact=False):
+    started = time.perf_counter()
+    rows, labels = (await fetch)[spec.name]
+    for name in spec.context:
+        await lookups[name]
+    ready = time.perf_counter()
+
+    records, (subject, body_html, attachment) = await run(render, spec, rows, labels, start_date, end_date, report_context, compact)
+    rendered = time.perf_counter()
+    await run(send, subject, body_html, attachment)
+    sent = time.perf_counter()
+    await run(export, spec, records, end_date, report_context)
+    exported = time.perf_counter()
+
+    print(f"Report {spec.name}: data ready after {ready - started:.2f}s, "
+          f"rendered in {rendered - ready:.2f}s, sent in {sent - rendered:.2f}s, exported in {exported - sent:.2f}s")
+
+# Function to run every planned query and report as concurrent tasks.
+# Each query is fetched on the executor as soon as the run starts, along with
+# the context lookups (such as distribution discovery) the reports need; a
+# query that needs a lookup itself, like the CloudFront metrics, starts as
+# soon as that lookup is done. A
+# report renders and sends as soon as its own query and lookups are done, so
+# it overlaps with fetches still in flight. Returns (spec, error) per report;
+# error is None for reports that were sent. With compact set, every report is
+# rendered in compact mode with its data attached as gzip'd CSV.
+async def run_reports(queries, report_context, ce_client, send, max_workers=MAX_WORKERS, compact=False):
+    loop = asyncio.get_running_loop()
+    specs = [spec for query in queries for spec, start, end in query.targets]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def run(func, *args):
+            return loop.run_in_executor(executor, func, *args)
+
+        names = [name for spec in specs for name in spec.context]
+        names.extend(name for query in queries for name in query.context)
+        lookups = {}
+        for name in names:
+            if name not in lookups:
+                lookups[name] = run(getattr, report_context, name)
+
+        tasks = []
+        for query in queries:
+            if query.context:
+                fetch = asyncio.ensure_future(fetch_with_context(query, lookups, run))
+            else:
+                fetch = run(execute_query, query, ce_client)
+            for spec, start_date, end_date in query.targets:
+                tasks.append(run_report(spec, start_date, end_date, fetch, lookups, report_context, send, run, compact))
+
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        # A lookup nobody awaited because its reports failed first must not go unretrieved
+        await asyncio.gather(*lookups.values(), return_exceptions=True)
+
+    results = []
+    for spec, outcome in zip(specs, outcomes):
+        error = outcome if isinstance(outcome, BaseException) else None
+        if error is not None:
+            print(f"Report {spec.name} failed: {str(error)}")
+        results.append((spec, error))
+    return results
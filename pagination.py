@@ -0,0 +1,52 @@
+# Generators that follow AWS pagination tokens and yield results page by page,
+# so consumers can start work before the last page arrives and never hold
+# more than one page of raw response in memory.
+
+# Function to look up a dotted path such as 'DistributionList.NextMarker' in a response
+def _lookup(response, path):
+    for part in path.split('.'):
+        if not isinstance(response, dict):
+            return None
+        response = response.get(part)
+    return response
+
+# Function to call a paginated operation repeatedly and yield each response page
+def iter_pages(operation, token_param, token_path, **kwargs):
+    token = kwargs.pop(token_param, None)
+    while True:
+        params = dict(kwargs)
+        if token:
+            params[token_param] = token
+        page = operation(**params)
+        yield page
+        token = _lookup(page, token_path)
+        if not token:
+            return
+
+# Function to yield every account in the organization
+def iter_accounts(org_client, **kwargs):
+    for page in iter_pages(org_client.list_accounts, 'NextToken', 'NextToken', **kwargs):
+        yield from page.get('Accounts', [])
+
+# Function to yield every CloudFront distribution summary visible to the client
+def iter_distributions(cf_client, **kwargs):
+    for page in iter_pages(cf_client.list_distributions, 'Marker', 'DistributionList.NextMarker', **kwargs):
+        distribution_list = page.get('DistributionList', {})
+        yield from distribution_list.get('Items', [])
+        if not distribution_list.get('IsTruncated'):
+            return
+
+# Function to yield every page of a Cost Explorer get_cost_and_usage query
+def iter_cost_and_usage_pages(ce_client, **kwargs):
+    yield from iter_pages(ce_client.get_cost_and_usage, 'NextPageToken', 'NextPageToken', **kwargs)
+
+# Function to yield every MetricDataResults entry of a CloudWatch get_metric_data call.
+# A query whose data points span two pages is yielded once per page.
+def iter_metric_data_results(cw_client, **kwargs):
+    for page in iter_pages(cw_client.get_metric_data, 'NextToken', 'NextToken', **kwargs):
+        yield from page.get('MetricDataResults', [])
+
+# Function to yield every DimensionValues entry of a Cost Explorer get_dimension_values query
+def iter_dimension_values(ce_client, **kwargs):
+    for page in iter_pages(ce_client.get_dimension_values, 'NextPageToken', 'NextPageToken', **kwargs):
+        yield from page.get('DimensionValues', [])
@@ -0,0 +1,68 @@
+from collections import defaultdict
+
+# Indexes amounts by (row key, column) in a single pass over the records and
+# keeps row, column and grand totals up to date as values are added, so
+# rendering a table is one dictionary lookup per cell.
+class Pivot:
+    def __init__(self):
+        self.cells = {}
+        self.labels = {}
+        self.row_totals = defaultdict(float)
+        self.column_totals = defaultdict(float)
+        self.grand_total = 0.0
+
+    # Function to build a pivot from report records such as {'Date': ..., 'Account ID': ..., 'Amount': ...}
+    @classmethod
+    def from_records(cls, records, row_field, column_field, value_field='Amount', label_field=None):
+        pivot = cls()
+        for item in records:
+            label = item.get(label_field) if label_field else None
+            pivot.add(item[row_field], item[column_field], float(item[value_field]), label)
+        return pivot
+
+    def add(self, row, column, amount, label=None):
+        key = (row, column)
+        self.cells[key] = self.cells.get(key, 0.0) + amount
+        self.row_totals[row] += amount
+        self.column_totals[column] += amount
+        self.grand_total += amount
+        if label is not None and row not in self.labels:
+            self.labels[row] = label
+
+    @property
+    def rows(self):
+        return sorted(self.row_totals)
+
+    @property
+    def columns(self):
+        return sorted(self.column_totals)
+
+    def get(self, row, column, default=None):
+        return self.cells.get((row, column), default)
+
+    def label(self, row, default=None):
+        return self.labels.get(row, default)
+
+    def row_total(self, row):
+        return self.row_totals.get(row, 0.0)
+
+    def column_total(self, column):
+        return self.column_totals.get(column, 0.0)
+
+    # Function to add every cell of another pivot, so partial pivots built
+    # from disjoint slices of the data can be merged in any order
+    def merge(self, other):
+        for (row, column), amount in other.cells.items():
+            self.add(row, column, amount, other.labels.get(row))
+        return self
+
+    # Function to return the cells and labels as JSON-serializable data
+    def to_json(self):
+        return {'cells': [[row, column, amount] for (row, column), amount in self.cells.items()], 'labels': self.labels}
+
+    @classmethod
+    def from_json(cls, data):
+        pivot = cls()
+        for row, column, amount in data['cells']:
+            pivot.add(row, column, amount, data['labels'].get(row))
+        return pivot
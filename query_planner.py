@@ -0,0 +1,182 @@
+import math
+import os
+from ce_coalescer import canonical_request_key
+from cloudfront_metrics import DistributionMetricsQuery
+from cost_columns import CostColumns, report_metrics
+from cost_store import days_to_fetch, fetch_daily, get_store
+from dimension_catalog import CATALOG
+from month_snapshots import fetch_monthly, get_snapshots, is_closed, iter_months, months_to_fetch
+
+# Cost Explorer accepts at most two GroupBy keys per request
+MAX_GROUP_BY = 2
+
+# Rough number of distinct values per dimension, used to estimate result pages
+# when the dimension catalog has not listed the dimension yet
+ESTIMATED_KEYS = {
+    'LINKED_ACCOUNT': int(os.environ.get('PLANNER_ESTIMATED_ACCOUNTS', '50')),
+    'SERVICE': int(os.environ.get('PLANNER_ESTIMATED_SERVICES', '100')),
+    'USAGE_TYPE': int(os.environ.get('PLANNER_ESTIMATED_USAGE_TYPES', '300')),
+}
+DEFAULT_ESTIMATED_KEYS = 100
+
+# Rough number of groups Cost Explorer returns per page
+GROUPS_PER_PAGE = int(os.environ.get('PLANNER_GROUPS_PER_PAGE', '5000'))
+
+# Function to return the first month of [start, end) that is not closed yet, or end
+def _first_open_month(start, end):
+    return next((month for month in iter_months(start, end) if not is_closed(month)), end)
+
+# One planned Cost Explorer query and the report specs it serves. Each spec is
+# kept with its own (start, end) so results can be cut back to its period.
+# The query runs through the cost store and the month snapshots: closed
+# months of its MONTHLY specs come from fetch_monthly, and everything from
+# daily_start on from fetch_daily, so only the days and months missing from
+# them are requested.
+class PlannedQuery:
+    # ReportContext attributes the query needs before it can run
+    context = ()
+
+    def __init__(self, filter, dimensions, metrics, granularity, start, end, targets, store=None, snapshots=None):
+        self.filter = filter
+        self.dimensions = tuple(dimensions)
+        self.metrics = tuple(sorted(metrics))
+        self.granularity = granularity
+        self.start = start
+        self.end = end
+        self.targets = targets
+        self.store = store or get_store()
+        self.snapshots = snapshots or get_snapshots()
+
+    @classmethod
+    def for_spec(cls, spec, start, end, store=None, snapshots=None):
+        return cls(spec.filter, [spec.dimension], report_metrics(spec.metric), spec.granularity, start, end,
+                   [(spec, start, end)], store, snapshots)
+
+    # First day fetched at DAILY granularity, or None when every spec is
+    # MONTHLY. Next to DAILY specs, MONTHLY specs are only served from
+    # snapshots up to their first month that is not closed; from that month
+    # on they are rolled up from the days.
+    @property
+    def daily_start(self):
+        daily = [start for spec, start, end in self.targets if spec.granularity == 'DAILY']
+        if not daily:
+            return None
+        monthly = [_first_open_month(start, end) for spec, start, end in self.targets if spec.granularity == 'MONTHLY']
+        if not monthly:
+            return min(daily)
+        return min(daily + monthly).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    # Function to estimate the number of billed requests, one per result page,
+    # counting only the months and days the snapshots and the store do not have
+    def estimated_requests(self):
+        keys = 1
+        for dimension in self.dimensions:
+            keys *= CATALOG.cached_count(dimension) or ESTIMATED_KEYS.get(dimension, DEFAULT_ESTIMATED_KEYS)
+        daily_start = self.daily_start
+        monthly_end = daily_start or self.end
+        months = 0
+        if self.start < monthly_end:
+            months = months_to_fetch(self.snapshots, self.start, monthly_end, self.metrics, self.dimensions, self.filter)
+        days = 0
+        if daily_start is not None:
+            days = days_to_fetch(self.store, daily_start, self.end, self.metrics, self.dimensions, self.filter)
+        return sum(math.ceil(periods * keys / GROUPS_PER_PAGE) for periods in (months, days))
+
+    # Function to combine two queries into one, or None when Cost Explorer cannot serve both at once
+    def merge(self, other):
+        if canonical_request_key('filter', self.filter) != canonical_request_key('filter', other.filter):
+            return None
+        dimensions = list(self.dimensions)
+        dimensions.extend(d for d in other.dimensions if d not in dimensions)
+        if len(dimensions) > MAX_GROUP_BY:
+            return None
+        # MONTHLY figures can be derived from DAILY ones, never the other way round
+        granularity = 'DAILY' if 'DAILY' in (self.granularity, other.granularity) else 'MONTHLY'
+        return PlannedQuery(
+            self.filter, dimensions, set(self.metrics) | set(other.metrics), granularity,
+            min(self.start, other.start), max(self.end, other.end), self.targets + other.targets,
+            self.store, self.snapshots,
+        )
+
+    def describe(self):
+        names = ', '.join(spec.name for spec, start, end in self.targets)
+        daily_start = self.daily_start
+        granularity = 'MONTHLY+DAILY' if daily_start is not None and self.start < daily_start else self.granularity
+        return (f"{granularity} {'+'.join(self.dimensions)} {'+'.join(self.metrics)} "
+                f"{self.start:%Y-%m-%d}..{self.end:%Y-%m-%d} (~{self.estimated_requests()} requests) for {names}")
+
+# Function to merge the (spec, start, end) requests into the fewest estimated
+# Cost Explorer requests. Pairs are merged greedily, best saving first, for as
+# long as a merged query is estimated to cost no more than the two it replaces,
+# given what the store and the snapshots already hold. Specs sourced from
+# CloudWatch share one DistributionMetricsQuery, except HOURLY ones, which get
+# their own so the others are not fetched by the hour.
+def plan(requests, store=None, snapshots=None):
+    queries = _plan_cost_explorer(
+        [(spec, start, end) for spec, start, end in requests if spec.source != 'cloudwatch'], store, snapshots
+    )
+    for hourly in (False, True):
+        metric_targets = [
+            (spec, start, end) for spec, start, end in requests
+            if spec.source == 'cloudwatch' and (spec.granularity == 'HOURLY') == hourly
+        ]
+        if metric_targets:
+            queries.append(DistributionMetricsQuery(metric_targets, hourly))
+    return queries
+
+def _plan_cost_explorer(requests, store=None, snapshots=None):
+    queries = [PlannedQuery.for_spec(spec, start, end, store, snapshots) for spec, start, end in requests]
+    while True:
+        best = None
+        for i in range(len(queries)):
+            for j in range(i + 1, len(queries)):
+                merged = queries[i].merge(queries[j])
+                if merged is None:
+                    continue
+                saving = queries[i].estimated_requests() + queries[j].estimated_requests() - merged.estimated_requests()
+                if saving >= 0 and (best is None or saving > best[0]):
+                    best = (saving, i, j, merged)
+        if best is None:
+            return queries
+        saving, i, j, merged = best
+        queries = [q for k, q in enumerate(queries) if k not in (i, j)] + [merged]
+
+# Function to run one planned query and cut its results back per spec.
+# Returns {spec name: (CostColumns, labels)}; the columns hold every metric
+# of the spec and iterate as (key, date, amount, unit) rows of its own metric,
+# in date order and, within a date, in the order Cost Explorer returned them.
+def execute_query(query, ce_client):
+    print(f"Query plan: {query.describe()}")
+    daily_start = query.daily_start
+    parts = []
+    labels = {}
+    if daily_start is None or query.start < daily_start:
+        columns, monthly_labels = fetch_monthly(ce_client, query.snapshots, query.start, daily_start or query.end,
+                                                query.metrics, query.dimensions, query.filter)
+        parts.append(('MONTHLY', columns))
+        labels.update(monthly_labels)
+    if daily_start is not None:
+        columns = fetch_daily(ce_client, query.store, daily_start, query.end, query.metrics, query.dimensions, query.filter)
+        parts.append(('DAILY', columns))
+        labels.update(query.store.labels(','.join(query.dimensions)))
+
+    results = {}
+    for spec, start, end in query.targets:
+        position = query.dimensions.index(spec.dimension)
+        metrics = report_metrics(spec.metric)
+        first, last = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+        view = CostColumns(metrics)
+        for granularity, columns in parts:
+            if granularity == 'MONTHLY' and spec.granularity == 'DAILY':
+                continue
+            amounts = [columns.column(metric) for metric in metrics]
+            for i, date in enumerate(columns.dates):
+                if not first <= date < last:
+                    continue
+                # Days are rolled up into months, each starting no earlier than the spec
+                if granularity == 'DAILY' and spec.granularity == 'MONTHLY':
+                    date = max(date[:8] + '01', first)
+                key = columns.keys[i][position] if len(query.dimensions) > 1 else columns.keys[i]
+                view.add(key, date, columns.units[i], {metric: column[i] for metric, column in zip(metrics, amounts)})
+        results[spec.name] = (view, labels)
+    return results
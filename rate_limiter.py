@@ -0,0 +1,164 @@
+import functools
+import os
+import random
+import threading
+import time
+from instrumentation import METRICS, THROTTLING_CODES
+
+# Starting (and highest) request rate per service, in requests per second.
+# Override with RATE_LIMIT_<SERVICE>, e.g. RATE_LIMIT_CE=2.
+DEFAULT_RATES = {
+    'ce': 5.0,
+    'sts': 200.0,
+    'organizations': 5.0,
+    'cloudfront': 10.0,
+    'ses': 14.0,
+    'cloudwatch': 20.0,
+    's3': 100.0,
+}
+FALLBACK_RATE = 10.0
+MIN_RATE = 0.1
+
+# Additive increase per success as a fraction of the ceiling, multiplicative decrease on throttling
+INCREASE_FRACTION = 0.05
+DECREASE_FACTOR = 0.5
+# A burst of throttles from calls already in flight only lowers the rate once per cooldown
+DECREASE_COOLDOWN = 1.0
+
+MAX_ATTEMPTS = int(os.environ.get('RATE_LIMIT_MAX_ATTEMPTS', '8'))
+BASE_BACKOFF = 0.25
+MAX_BACKOFF = 20.0
+
+# botocore does not retry on its own (see aws_clients), so transient
+# failures are retried here too, without lowering the rate
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+TRANSIENT_ERRORS = ('EndpointConnectionError', 'ConnectionClosedError', 'ConnectTimeoutError', 'ReadTimeoutError')
+
+# Function to check whether an exception is AWS throttling
+def is_throttle(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_CODES
+
+# Function to check whether an exception is a server error or a dropped connection worth retrying
+def is_transient(error):
+    response = getattr(error, 'response', None) or {}
+    if response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUS_CODES:
+        return True
+    return type(error).__name__ in TRANSIENT_ERRORS
+
+# Function to pick a retry delay with full jitter
+def backoff(attempt):
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+# Token bucket whose rate adapts to throttling: it halves when AWS throttles
+# and climbs back towards the ceiling with every success. Callers reserve a
+# token under a short lock and wait outside it.
+class AdaptiveTokenBucket:
+    def __init__(self, name, rate, burst=None, min_rate=MIN_RATE):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    # Function to take a token and return how long the caller must wait before using it
+    def _reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE_FRACTION)
+
+    def on_throttle(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            # Drain the bucket so calls already queued back off as well
+            self._tokens = min(self._tokens, 0.0)
+            rate = self.rate
+        print(f"Rate limiter {self.name}: throttled, lowering rate to {rate:.2f} requests/s")
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+# Function to return the shared limiter of a (service, region). AWS throttles
+# per calling account, so clients of assumed roles pass the account as scope.
+def get_limiter(service, region, scope=None):
+    key = (service, region, scope)
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is None:
+            rate = float(os.environ.get(f'RATE_LIMIT_{service.upper()}', DEFAULT_RATES.get(service, FALLBACK_RATE)))
+            limiter = AdaptiveTokenBucket('/'.join(part for part in key if part), rate)
+            _LIMITERS[key] = limiter
+        return limiter
+
+# Function to call an operation through a limiter, retrying throttled and
+# transient failures with jittered backoff; only throttling lowers the rate.
+# With transient off only throttling is retried, for calls such as a Lambda
+# invoke that may already have done their work when the connection drops.
+# The attempts are counted in METRICS as one call with retries.
+def call_with_retry(limiter, operation, *args, transient=True, **kwargs):
+    with METRICS.call():
+        attempt = 1
+        while True:
+            limiter.acquire()
+            try:
+                response = operation(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttle(e)
+                if not (throttled or (transient and is_transient(e))) or attempt >= MAX_ATTEMPTS:
+                    raise
+                if throttled:
+                    limiter.on_throttle()
+                time.sleep(backoff(attempt))
+                attempt += 1
+                continue
+            limiter.on_success()
+            return response
+
+# Wraps a client so every API operation goes through the (service, region)
+# limiter and is retried on throttling. Paginators built on the wrapped
+# methods and the STS credential cache inherit the limits from the client
+# they are given. Clients built with retry_transient off do not retry
+# server errors and dropped connections.
+class RateLimitedClient:
+    def __init__(self, client, service=None, region=None, scope=None, retry_transient=True):
+        meta = getattr(client, 'meta', None)
+        self._client = client
+        self._retry_transient = retry_transient
+        self._operations = getattr(meta, 'method_to_api_mapping', None)
+        service = service or getattr(getattr(meta, 'service_model', None), 'service_name', None) or getattr(client, 'service_name', 'unknown')
+        region = region or getattr(meta, 'region_name', None) or 'us-east-1'
+        self.limiter = get_limiter(service, region, scope)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        if self._operations is not None and name not in self._operations:
+            return attribute
+        return functools.partial(call_with_retry, self.limiter, attribute, transient=self._retry_transient)
+
+# Function to put a client behind its shared rate limiter
+def rate_limited(client, scope=None, retry_transient=True):
+    if isinstance(client, RateLimitedClient):
+        return client
+    return RateLimitedClient(client, scope=scope, retry_transient=retry_transient)
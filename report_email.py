@@ -0,0 +1,141 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email import charset
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from aws_clients import get_client
+from data_export import export_report
+from html_render import rendering, split_document
+
+# HTML per email before a report is split into parts. SES accepts messages
+# of up to 10 MB after encoding, which leaves room for the CSV attachment.
+SPLIT_BYTES = int(os.environ.get('EMAIL_SPLIT_BYTES', str(4 * 1024 * 1024)))
+MAX_MESSAGE_BYTES = 10 * 1024 * 1024
+
+# Emails of a batch in flight at once; the SES rate limiter paces them further
+SEND_MAX_WORKERS = int(os.environ.get('EMAIL_SEND_MAX_WORKERS', '8'))
+
+# Quoted-printable keeps mostly-ASCII HTML close to its original size, where base64 adds a third
+_UTF8_QP = charset.Charset('utf-8')
+_UTF8_QP.body_encoding = charset.QP
+
+# Function to read the compact mode switch from the event, then the environment
+def compact_mode(event=None):
+    value = (event or {}).get('compact')
+    if value is None:
+        value = os.environ.get('REPORT_EMAIL_COMPACT', '')
+    return str(value).lower() in ('1', 'true', 'yes')
+
+# Function to run a report's render function inside the chosen rendering mode.
+# Returns (subject, body_html, attachment); in compact mode the attachment is
+# the full table data as gzip'd CSV, otherwise it is None.
+def render_email(render, compact=False):
+    with rendering(compact=compact, capture=compact) as state:
+        subject, body_html = render()
+    if not compact:
+        return subject, body_html, None
+
+    html_bytes = len(body_html.encode('utf-8'))
+    print(f"Compact email '{subject}': {html_bytes + state.saved_bytes} bytes of HTML before, {html_bytes} after")
+    return subject, body_html, state.csv_gzip()
+
+# Function to build a file name from the report subject
+def attachment_name(subject):
+    return re.sub(r'[^A-Za-z0-9]+', '-', subject).strip('-') + '.csv.gz'
+
+def _raw_message(subject, sender, recipient, body_html=None, attachment=None, filename=None):
+    message = MIMEMultipart('mixed')
+    message['Subject'] = subject
+    message['From'] = sender
+    message['To'] = recipient
+    if body_html is not None:
+        message.attach(MIMEText(body_html, 'html', _UTF8_QP))
+    if attachment is not None:
+        part = MIMEApplication(attachment, 'gzip')
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        message.attach(part)
+    return message.as_bytes()
+
+# Function to send a report email. Bodies above split_bytes are split into
+# numbered parts, and an attachment is sent with send_raw_email on the first
+# part, or on its own when the two would not fit one message.
+def send_report(subject, body_html, sender, recipient, attachment=None, split_bytes=SPLIT_BYTES, ses=None):
+    ses = ses or get_client('ses', region_name='us-east-1')
+    html_bytes = len(body_html.encode('utf-8'))
+    parts = split_document(body_html, split_bytes)
+
+    if len(parts) == 1 and attachment is None:
+        ses.send_email(
+            Source=sender,
+            Destination={'ToAddresses': [recipient]},
+            Message={
+                'Subject': {'Charset': 'UTF-8', 'Data': subject},
+                'Body': {'Html': {'Charset': 'UTF-8', 'Data': body_html}}
+            }
+        )
+        print(f"Email '{subject}': {html_bytes} bytes of HTML in one message")
+        return 1
+
+    filename = attachment_name(subject)
+    subjects = [subject] if len(parts) == 1 else [f'{subject} (part {number}/{len(parts)})' for number in range(1, len(parts) + 1)]
+    messages = [_raw_message(part_subject, sender, recipient, part) for part_subject, part in zip(subjects, parts)]
+    if attachment is not None:
+        first = _raw_message(subjects[0], sender, recipient, parts[0], attachment, filename)
+        if len(first) <= MAX_MESSAGE_BYTES:
+            messages[0] = first
+        else:
+            messages.append(_raw_message(f'{subject} (data)', sender, recipient, None, attachment, filename))
+
+    for raw in messages:
+        ses.send_raw_email(Source=sender, Destinations=[recipient], RawMessage={'Data': raw})
+
+    attachment_info = f", with a {len(attachment)} byte gzip CSV" if attachment is not None else ''
+    print(f"Email '{subject}': {html_bytes} bytes of HTML sent as {len(messages)} message(s) "
+          f"totalling {sum(len(raw) for raw in messages)} bytes{attachment_info}")
+    return len(messages)
+
+# Function to finish a report run: render it with render(), which returns
+# (subject, body_html), send it to the recipient, split into parts when the
+# body is too large for one message, and stream the records to the export
+# sink when an export format is configured. In compact mode the HTML is
+# trimmed and the full data attached as gzip'd CSV.
+def finish_report(report, render, records, end_date, sender, recipient, compact=False):
+    subject, body_html, attachment = render_email(render, compact)
+    send_report(subject, body_html, sender, recipient, attachment)
+    export_report(report, records, end_date)
+
+# Function to send a batch of report emails, given as (subject, body_html,
+# recipient, attachment) tuples, through one SES client. messages may be a
+# generator: each email is queued as soon as it is produced, so producing
+# the next overlaps with sending, and production waits while max_queued
+# are waiting to be sent. Up to max_workers are in flight at once and the
+# client's rate limiter keeps them under the SES sending rate, backing off
+# when throttled. Returns (subject, recipient, messages sent, error) per
+# email; a failed email never stops the others.
+def send_reports(messages, sender, max_workers=SEND_MAX_WORKERS, max_queued=None):
+    ses = get_client('ses', region_name='us-east-1')
+    queued = threading.BoundedSemaphore(max_queued or max_workers * 4)
+
+    def send(subject, body_html, recipient, attachment):
+        try:
+            return send_report(subject, body_html, sender, recipient, attachment, ses=ses)
+        finally:
+            queued.release()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Only the headers are kept, so each body is released once it is sent
+        pending = []
+        for subject, body_html, recipient, attachment in messages:
+            queued.acquire()
+            pending.append((subject, recipient, executor.submit(send, subject, body_html, recipient, attachment)))
+
+        results = []
+        for subject, recipient, future in pending:
+            try:
+                results.append((subject, recipient, future.result(), None))
+            except Exception as e:
+                results.append((subject, recipient, None, e))
+        return results
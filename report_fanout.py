@@ -0,0 +1,70 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from aws_clients import get_client
+from pagination import iter_accounts
+from report_email import send_reports
+
+# Processes rendering the per-account slices of a report
+RENDER_PROCESSES = int(os.environ.get('FANOUT_RENDER_PROCESSES', str(os.cpu_count() or 1)))
+
+# Function to read the per-account fan-out switch from the event, then the environment
+def fan_out_mode(event=None):
+    value = (event or {}).get('fan_out')
+    if value is None:
+        value = os.environ.get('REPORT_FAN_OUT', '')
+    return str(value).lower() in ('1', 'true', 'yes')
+
+# Function to map each active account to its owner, the email address the organization has for it
+def account_owners(accounts):
+    return {k['Id']: k['Email'] for k in accounts if k.get('Status') == 'ACTIVE' and k.get('Email')}
+
+# Function to split items into {account ID: [items]} in one pass, keeping their order
+def partition(items, account_of):
+    slices = {}
+    for item in items:
+        slices.setdefault(account_of(item), []).append(item)
+    return slices
+
+# Function to call render(account ID, slice) for every slice in a process
+# pool, so rendering uses every core. Lambda has no /dev/shm for the pool's
+# locks, and there the slices are rendered in this process instead. Yields
+# the results in the order of the slices as they are ready.
+def iter_rendered(render, slices, processes=RENDER_PROCESSES):
+    account_ids = list(slices)
+    if processes > 1 and len(account_ids) > 1:
+        processes = min(processes, len(account_ids))
+        try:
+            executor = ProcessPoolExecutor(processes)
+        except (OSError, NotImplementedError) as e:
+            print(f"Rendering slices in this process: {str(e)}")
+        else:
+            with executor:
+                chunksize = max(1, len(account_ids) // (processes * 4))
+                yield from executor.map(render, account_ids, [slices[k] for k in account_ids], chunksize=chunksize)
+            return
+    for account_id in account_ids:
+        yield render(account_id, slices[account_id])
+
+# Function to render every account's slice of a report and send it to the
+# account's owner. render(account ID, slice) returns (subject, body_html,
+# attachment) and must be a module-level function, or a functools.partial
+# of one, so it can run in another process. Each email is sent while the
+# next slices render. Slices of accounts without an owner are skipped.
+# Returns the number of emails sent.
+def send_account_reports(report, slices, render, sender):
+    owners = account_owners(iter_accounts(get_client('organizations')))
+    owned = {account_id: records for account_id, records in sorted(slices.items()) if account_id in owners}
+
+    messages = (
+        (subject, body_html, owners[account_id], attachment)
+        for account_id, (subject, body_html, attachment) in zip(owned, iter_rendered(render, owned))
+    )
+
+    failed = 0
+    for subject, recipient, count, error in send_reports(messages, sender):
+        if error is not None:
+            print(f"Error sending '{subject}' to {recipient}: {str(error)}")
+            failed += 1
+    print(f"{report}: {len(owned) - failed} of {len(owned)} account reports sent, "
+          f"{len(slices) - len(owned)} accounts without an owner skipped")
+    return len(owned) - failed
@@ -0,0 +1,101 @@
+import importlib
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from aws_clients import get_client
+from cross_account import discover_distributions, get_max_workers
+from pagination import iter_accounts
+
+# Cost reports leave out credits and refunds
+COST_FILTER = {
+    "Not": {
+        'Dimensions': {
+            'Key': 'RECORD_TYPE',
+            'Values': ['Credit', 'Refund']
+        }
+    }
+}
+
+# Function to read the CDN granularity, DAILY or HOURLY, from the event, then the environment
+def cdn_granularity(event=None):
+    value = (event or {}).get('granularity') or os.environ.get('CDN_GRANULARITY', 'DAILY')
+    return 'HOURLY' if str(value).upper() == 'HOURLY' else 'DAILY'
+
+# A report declared as data. The renderer is the report module, which
+# provides rows_to_records(rows, labels) and
+# render_report(records, start_date, end_date, report_context). context names
+# the ReportContext attributes the renderer reads. source is 'ce' for Cost
+# Explorer data or 'cloudwatch' for CloudFront distribution metrics. Reports
+# with labels off show no labels and take rows_to_records(rows) instead.
+ReportSpec = namedtuple(
+    'ReportSpec', ['name', 'renderer', 'period', 'dimension', 'granularity', 'metric', 'filter', 'context', 'source', 'labels'],
+    defaults=[(), 'ce', True],
+)
+
+REPORTS = (
+    ReportSpec('linked-account-mtd', 'LinkedAccountMTDReport', 'MTD', 'LINKED_ACCOUNT', 'DAILY', 'BlendedCost', COST_FILTER),
+    ReportSpec('linked-account-ytm', 'LinkedAccountYTMReport', 'YTM', 'LINKED_ACCOUNT', 'MONTHLY', 'BlendedCost', COST_FILTER),
+    ReportSpec('services-mtd', 'LinkedAccountServicesMTDReport', 'MTD', 'SERVICE', 'DAILY', 'BlendedCost', COST_FILTER, ('account_id',)),
+    ReportSpec('services-ytm', 'LinkedAccountServicesYTM', 'YTM', 'SERVICE', 'MONTHLY', 'BlendedCost', COST_FILTER, ('account_id',)),
+    ReportSpec('cdn-mtd', 'CDN-MTDReport', 'MTD', 'DistributionId', 'DAILY', 'BytesDownloaded', None, ('distributions',), 'cloudwatch'),
+    ReportSpec('cdn-ytm', 'CDN-YTMReport', 'YTM', 'DistributionId', 'MONTHLY', 'BytesDownloaded', None, ('distributions',), 'cloudwatch', False),
+)
+
+# Reports whose granularity follows the run's cdn_granularity
+CDN_GRANULARITY_REPORTS = ('cdn-mtd',)
+
+# Function to select report specs by name; no names selects them all. The
+# CDN granularity is resolved from the event of the run.
+def select_reports(names=None, event=None):
+    if names:
+        unknown = set(names) - {spec.name for spec in REPORTS}
+        if unknown:
+            raise ValueError(f"Unknown reports: {', '.join(sorted(unknown))}")
+    granularity = cdn_granularity(event)
+    return [
+        spec._replace(granularity=granularity) if spec.name in CDN_GRANULARITY_REPORTS else spec
+        for spec in REPORTS if not names or spec.name in names
+    ]
+
+# Function to resolve a report period to its (start, end) dates
+def period_dates(period, today=None):
+    today = today or datetime.utcnow()
+    if period == 'MTD':
+        return datetime(today.year, today.month, 1), today
+    if period == 'YTM':
+        return datetime(today.year, 1, 1), today
+    raise ValueError(f"Unknown report period {period!r}")
+
+# Function to import the module that renders a report
+def load_renderer(spec):
+    return importlib.import_module(spec.renderer)
+
+# Inputs the renderers share besides cost data, each looked up at most once,
+# also when reports are rendered on several threads. Values already known,
+# such as distributions discovered by the shards of a sharded run or the
+# account of a per-account slice, are passed in.
+class ReportContext:
+    def __init__(self, event=None, distributions=None, account_id=None):
+        self.event = event or {}
+        self._account_lock = threading.Lock()
+        self._distributions_lock = threading.Lock()
+        self._account_id = account_id
+        self._distributions = distributions
+
+    @property
+    def account_id(self):
+        with self._account_lock:
+            if self._account_id is None:
+                sts_client = get_client('sts')
+                self._account_id = sts_client.get_caller_identity()['Account']
+            return self._account_id
+
+    @property
+    def distributions(self):
+        with self._distributions_lock:
+            if self._distributions is None:
+                # Probe roles and list distributions for all accounts in parallel
+                org_client = get_client('organizations')
+                self._distributions = discover_distributions(iter_accounts(org_client), get_max_workers(self.event))
+            return self._distributions
@@ -0,0 +1,197 @@
+import json
+import math
+import os
+import threading
+from collections import deque, namedtuple
+from datetime import date, timedelta
+from html_render import render_table
+
+ROLLING_STATS_DIR = os.environ.get('ROLLING_STATS_DIR', '/tmp/rolling_stats')
+
+# Anomaly flags are on unless ROLLING_STATS is set to off
+ENABLED = os.environ.get('ROLLING_STATS', 'on').lower() not in ('0', 'false', 'no', 'off')
+
+# Smoothing factor of the exponentially weighted moving average
+ALPHA = float(os.environ.get('ROLLING_STATS_ALPHA', '0.3'))
+
+# A cell is an anomaly when its z-score against the rolling window reaches this
+Z_THRESHOLD = float(os.environ.get('ROLLING_STATS_Z_THRESHOLD', '3'))
+
+# Rows in the top movers section
+TOP_MOVERS = int(os.environ.get('ROLLING_STATS_TOP_MOVERS', '5'))
+
+# Flags older than this are dropped from the persisted state
+FLAG_RETENTION_DAYS = 400
+
+# Floor of the standard deviation relative to the mean, so a flat history
+# does not turn every small change into an anomaly
+MIN_RELATIVE_STD = 0.05
+
+ANOMALY_CLASS = 'anomaly'
+
+# Cells flagged as {(row index, column index): z-score} and the top movers as
+# Mover tuples, largest |z| first; a key's mover is its latest scored period
+Anomalies = namedtuple('Anomalies', ['cells', 'movers'])
+Mover = namedtuple('Mover', ['key', 'column', 'value', 'expected', 'z'])
+
+NO_ANOMALIES = Anomalies({}, [])
+
+# Function to add the anomaly class to a cell's CSS class
+def flag_class(css_class, flagged):
+    if not flagged:
+        return css_class
+    return f'{css_class} {ANOMALY_CLASS}' if css_class else ANOMALY_CLASS
+
+# Statistics of one key's series: the EWMA and a rolling window with running
+# sums, so folding in a value and scoring one are both O(1). z-scores of the
+# last folded period and of every flagged period are kept, so cells folded
+# in an earlier run are flagged again without their history.
+class KeyStats:
+    __slots__ = ('last', 'last_z', 'ewma', 'window', 'total', 'total_sq', 'flags')
+
+    def __init__(self, window, last=None, last_z=None, ewma=None, values=(), flags=None):
+        self.last = last
+        self.last_z = last_z
+        self.ewma = ewma
+        self.window = deque(values, maxlen=window)
+        self.total = sum(self.window)
+        self.total_sq = sum(value * value for value in self.window)
+        self.flags = flags or {}
+
+    # Function to return the z-score of a value against the window, or None with too little history
+    def score(self, value, min_history):
+        count = len(self.window)
+        if count < min_history:
+            return None
+        mean = self.total / count
+        std = math.sqrt(max(self.total_sq / count - mean * mean, 0.0))
+        return (value - mean) / max(std, MIN_RELATIVE_STD * abs(mean), 1e-9)
+
+    # Function to fold the value of a period into the statistics
+    def update(self, period, value, z):
+        if len(self.window) == self.window.maxlen:
+            oldest = self.window[0]
+            self.total -= oldest
+            self.total_sq -= oldest * oldest
+        self.window.append(value)
+        self.total += value
+        self.total_sq += value * value
+        self.ewma = value if self.ewma is None else self.ewma + ALPHA * (value - self.ewma)
+        self.last = period
+        self.last_z = None if z is None else round(z, 2)
+        if z is not None and abs(z) >= Z_THRESHOLD:
+            self.flags[period] = round(z, 2)
+
+    def to_json(self):
+        return {'last': self.last, 'last_z': self.last_z, 'ewma': self.ewma, 'window': list(self.window), 'flags': self.flags}
+
+# Function to turn a matrix column, a date or a 'YYYY-MM-DD' string, into the period key
+def _period(column):
+    return column if isinstance(column, str) else column.isoformat()
+
+# Per-key statistics of one report's series, persisted as one JSON file.
+# A period is folded in once, when settled() says its figures are final;
+# later periods are scored against the statistics without changing them,
+# and since their figures can only grow, only spikes are flagged.
+class RollingStats:
+    def __init__(self, name, window, min_history, directory=ROLLING_STATS_DIR):
+        self.name = name
+        self.window = window
+        self.min_history = min_history
+        self.path = os.path.join(directory, f'{name}.json')
+        self._lock = threading.Lock()
+        self._keys = None
+
+    def _load(self):
+        self._keys = {}
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Starting rolling statistics {self.name} afresh: {str(e)}")
+            return
+        for key, stats in state.items():
+            self._keys[key] = KeyStats(
+                self.window, stats['last'], stats.get('last_z'), stats['ewma'], stats['window'], stats.get('flags')
+            )
+
+    def _save(self):
+        cutoff = (date.today() - timedelta(days=FLAG_RETENTION_DAYS)).isoformat()
+        for stats in self._keys.values():
+            stats.flags = {period: z for period, z in stats.flags.items() if period >= cutoff}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({key: stats.to_json() for key, stats in self._keys.items()}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    # Function to score every cell of a CostMatrix, fold the settled periods
+    # that are new into the statistics and save them. Returns Anomalies.
+    def observe(self, matrix, settled=lambda column: True):
+        if not ENABLED:
+            return NO_ANOMALIES
+        periods = [_period(column) for column in matrix.columns]
+        is_settled = [settled(column) for column in matrix.columns]
+        values = matrix.values.tolist()
+        cells = {}
+        movers = []
+
+        with self._lock:
+            if self._keys is None:
+                self._load()
+            for i, key in enumerate(matrix.rows):
+                stats = self._keys.get(key)
+                if stats is None:
+                    stats = self._keys[key] = KeyStats(self.window)
+                latest = None
+                for j, period in enumerate(periods):
+                    if stats.last is not None and period <= stats.last:
+                        z = stats.last_z if period == stats.last else stats.flags.get(period)
+                        expected = None
+                    else:
+                        expected = stats.ewma
+                        z = stats.score(values[i][j], self.min_history)
+                        if is_settled[j]:
+                            stats.update(period, values[i][j], z)
+                        elif z is not None and z < 0:
+                            z = None
+                    if z is not None:
+                        latest = Mover(key, matrix.columns[j], values[i][j], expected, z)
+                        if abs(z) >= Z_THRESHOLD:
+                            cells[(i, j)] = z
+                if latest is not None:
+                    movers.append(latest)
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Could not save rolling statistics {self.name}: {str(e)}")
+
+        movers.sort(key=lambda mover: abs(mover.z), reverse=True)
+        return Anomalies(cells, movers[:TOP_MOVERS])
+
+_SERIES = {}
+
+# Function to return the module-scope statistics of a series, which stay loaded across warm invocations
+def get_rolling_stats(name, window, min_history):
+    series = _SERIES.get(name)
+    if series is None:
+        series = _SERIES[name] = RollingStats(name, window, min_history)
+    return series
+
+# Function to render the top movers as a short table; format_values turns a
+# list of amounts into display strings. Returns '' when there are none.
+def render_movers(movers, key_header, format_values, format_period=str):
+    if not movers:
+        return ''
+    values = format_values([mover.value for mover in movers])
+    expected = format_values([mover.expected or 0.0 for mover in movers])
+    header = [key_header, 'Period', 'Value', 'Expected', 'z-score']
+    rows = []
+    for i, mover in enumerate(movers):
+        rows.append([
+            mover.key, format_period(mover.column), (values[i], 'num'),
+            (expected[i] if mover.expected is not None else '-', 'num'),
+            ('%+.1f' % mover.z, flag_class('num', abs(mover.z) >= Z_THRESHOLD)),
+        ])
+    return '<h5>Top movers</h5>' + render_table(header, rows)
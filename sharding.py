@@ -0,0 +1,236 @@
+import heapq
+import json
+import multiprocessing
+import os
+import uuid
+from datetime import datetime
+from aws_clients import get_client
+from cloudfront_metrics import PEAK_HOURS, UsageRows, fetch_bytes_downloaded
+from cross_account import discover_distributions, fan_out, get_max_workers
+from instrumentation import METRICS
+from pagination import iter_accounts
+from pivot import Pivot
+
+# Shards the accounts are split into; 1 runs the report in a single invocation
+DEFAULT_SHARDS = 1
+
+# 'lambda' invokes one worker Lambda per shard; 'local' runs the shards in a
+# multiprocessing pool, standing in for the worker invocations in local runs
+DEFAULT_SHARD_MODE = 'lambda'
+
+# Worker function invoked per shard; by default the coordinator invokes itself
+SHARD_WORKER_FUNCTION = os.environ.get('SHARD_WORKER_FUNCTION')
+
+# Seconds the coordinator waits for a worker, up to the Lambda maximum of 15 minutes
+SHARD_TIMEOUT_SECONDS = int(os.environ.get('SHARD_TIMEOUT_SECONDS', '900'))
+
+# Report the API metrics of shard workers are emitted under
+SHARD_METRICS_REPORT = 'CDNShard'
+
+# Seconds of its own run time the coordinator keeps to merge the partials and send the report
+SHARD_MERGE_SECONDS = 60
+
+# Bucket worker invocations write their partials to. A partial takes about
+# 1.4 KB per distribution and month, so a few thousand distributions would
+# exceed the 6 MB limit of a Lambda response; workers return the object key instead.
+SHARD_RESULT_BUCKET = os.environ.get('SHARD_RESULT_BUCKET', '')
+SHARD_RESULT_PREFIX = os.environ.get('SHARD_RESULT_PREFIX', 'shards/')
+
+# Function to resolve the shard count from the event, then the environment
+def get_shard_count(event=None):
+    value = (event or {}).get('shards') or os.environ.get('REPORT_SHARDS')
+    try:
+        return max(1, int(value)) if value else DEFAULT_SHARDS
+    except ValueError:
+        print(f"Ignoring invalid shards value {value!r}")
+        return DEFAULT_SHARDS
+
+# Function to resolve the shard mode, 'lambda' or 'local', from the event, then the environment
+def get_shard_mode(event=None):
+    value = (event or {}).get('shard_mode') or os.environ.get('SHARD_MODE', DEFAULT_SHARD_MODE)
+    return 'local' if str(value).lower() == 'local' else 'lambda'
+
+# Function to split the IDs of the active accounts into at most count shards.
+# Accounts are dealt round-robin in ID order, so shards differ by one account at most.
+def split_accounts(accounts, count):
+    account_ids = sorted(k['Id'] for k in accounts if k.get('Status') == 'ACTIVE')
+    return [shard for shard in (account_ids[i::count] for i in range(count)) if shard]
+
+# Daily, or for MONTHLY granularity monthly, BytesDownloaded of one shard's
+# distributions as a pivot by (distribution ID, 'YYYY-MM-DD'), with their
+# busiest hours in hourly mode.
+# It converts to and from plain JSON, so it can be returned by a worker
+# invocation, and partials of disjoint shards merge in any order.
+class PartialUsage:
+    def __init__(self, distributions=(), pivot=None, peak_hours=None, accounts=0):
+        self.distributions = list(distributions)
+        self.pivot = pivot or Pivot()
+        self.peak_hours = peak_hours or {}
+        self.accounts = accounts
+
+    # Function to build a partial from the DailyUsage or HourlyUsage of a shard's distributions
+    @classmethod
+    def from_usage(cls, distributions, usage, start, end, accounts=0, granularity='DAILY'):
+        partial = cls(distributions, accounts=accounts)
+        for distribution_id, date, amount, unit in usage.rows(start, end, granularity):
+            partial.pivot.add(distribution_id, date, amount)
+        for distribution_id, hours in usage.peak_hours().items():
+            partial.peak_hours[distribution_id] = [(hour.isoformat(), value) for hour, value in hours]
+        return partial
+
+    # Function to add another shard's partial; each distribution keeps its PEAK_HOURS busiest hours
+    def merge(self, other):
+        self.distributions.extend(other.distributions)
+        self.pivot.merge(other.pivot)
+        for distribution_id, hours in other.peak_hours.items():
+            merged = self.peak_hours.get(distribution_id, []) + [tuple(hour) for hour in hours]
+            self.peak_hours[distribution_id] = heapq.nlargest(PEAK_HOURS, merged, key=lambda hour: hour[1])
+        self.accounts += other.accounts
+        return self
+
+    def to_json(self):
+        return {
+            'distributions': self.distributions,
+            'usage': self.pivot.to_json(),
+            'peak_hours': self.peak_hours,
+            'accounts': self.accounts,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['distributions'], Pivot.from_json(data['usage']), data['peak_hours'], data['accounts'])
+
+    # Function to return the merged usage as UsageRows, as fetch_usage_rows does
+    def rows(self):
+        return UsageRows.from_rows(
+            (distribution_id, date, amount, 'Bytes') for (distribution_id, date), amount in self.pivot.cells.items()
+        )
+
+    # Function to return {distribution ID: [(hour start, bytes)]}, busiest hour first
+    def peak_hour_labels(self):
+        return {
+            distribution_id: [(datetime.fromisoformat(hour), value) for hour, value in hours]
+            for distribution_id, hours in self.peak_hours.items()
+        }
+
+# Function to run one shard: discover the distributions of its accounts and
+# fetch their usage for the whole days in [start, end). Takes and returns
+# plain JSON, the payload of a worker invocation. When the task names a
+# result bucket, the partial is written there and only its location is returned.
+def run_shard(task):
+    start = datetime.fromisoformat(task['start'])
+    end = datetime.fromisoformat(task['end'])
+    accounts = [{'Id': account_id, 'Status': 'ACTIVE'} for account_id in task['accounts']]
+
+    # The shard's own calls are flushed here, also from local pool processes
+    try:
+        distributions = discover_distributions(accounts, task.get('max_workers') or get_max_workers())
+        usage = fetch_bytes_downloaded(distributions, start, end, hourly=task.get('granularity') == 'HOURLY')
+    finally:
+        METRICS.flush(SHARD_METRICS_REPORT)
+    print(f"Shard {task['index']}: {len(task['accounts'])} accounts, {len(distributions)} distributions")
+    partial = PartialUsage.from_usage(
+        distributions, usage, start, end, len(task['accounts']), task.get('granularity', 'DAILY')
+    ).to_json()
+    if not task.get('result_bucket'):
+        return partial
+    get_client('s3').put_object(
+        Bucket=task['result_bucket'], Key=task['result_key'], Body=json.dumps(partial).encode('utf-8'),
+        ContentType='application/json',
+    )
+    return {'bucket': task['result_bucket'], 'key': task['result_key']}
+
+# Function to read a shard's partial, from S3 when the worker wrote it there.
+# The object is deleted once read.
+def load_partial(result):
+    if 'key' not in result:
+        return PartialUsage.from_json(result)
+    s3_client = get_client('s3')
+    body = s3_client.get_object(Bucket=result['bucket'], Key=result['key'])['Body'].read()
+    s3_client.delete_object(Bucket=result['bucket'], Key=result['key'])
+    return PartialUsage.from_json(json.loads(body))
+
+# Function to return how long the coordinator can wait for its workers: at most
+# SHARD_TIMEOUT_SECONDS, and never past its own Lambda deadline
+def shard_timeout(context=None):
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining is None:
+        return SHARD_TIMEOUT_SECONDS
+    return max(1, min(SHARD_TIMEOUT_SECONDS, remaining() // 1000 - SHARD_MERGE_SECONDS))
+
+# Function to run each shard as a synchronous invocation of the worker function.
+# A worker that does not answer within timeout seconds is a failed shard; the
+# invocation is not retried, since the worker may still be running.
+def invoke_shards(tasks, function_name, timeout=SHARD_TIMEOUT_SECONDS):
+    lambda_client = get_client('lambda', read_timeout=timeout)
+
+    def invoke(task):
+        response = lambda_client.invoke(
+            FunctionName=function_name, InvocationType='RequestResponse', Payload=json.dumps({'shard': task})
+        )
+        payload = json.loads(response['Payload'].read())
+        if response.get('FunctionError'):
+            raise RuntimeError(payload.get('errorMessage', response['FunctionError']))
+        return payload
+
+    return fan_out(invoke, tasks, len(tasks))
+
+# Function to run every shard in a local process pool. Returns
+# (task, result, error) tuples like fan_out.
+def run_local_shards(tasks):
+    with multiprocessing.Pool(min(len(tasks), os.cpu_count() or 1)) as pool:
+        pending = [(task, pool.apply_async(run_shard, (task,))) for task in tasks]
+        results = []
+        for task, result in pending:
+            try:
+                results.append((task, result.get(), None))
+            except Exception as e:
+                results.append((task, None, e))
+        return results
+
+# Function to fetch the CloudFront usage of the whole organization in shards.
+# The coordinator lists the accounts and splits them into shards, each
+# shard discovers its distributions and fetches their usage as a partial,
+# and the partials are merged here. Worker invocations hand their partials
+# over through SHARD_RESULT_BUCKET. A failed shard fails the run rather than
+# sending a report that silently leaves its accounts out. Returns
+# (distributions, rows, peak hours) in the shapes the unsharded fetch returns them.
+def fetch_sharded(start, end, granularity, shards, event=None, context=None):
+    org_client = get_client('organizations')
+    tasks = [
+        {'index': i, 'accounts': accounts, 'start': start.isoformat(), 'end': end.isoformat(),
+         'granularity': granularity, 'max_workers': get_max_workers(event)}
+        for i, accounts in enumerate(split_accounts(iter_accounts(org_client), shards))
+    ]
+    if not tasks:
+        return [], [], {}
+
+    if get_shard_mode(event) == 'local':
+        results = run_local_shards(tasks)
+    else:
+        function_name = SHARD_WORKER_FUNCTION or getattr(context, 'function_name', None)
+        if not function_name:
+            raise ValueError("Sharded runs need SHARD_WORKER_FUNCTION or a Lambda context")
+        if not SHARD_RESULT_BUCKET:
+            raise ValueError("Sharded runs on Lambda need SHARD_RESULT_BUCKET for the shard results")
+        run_id = uuid.uuid4().hex
+        for task in tasks:
+            task['result_bucket'] = SHARD_RESULT_BUCKET
+            task['result_key'] = f"{SHARD_RESULT_PREFIX}{run_id}/{task['index']}.json"
+        results = invoke_shards(tasks, function_name, shard_timeout(context))
+
+    merged = PartialUsage()
+    failed = 0
+    for task, result, error in results:
+        if error is not None:
+            print(f"Shard {task['index']} of {len(task['accounts'])} accounts failed: {str(error)}")
+            failed += 1
+            continue
+        merged.merge(load_partial(result))
+    if failed:
+        raise RuntimeError(f"{failed} of {len(tasks)} shards failed")
+    print(f"Sharded run: {len(tasks)} shards, {merged.accounts} accounts, {len(merged.distributions)} distributions")
+
+    # Distributions are ordered by account as in an unsharded discovery
+    distributions = sorted(merged.distributions, key=lambda dist: dist['AccountId'])
+    return distributions, merged.rows(), merged.peak_hour_labels()
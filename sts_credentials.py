@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from aws_clients import get_client
+
+REFRESH_MARGIN = timedelta(minutes=5)
+SESSION_NAME = 'cross_acct_lambda'
+SPILL_PATH = os.environ.get('STS_CACHE_SPILL_PATH', '/tmp/sts_credentials.cache')
+
+# Caches assumed-role credentials per (account, role ARN) until shortly before
+# they expire. One instance lives in module scope, so warm Lambda invocations
+# reuse it. When a Fernet key is configured the cache is also spilled,
+# encrypted, to /tmp so it survives a process restart in the same sandbox.
+class CredentialCache:
+    def __init__(self, refresh_margin=REFRESH_MARGIN, spill_path=None, spill_key=None):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entries = {}
+        self._fernet = None
+        self._spill_path = None
+        self._spill_loaded = False
+        if spill_path and spill_key:
+            # cryptography is only imported when a spill is configured
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError:
+                print("cryptography is not installed; STS credential spill disabled")
+            else:
+                self._fernet = Fernet(spill_key)
+                self._spill_path = spill_path
+
+    # Function to return valid credentials for the role, assuming it only when needed
+    def get(self, account_id, role_arn, sts_client=None):
+        key = (account_id, role_arn)
+        self._load_spill()
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Concurrent callers for the same role wait here rather than all calling STS
+        with key_lock:
+            credentials = self._fresh(key)
+            if credentials is not None:
+                return credentials
+
+            sts_client = sts_client or get_client('sts')
+            response = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=SESSION_NAME)
+            credentials = response['Credentials']
+            with self._lock:
+                self._entries[key] = credentials
+            self._save_spill()
+            return credentials
+
+    def _fresh(self, key):
+        with self._lock:
+            credentials = self._entries.get(key)
+        if credentials is None:
+            return None
+        if credentials['Expiration'] - self.refresh_margin <= datetime.now(timezone.utc):
+            return None
+        return credentials
+
+    def _load_spill(self):
+        if self._spill_loaded or self._fernet is None:
+            return
+        self._spill_loaded = True
+        from cryptography.fernet import InvalidToken
+        try:
+            with open(self._spill_path, 'rb') as f:
+                payload = json.loads(self._fernet.decrypt(f.read()))
+        except FileNotFoundError:
+            return
+        except (InvalidToken, ValueError) as e:
+            print(f"Discarding unreadable STS credential spill: {str(e)}")
+            return
+
+        with self._lock:
+            for entry in payload:
+                credentials = dict(entry['Credentials'])
+                credentials['Expiration'] = datetime.fromisoformat(credentials['Expiration'])
+                self._entries.setdefault((entry['AccountId'], entry['RoleArn']), credentials)
+
+    def _save_spill(self):
+        if self._fernet is None:
+            return
+        with self._lock:
+            payload = [
+                {'AccountId': account_id, 'RoleArn': role_arn,
+                 'Credentials': dict(credentials, Expiration=credentials['Expiration'].isoformat())}
+                for (account_id, role_arn), credentials in self._entries.items()
+            ]
+        tmp_path = f"{self._spill_path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._fernet.encrypt(json.dumps(payload).encode('utf-8')))
+            os.replace(tmp_path, self._spill_path)
+        except OSError as e:
+            print(f"Could not write STS credential spill: {str(e)}")
+
+# Shared across warm invocations
+CREDENTIALS = CredentialCache(spill_path=SPILL_PATH, spill_key=os.environ.get('STS_CACHE_SPILL_KEY'))
+
+# Function to return a shared client that acts with the role's cached credentials
+def assumed_client(service_name, account_id, role_arn, sts_client=None, region_name=None):
+    credentials = CREDENTIALS.get(account_id, role_arn, sts_client)
+    return get_client(service_name, region_name, credentials=credentials, scope=account_id)
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# The report modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aws_clients import clear_clients
+from benchmarks.fake_aws import SyntheticOrg
+
+# A small synthetic organization standing in for AWS; clients cached by
+# earlier tests are dropped so every call reaches it
+@pytest.fixture
+def org():
+    clear_clients()
+    org = SyntheticOrg(accounts=6, distributions=24, services=5)
+    with org.patched():
+        yield org
+    clear_clients()
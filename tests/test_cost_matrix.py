@@ -0,0 +1,38 @@
+from datetime import date
+import numpy as np
+from cloudfront_metrics import UsageRows
+from cost_matrix import SIZE_SUFFIXES, format_sizes
+
+# Function to format one byte count the way the reports did cell by cell
+def format_size(size):
+    index = 0
+    while size >= 1024 and index < len(SIZE_SUFFIXES) - 1:
+        size /= 1024
+        index += 1
+    return '%.2f %s' % (size, SIZE_SUFFIXES[index])
+
+def test_grouped_sizes_match_formatting_each_cell():
+    rng = np.random.default_rng(0)
+    sizes = np.concatenate([
+        rng.lognormal(20, 3, 20000),
+        # Amounts on and around the rounding boundary of the hundredths
+        np.array([1.005, 2.675, 1.125 * 1024, 10.005 * 1024 ** 3, 1023.994 * 1024, 1023.995 * 1024, 1024.0, 0.0]),
+        np.round(rng.random(20000) * 1000, 3) * 1024,
+    ])
+
+    assert format_sizes(sizes).tolist() == [format_size(size) for size in sizes.tolist()]
+
+def test_usage_matrix_is_laid_out_by_distribution_and_period():
+    usage = UsageRows.from_rows([
+        ('E2', '2025-03-02', 300.0, 'Bytes'),
+        ('E1', '2025-03-01', 100.0, 'Bytes'),
+        ('E1', '2025-03-02', 200.0, 'Bytes'),
+    ])
+    days = [date(2025, 3, 1), date(2025, 3, 2), date(2025, 3, 3)]
+    matrix = usage.matrix(['E1', 'E3', 'E2'], days)
+
+    assert matrix.values.tolist() == [[100.0, 200.0, 0.0], [0.0, 0.0, 0.0], [0.0, 300.0, 0.0]]
+    # Rows come in date order, and within a date in the order the distributions were read
+    assert list(usage) == [('E1', '2025-03-01', 100.0, 'Bytes'), ('E2', '2025-03-02', 300.0, 'Bytes'),
+                           ('E1', '2025-03-02', 200.0, 'Bytes')]
+    assert usage.select(['E2']).usage('E2') == [(date(2025, 3, 2), 300.0)]
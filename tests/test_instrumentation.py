@@ -0,0 +1,47 @@
+import json
+from types import SimpleNamespace
+import pytest
+from instrumentation import CE_REQUEST_PRICE_USD, METRICS, NAMESPACE, ApiMetrics, flush_metrics
+
+# Function to drive the botocore event handlers the way one call to an operation would
+def record_call(metrics, service, operation, status_code=200, error_code=None):
+    model = SimpleNamespace(name=operation, service_model=SimpleNamespace(service_name=service))
+    context = {}
+    metrics._before_call(model=model, context=context)
+    parsed = {'Error': {'Code': error_code}} if error_code else {}
+    metrics._response_received(context=context, parsed_response=parsed)
+    parsed['ResponseMetadata'] = {'RetryAttempts': 0}
+    metrics._after_call(http_response=SimpleNamespace(status_code=status_code), parsed=parsed, context=context)
+
+def test_flushed_summary_is_one_json_document_per_line(capsys):
+    metrics = ApiMetrics()
+    record_call(metrics, 'ce', 'GetCostAndUsage')
+    record_call(metrics, 'ce', 'GetCostAndUsage', 400, 'ThrottlingException')
+    record_call(metrics, 'ses', 'SendEmail')
+
+    metrics.flush('TestReport')
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    assert [(d['Service'], d['Operation']) for d in documents] == [('ce', 'GetCostAndUsage'), ('ses', 'SendEmail')]
+    for document in documents:
+        definition, = document['_aws']['CloudWatchMetrics']
+        assert definition['Namespace'] == NAMESPACE
+        assert all(isinstance(document[name], str) for name in definition['Dimensions'][0])
+        assert all(isinstance(document[metric['Name']], (int, float)) for metric in definition['Metrics'])
+    ce = documents[0]
+    assert (ce['Calls'], ce['Attempts'], ce['Throttles'], ce['Errors']) == (2, 2, 1, 1)
+    assert ce['EstimatedCostUSD'] == round(2 * CE_REQUEST_PRICE_USD, 2)
+    assert sum(ce['LatencyHistogram'].values()) == 2
+    assert metrics.snapshot() == {}
+
+def test_failed_handler_still_flushes_its_metrics(capsys):
+    @flush_metrics('FailingReport')
+    def lambda_handler(event, context):
+        record_call(METRICS, 'ce', 'GetCostAndUsage', 400, 'ThrottlingException')
+        raise RuntimeError('Cost Explorer unavailable')
+
+    with pytest.raises(RuntimeError):
+        lambda_handler({}, None)
+    document, = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+    assert (document['Report'], document['Throttles'], document['Errors']) == ('FailingReport', 1, 1)
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+import pytest
+import query_planner
+from cost_store import CostStore
+from month_snapshots import MonthSnapshots
+from report_specs import REPORTS
+
+ACCOUNTS = ('111111111111', '222222222222')
+
+# Cost Explorer stand-in where every account costs 1.0 a day, so a month
+# costs as many dollars as the days it covers
+class FakeCostExplorer:
+    def __init__(self):
+        self.calls = []
+
+    def get_cost_and_usage(self, TimePeriod, Granularity, Metrics, GroupBy, Filter=None, NextPageToken=None):
+        self.calls.append((TimePeriod['Start'], TimePeriod['End'], Granularity))
+        day = datetime.strptime(TimePeriod['Start'], '%Y-%m-%d')
+        end = datetime.strptime(TimePeriod['End'], '%Y-%m-%d')
+        results = []
+        while day < end:
+            following = day + timedelta(days=1)
+            if Granularity == 'MONTHLY':
+                following = min(end, (day.replace(day=1) + timedelta(days=32)).replace(day=1))
+            amount = str(float((following - day).days))
+            results.append({
+                'TimePeriod': {'Start': day.strftime('%Y-%m-%d'), 'End': following.strftime('%Y-%m-%d')},
+                'Groups': [
+                    {'Keys': [account], 'Metrics': {metric: {'Amount': amount, 'Unit': 'USD'} for metric in Metrics}}
+                    for account in ACCOUNTS
+                ],
+            })
+            day = following
+        return {'ResultsByTime': results}
+
+@pytest.fixture
+def caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(query_planner.CATALOG, 'cached_count', lambda dimension: None)
+    return CostStore(str(tmp_path / 'costs.sqlite3')), MonthSnapshots(str(tmp_path / 'snapshots'))
+
+def linked_account_requests():
+    specs = {spec.name: spec for spec in REPORTS}
+    end = datetime(2025, 3, 15, 9, 30)
+    return [
+        (specs['linked-account-mtd'], datetime(2025, 3, 1), end),
+        (specs['linked-account-ytm'], datetime(2025, 1, 1), end),
+    ]
+
+def test_mtd_and_ytm_merge_into_one_query(caches):
+    store, snapshots = caches
+    queries = query_planner.plan(linked_account_requests(), store, snapshots)
+
+    assert len(queries) == 1
+    assert queries[0].daily_start == datetime(2025, 3, 1)
+    assert queries[0].estimated_requests() == 2
+
+def test_merged_query_is_cut_back_per_spec(caches):
+    store, snapshots = caches
+    ce_client = FakeCostExplorer()
+    query, = query_planner.plan(linked_account_requests(), store, snapshots)
+    results = query_planner.execute_query(query, ce_client)
+
+    # Closed months come from one MONTHLY request, the rest from one DAILY request
+    assert ce_client.calls == [('2025-01-01', '2025-03-01', 'MONTHLY'), ('2025-03-01', '2025-03-15', 'DAILY')]
+    mtd, labels = results['linked-account-mtd']
+    assert len(mtd) == 14 * len(ACCOUNTS)
+    assert {amount for key, date, amount, unit in mtd} == {1.0}
+    ytm, labels = results['linked-account-ytm']
+    assert sorted((date, amount) for key, date, amount, unit in ytm if key == ACCOUNTS[0]) == [
+        ('2025-01-01', 31.0), ('2025-02-01', 28.0), ('2025-03-01', 14.0),
+    ]
+
+def test_second_run_only_fetches_the_restatement_window(caches):
+    store, snapshots = caches
+    query, = query_planner.plan(linked_account_requests(), store, snapshots)
+    query_planner.execute_query(query, FakeCostExplorer())
+
+    ce_client = FakeCostExplorer()
+    query, = query_planner.plan(linked_account_requests(), store, snapshots)
+    assert query.estimated_requests() == 1
+    query_planner.execute_query(query, ce_client)
+    assert ce_client.calls == [('2025-03-12', '2025-03-15', 'DAILY')]
@@ -0,0 +1,85 @@
+import json
+import pytest
+import rate_limiter
+from aws_clients import clear_clients, get_client
+from instrumentation import METRICS
+
+# Raw HTTP response body botocore reads a canned response from
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+# Function to build the before-send handler that answers the requests in
+# turn with (status, body) responses instead of sending them
+def canned_responses(responses, sent):
+    from botocore.awsrequest import AWSResponse
+
+    def before_send(request, **kwargs):
+        status, body = responses[len(sent)]
+        sent.append(request.url)
+        headers = {'x-amzn-RequestId': f'request-{len(sent)}', 'Content-Type': 'application/x-amz-json-1.1'}
+        return AWSResponse(request.url, status, headers, RawBody(json.dumps(body).encode('utf-8')))
+    return before_send
+
+THROTTLED = (400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'})
+UNAVAILABLE = (503, {'__type': 'ServiceUnavailableException', 'message': 'Service unavailable'})
+RESULTS = (200, {'ResultsByTime': [], 'DimensionValueAttributes': []})
+
+# A real botocore Cost Explorer client whose requests never leave the process
+@pytest.fixture
+def ce_client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.delenv('AWS_PROFILE', raising=False)
+    monkeypatch.setattr(rate_limiter, 'backoff', lambda attempt: 0)
+    # Every test starts from limiters nobody has throttled yet
+    monkeypatch.setattr(rate_limiter, '_LIMITERS', {})
+    clear_clients()
+    METRICS.reset()
+    yield get_client('ce', region_name='us-east-1')
+    clear_clients()
+    METRICS.reset()
+
+def get_cost_and_usage(client):
+    return client.get_cost_and_usage(
+        TimePeriod={'Start': '2025-03-01', 'End': '2025-03-02'}, Granularity='DAILY', Metrics=['BlendedCost'],
+    )
+
+def ce_stats():
+    return METRICS.snapshot()[('ce', 'GetCostAndUsage')]
+
+def test_throttled_call_counts_once_with_its_retries(ce_client):
+    sent = []
+    ce_client.meta.events.register('before-send', canned_responses([THROTTLED, THROTTLED, RESULTS], sent))
+
+    assert get_cost_and_usage(ce_client)['ResultsByTime'] == []
+    stats = ce_stats()
+    assert len(sent) == 3
+    assert (stats.calls, stats.attempts, stats.retries, stats.throttles, stats.errors) == (1, 3, 2, 2, 0)
+    ce, = [d for d in METRICS.summary('Test') if d['Service'] == 'ce']
+    assert ce['EstimatedCostUSD'] == 0.01
+
+def test_call_throttled_past_the_last_attempt_is_one_failed_call(ce_client, monkeypatch):
+    from botocore.exceptions import ClientError
+    monkeypatch.setattr(rate_limiter, 'MAX_ATTEMPTS', 3)
+    sent = []
+    ce_client.meta.events.register('before-send', canned_responses([THROTTLED] * 3, sent))
+
+    with pytest.raises(ClientError, match='ThrottlingException'):
+        get_cost_and_usage(ce_client)
+    stats = ce_stats()
+    assert len(sent) == 3
+    assert (stats.calls, stats.attempts, stats.retries, stats.throttles, stats.errors) == (1, 3, 2, 3, 1)
+
+def test_server_error_is_retried_without_lowering_the_rate(ce_client):
+    sent = []
+    ce_client.meta.events.register('before-send', canned_responses([UNAVAILABLE, RESULTS], sent))
+
+    assert get_cost_and_usage(ce_client)['ResultsByTime'] == []
+    stats = ce_stats()
+    assert len(sent) == 2
+    assert (stats.calls, stats.attempts, stats.retries, stats.throttles, stats.errors) == (1, 2, 1, 0, 0)
+    assert ce_client.limiter.rate == ce_client.limiter.max_rate
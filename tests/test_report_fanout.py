@@ -0,0 +1,31 @@
+from collections import Counter
+from aws_clients import get_client
+from pagination import iter_accounts
+from report_email import send_reports
+from report_fanout import account_owners, partition, send_account_reports
+
+SENDER = 'reports@example.com'
+
+# Renders one account's slice; module level so the render processes can run it
+def render(account_id, records):
+    rows = ''.join(f"<tr><td>{record['amount']}</td></tr>" for record in records)
+    return f'Report for {account_id}', f'<table>{rows}</table>', None
+
+def test_send_reports_sends_every_message(org):
+    messages = [(f'Report {n}', '<p>body</p>', f'user-{n % 2}@example.com', None) for n in range(5)]
+    results = list(send_reports(iter(messages), SENDER, max_workers=2))
+
+    assert [error for subject, recipient, count, error in results] == [None] * 5
+    assert org.recipients == Counter({'user-0@example.com': 3, 'user-1@example.com': 2})
+
+def test_account_reports_go_to_their_owners(org):
+    owners = account_owners(iter_accounts(get_client('organizations')))
+    assert owners
+    records = [{'account': account_id, 'amount': n} for n, account_id in enumerate(sorted(owners) * 2)]
+    records.append({'account': '000000000000', 'amount': 1})
+    slices = partition(records, lambda record: record['account'])
+
+    sent = send_account_reports('Test report', slices, render, SENDER)
+
+    assert sent == len(owners)
+    assert org.recipients == Counter(owners.values())
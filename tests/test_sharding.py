@@ -0,0 +1,87 @@
+import json
+from datetime import datetime
+import pytest
+import sharding
+from cloudfront_metrics import fetch_usage_rows
+from cross_account import discover_distributions
+from pagination import iter_accounts
+from aws_clients import get_client
+
+START = datetime(2025, 3, 1)
+END = datetime(2025, 3, 8)
+
+def shard_tasks(count, **extra):
+    accounts = list(iter_accounts(get_client('organizations')))
+    return [
+        dict({'index': i, 'accounts': shard, 'start': START.isoformat(), 'end': END.isoformat(), 'granularity': 'DAILY'}, **extra)
+        for i, shard in enumerate(sharding.split_accounts(accounts, count))
+    ]
+
+def test_partial_usage_survives_json(org):
+    partial = sharding.PartialUsage.from_json(json.loads(json.dumps(sharding.run_shard(shard_tasks(1)[0]))))
+    again = sharding.PartialUsage.from_json(json.loads(json.dumps(partial.to_json())))
+
+    assert list(again.rows()) == list(partial.rows())
+    assert again.distributions == partial.distributions
+    assert again.accounts == partial.accounts
+
+@pytest.mark.parametrize('granularity', ['DAILY', 'MONTHLY'])
+def test_merged_shards_match_the_unsharded_fetch(org, granularity):
+    accounts = list(iter_accounts(get_client('organizations')))
+    distributions = discover_distributions(accounts)
+    expected = fetch_usage_rows(distributions, START, END, granularity)
+    assert expected
+
+    merged = sharding.PartialUsage()
+    for task in reversed(shard_tasks(3, granularity=granularity)):
+        merged.merge(sharding.PartialUsage.from_json(json.loads(json.dumps(sharding.run_shard(task)))))
+
+    assert merged.accounts == len([k for k in accounts if k['Status'] == 'ACTIVE'])
+    assert sorted(d['DistributionId'] for d in merged.distributions) == sorted(d['DistributionId'] for d in distributions)
+    assert sorted(merged.rows()) == sorted(expected)
+
+def test_worker_hands_its_partial_over_through_s3(org):
+    task = shard_tasks(2, result_bucket='shard-results', result_key='shards/run/0.json')[0]
+    result = sharding.run_shard(task)
+
+    assert result == {'bucket': 'shard-results', 'key': 'shards/run/0.json'}
+    assert len(json.dumps(result)) < 100
+    partial = sharding.load_partial(result)
+    assert partial.rows()
+    assert org.objects == {}
+
+def test_a_failed_shard_fails_the_run(org, monkeypatch):
+    # The second shard times out
+    def run_local_shards(tasks):
+        first, second = tasks
+        return [(first, sharding.run_shard(first), None), (second, None, RuntimeError('Task timed out'))]
+    monkeypatch.setattr(sharding, 'run_local_shards', run_local_shards)
+
+    with pytest.raises(RuntimeError, match='1 of 2 shards failed'):
+        sharding.fetch_sharded(START, END, 'DAILY', 2, {'shard_mode': 'local'})
+
+def test_a_timed_out_invocation_is_a_failed_shard_not_a_retry(monkeypatch):
+    from botocore.exceptions import ReadTimeoutError
+    import aws_clients
+
+    invocations = []
+
+    class TimingOutLambda:
+        def invoke(self, **kwargs):
+            invocations.append(kwargs['FunctionName'])
+            raise ReadTimeoutError(endpoint_url='https://lambda.us-east-1.amazonaws.com')
+
+    monkeypatch.setattr(aws_clients, '_create_client', lambda service_name, *args: TimingOutLambda())
+    aws_clients.clear_clients()
+    tasks = [{'index': i, 'accounts': [f'{i:012d}']} for i in range(2)]
+    results = sharding.invoke_shards(tasks, 'cdn-worker', timeout=5)
+    aws_clients.clear_clients()
+
+    assert invocations == ['cdn-worker', 'cdn-worker']
+    assert all(isinstance(error, ReadTimeoutError) for task, result, error in results)
+
+def test_workers_are_not_waited_for_past_the_coordinator_deadline():
+    context = type('Context', (), {'get_remaining_time_in_millis': lambda self: 300000})()
+
+    assert sharding.shard_timeout(context) == 300 - sharding.SHARD_MERGE_SECONDS
+    assert sharding.shard_timeout(None) == sharding.SHARD_TIMEOUT_SECONDS